@@ -0,0 +1,359 @@
+"""Benchmarks of fox against in-process asyncssh servers listening on loopback ports.
+
+Run all the benchmarks and write the results to a JSON file::
+
+    python benchmarks/run.py --output baseline.json
+
+then compare a later run against it, failing when any result is worse than the baseline by more
+than its regression threshold::
+
+    python benchmarks/run.py --output current.json --compare baseline.json
+
+The servers run in the same process and event loop as fox, so the results measure the overhead of
+fox and asyncssh (CPU, buffering, round trips on loopback) rather than the network. With
+`--simulated` the servers are simulated in memory by :class:`fox.transport.SimulatedTransport`:
+no sockets nor cryptography are involved and only the overhead of fox itself is measured, which
+makes it possible to run clusters of 10000 hosts or more.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import contextlib
+from typing import Any, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import asyncssh  # noqa: E402
+import fox.conf  # noqa: E402
+from fox.conf import env  # noqa: E402
+from fox.cluster import Cluster  # noqa: E402
+from fox.connection import Connection, _disconnect_all  # noqa: E402
+from fox.transport import SimulatedTransport  # noqa: E402
+from fox.render import get_renderer  # noqa: E402
+from fox.utils import LineDecoder, get_loop  # noqa: E402
+
+
+#: The maximum allowed regression of each benchmark, as a fraction of the baseline value; the
+#: benchmarks not listed here use `DEFAULT_THRESHOLD`.
+THRESHOLDS = {
+    "connect.p50": 0.3,
+    "run.p50": 0.3,
+    "run.p90": 0.5,
+}
+
+DEFAULT_THRESHOLD = 0.2
+
+LINE = b"x" * 99 + b"\n"
+
+
+class SSHServer(asyncssh.SSHServer):
+    def begin_auth(self, username):
+        # no auth required
+        return False
+
+
+async def process_factory(process):
+    """Serve the commands used by the benchmarks: `true` and `lines <n>`."""
+
+    args = process.command.split()
+    if args[0] == "lines":
+        count = int(args[1])
+        chunk = LINE * 1000
+        for _ in range(count // 1000):
+            process.stdout.write(chunk)
+            await process.stdout.drain()
+        process.stdout.write(LINE * (count % 1000))
+    process.exit(0)
+
+
+async def start_servers(count: int) -> List[Any]:
+    server_key = asyncssh.generate_private_key("ssh-ed25519")
+    servers = []
+    for _ in range(count):
+        server = await asyncssh.create_server(
+            SSHServer,
+            host="127.0.0.1",
+            port=0,
+            server_host_keys=[server_key],
+            process_factory=process_factory,
+            sftp_factory=True,
+            encoding=None,
+        )
+        servers.append(server)
+    return servers
+
+
+def _percentile(values: List[float], percent: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def _connection(port: int) -> Connection:
+    return Connection("127.0.0.1", "bench", port, nickname=f"bench-{port}")
+
+
+async def bench_connect(port: int, count: int) -> Dict[str, float]:
+    durations = []
+    for _ in range(count):
+        conn = _connection(port)
+        started = time.perf_counter()
+        await conn._connect()
+        durations.append(time.perf_counter() - started)
+        await conn._disconnect()
+
+    return {"connect.p50": _percentile(durations, 50)}
+
+
+async def bench_run(port: int, count: int) -> Dict[str, float]:
+    conn = _connection(port)
+    await conn._run("true", echo=False)
+
+    durations = []
+    for _ in range(count):
+        started = time.perf_counter()
+        await conn._run("true", echo=False)
+        durations.append(time.perf_counter() - started)
+    await conn._disconnect()
+
+    return {
+        "run.p50": _percentile(durations, 50),
+        "run.p90": _percentile(durations, 90),
+        "run.ops": count / sum(durations),
+    }
+
+
+async def bench_output(port: int, lines: int) -> Dict[str, float]:
+    conn = _connection(port)
+    await conn._connect()
+
+    if isinstance(env.transport, SimulatedTransport):
+        env.transport.output_size = lines * len(LINE)
+
+    results = {}
+    for echo in (False, True):
+        started = time.perf_counter()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            await conn._run(f"lines {lines}", echo=echo)
+            get_renderer().flush()
+        elapsed = time.perf_counter() - started
+        name = "output.echo" if echo else "output"
+        results[f"{name}.mbps"] = lines * len(LINE) / elapsed / 1e6
+    await conn._disconnect()
+
+    if isinstance(env.transport, SimulatedTransport):
+        env.transport.output_size = 0
+
+    return results
+
+
+async def bench_decoder(size: int) -> Dict[str, float]:
+    """Split `size` bytes of output in lines, with short lines and with a single long line."""
+
+    results = {}
+    for name, data in (("lines", LINE * (size // len(LINE))), ("long", b"x" * size)):
+        decoder = LineDecoder()
+        started = time.perf_counter()
+        for start in range(0, len(data), env.read_size):
+            decoder.feed(data[start : start + env.read_size])  # noqa: E203
+        decoder.close()
+        results[f"decoder.{name}.mbps"] = size / (time.perf_counter() - started) / 1e6
+    return results
+
+
+async def bench_sftp(port: int, size: int, block_sizes: List[int]) -> Dict[str, float]:
+    conn = _connection(port)
+    results = {}
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        source = os.path.join(tmpdir, "source")
+        with open(source, "wb") as fd:
+            fd.write(os.urandom(size))
+
+        for block_size in block_sizes:
+            env.sftp_block_size = block_size
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stderr(devnull):
+                started = time.perf_counter()
+                await conn._put(source, os.path.join(tmpdir, "uploaded"))
+                put_time = time.perf_counter() - started
+
+                started = time.perf_counter()
+                await conn._get(source, os.path.join(tmpdir, "downloaded"))
+                get_time = time.perf_counter() - started
+
+                started = time.perf_counter()
+                await conn._read(source)
+                read_time = time.perf_counter() - started
+                get_renderer().flush()
+
+            kib = block_size // 1024
+            results[f"sftp.put.{kib}k.mbps"] = size / put_time / 1e6
+            results[f"sftp.get.{kib}k.mbps"] = size / get_time / 1e6
+            results[f"sftp.read.{kib}k.mbps"] = size / read_time / 1e6
+
+    env.sftp_block_size = 16384
+    await conn._disconnect()
+    return results
+
+
+async def bench_cluster(ports: List[int], sizes: List[int]) -> Dict[str, float]:
+    results = {}
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for size in sizes:
+            # every simulated host is a different nickname pointing to one of the servers
+            config_path = os.path.join(tmpdir, f"config-{size}")
+            with open(config_path, "w") as fd:
+                for i in range(size):
+                    port = ports[i % len(ports)]
+                    fd.write(f"Host bench{i}\n  HostName 127.0.0.1\n  Port {port}\n  User bench\n")
+            env.ssh_config_path = config_path
+            env.use_ssh_config = True
+            fox.conf._ssh_config = None
+
+            cluster = Cluster(*[f"bench{i}" for i in range(size)])
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(
+                devnull
+            ), contextlib.redirect_stderr(devnull):
+                started = time.perf_counter()
+                results_ = await cluster._run("true")
+                elapsed = time.perf_counter() - started
+                get_renderer().flush()
+            await _disconnect_all(cluster._connections)
+
+            failed = [result for _, result in results_ if isinstance(result, Exception)]
+            if failed:
+                raise RuntimeError(f"{len(failed)} hosts failed, e.g. {failed[0]!r}")
+            results[f"cluster.{size}.seconds"] = elapsed
+
+    env.use_ssh_config = False
+    fox.conf._ssh_config = None
+    return results
+
+
+async def run_benchmarks(args) -> Dict[str, float]:
+    env.use_known_hosts = False
+    env.use_ssh_config = False
+    env.dead_host_ttl = None
+
+    if args.simulated:
+        env.transport = SimulatedTransport()
+        servers = []
+        ports = list(range(2200, 2200 + args.servers))
+    else:
+        servers = await start_servers(args.servers)
+        ports = [server.get_port() for server in servers]
+    results: Dict[str, float] = {}
+
+    try:
+        results.update(await bench_connect(ports[0], args.connections))
+        results.update(await bench_run(ports[0], args.commands))
+        results.update(await bench_output(ports[0], args.lines))
+        results.update(await bench_decoder(args.lines * len(LINE)))
+        results.update(await bench_sftp(ports[0], args.file_size, args.block_sizes))
+        results.update(await bench_cluster(ports, args.hosts))
+    finally:
+        for server in servers:
+            server.close()
+
+    return results
+
+
+def _lower_is_better(name: str) -> bool:
+    return not (name.endswith(".mbps") or name.endswith(".ops"))
+
+
+def best_of(runs: List[Dict[str, float]]) -> Dict[str, float]:
+    """Keep the best value of each benchmark across several runs, to reduce the noise."""
+
+    best = {}
+    for name in runs[0]:
+        values = [run[name] for run in runs]
+        best[name] = min(values) if _lower_is_better(name) else max(values)
+    return best
+
+
+def compare(results: Dict[str, float], baseline: Dict[str, float]) -> List[str]:
+    """Compare the results with a baseline and return the benchmarks that regressed."""
+
+    regressions = []
+    for name, value in sorted(results.items()):
+        if name not in baseline:
+            continue
+        old = baseline[name]
+        if _lower_is_better(name):
+            change = value / old - 1
+        else:
+            change = old / value - 1
+        threshold = THRESHOLDS.get(name, DEFAULT_THRESHOLD)
+        status = "REGRESSION" if change > threshold else "ok"
+        print(f"{name:30} {old:12.6f} -> {value:12.6f} {change:+8.1%} {status}")
+        if change > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def _int_list(value: str) -> List[int]:
+    return [int(item) for item in value.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark fox against local SSH servers")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="compare the results with this JSON file")
+    parser.add_argument(
+        "--simulated", action="store_true", help="simulate the servers instead of using asyncssh"
+    )
+    parser.add_argument(
+        "--loop", default="asyncio", choices=["asyncio", "uvloop"], help="event loop to use"
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="keep the best of N runs")
+    parser.add_argument("--servers", type=int, default=10, help="number of SSH servers")
+    parser.add_argument("--connections", type=int, default=20, help="connections to open")
+    parser.add_argument("--commands", type=int, default=200, help="commands to run")
+    parser.add_argument("--lines", type=int, default=100000, help="lines of output to read")
+    parser.add_argument("--file-size", type=int, default=16 * 1024 * 1024, help="file size")
+    parser.add_argument(
+        "--block-sizes", type=_int_list, default=[16384, 65536, 262144], help="SFTP block sizes"
+    )
+    parser.add_argument(
+        "--hosts", type=_int_list, default=[10, 100, 1000], help="cluster sizes to run"
+    )
+    args = parser.parse_args()
+
+    env.event_loop = args.loop
+    loop = get_loop()
+    runs = [loop.run_until_complete(run_benchmarks(args)) for _ in range(args.repeat)]
+    results = best_of(runs)
+
+    report = {
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "asyncssh": asyncssh.__version__,
+        "platform": platform.platform(),
+        "simulated": args.simulated,
+        "loop": type(loop).__module__,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as fd:
+            json.dump(report, fd, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as fd:
+            baseline = json.load(fd)["results"]
+        regressions = compare(results, baseline)
+        if regressions:
+            print(f"{len(regressions)} benchmarks regressed: {', '.join(regressions)}")
+            sys.exit(1)
+    else:
+        for name, value in sorted(results.items()):
+            print(f"{name:30} {value:12.6f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,15 @@
 import os
 import asyncio
 import shlex
+from typing import Any, Dict, List, Union
 from .conf import env
-from .connection import _get_connection
+from .connection import _get_connection, HostTimeout
 from .utils import CommandResult, read_from_stream, run_in_loop
 
 
-def run(command, pty=False, cd=None, environ=None, echo=True) -> CommandResult:
+def run(
+    command, pty=False, cd=None, environ=None, echo=True, timeout=None, compress=None
+) -> CommandResult:
     """Run a command on the current `env.host_string` remote host.
 
     :param command: the command line string to execute.
@@ -15,13 +18,19 @@ def run(command, pty=False, cd=None, environ=None, echo=True) -> CommandResult:
     :param environ: an optional dictionary containing environment variables to set when
     executing the command.
     :param echo: set to `False` to hide the output of the command.
+    :param timeout: the optional number of seconds to wait for the command to complete (default:
+    `env.command_timeout`).
+    :param compress: compress the output on the remote host with `"zstd"` or `"gzip"` (see
+    :meth:`fox.connection.Connection.run`).
     """
 
     c = _get_connection(env.host_string)
-    return c.run(command, pty, cd)
+    return c.run(command, pty, cd, timeout=timeout, compress=compress)
 
 
-def sudo(command, pty=False, cd=None, environ=None, echo=True) -> CommandResult:
+def sudo(
+    command, pty=False, cd=None, environ=None, echo=True, timeout=None, compress=None
+) -> CommandResult:
     """Run a command on the current env.host_string remote host with sudo
 
     :param command: the command line string to execute.
@@ -30,32 +39,40 @@ def sudo(command, pty=False, cd=None, environ=None, echo=True) -> CommandResult:
     :param environ: an optional dictionary containing environment variables to set when
     executing the command.
     :param echo: set to `False` to hide the output of the command.
+    :param timeout: the optional number of seconds to wait for the command to complete (default:
+    `env.command_timeout`).
+    :param compress: compress the output on the remote host with `"zstd"` or `"gzip"` (see
+    :meth:`fox.connection.Connection.run`).
     """
 
     c = _get_connection(env.host_string)
-    return c.sudo(command, pty, cd)
+    return c.sudo(command, pty, cd, timeout=timeout, compress=compress)
 
 
-def get(remotefile, localfile):
+def get(remotefile, localfile, resume=False):
     """Download a file from the remote server.
 
     :param remotefile: the path to the remote file to download.
     :param localfile: the local path where to write the downloaded file.
+    :param resume: set to `True` to make the download resumable (see
+    :meth:`fox.connection.Connection.get`).
     """
 
     c = _get_connection(env.host_string)
-    c.get(remotefile, localfile)
+    c.get(remotefile, localfile, resume)
 
 
-def put(localfile, remotefile):
+def put(localfile, remotefile, resume=False):
     """Upload a local file to a remote server.
 
     :param localfile: the path of the local file to upload.
     :param remotefile: the path where to write the file on the remote server.
+    :param resume: set to `True` to make the upload resumable (see
+    :meth:`fox.connection.Connection.put`).
     """
 
     c = _get_connection(env.host_string)
-    c.put(localfile, remotefile)
+    c.put(localfile, remotefile, resume)
 
 
 def read(remotefile) -> bytes:
@@ -70,6 +87,26 @@ def read(remotefile) -> bytes:
     return c.read(remotefile)
 
 
+def read_iter(remotefile, chunk_size=None, offset=0, lines=False, follow=False):
+    """Read a remote file lazily, one chunk or line at a time.
+
+    See :meth:`fox.connection.Connection.read_iter` for the parameters.
+    """
+
+    c = _get_connection(env.host_string)
+    return c.read_iter(remotefile, chunk_size, offset, lines, follow)
+
+
+def facts(names=None, refresh=False) -> Dict[str, Any]:
+    """Returns facts about the current `env.host_string` remote host.
+
+    See :meth:`fox.connection.Connection.facts` for the parameters.
+    """
+
+    c = _get_connection(env.host_string)
+    return c.facts(names, refresh)
+
+
 def file_exists(remotefile) -> bool:
     """Check if a file exists on the remote server.
 
@@ -80,34 +117,53 @@ def file_exists(remotefile) -> bool:
     return c.file_exists(remotefile)
 
 
-async def _local(command, environ=None, env_inherit=True, **kwargs) -> CommandResult:
+async def _local(
+    command,
+    cd=None,
+    environ=None,
+    env_inherit=True,
+    echo=True,
+    timeout=None,
+    label="*local*",
+) -> CommandResult:
     args = {
-        "cwd": kwargs.get("cd"),
+        "cwd": cd,
         "stdout": asyncio.subprocess.PIPE,
         "stderr": asyncio.subprocess.PIPE,
     }
 
-    if env is not None:
+    if environ is not None or not env_inherit:
         process_env = {}
         if env_inherit:
             process_env.update(os.environ)
-        process_env.update(environ)
-        args["env"] = environ
+        process_env.update(environ or {})
+        args["env"] = process_env
 
-    label = "*local*"
     original_command = command
     cmdline = shlex.split(command)
 
+    loop = asyncio.get_event_loop()
+    started = loop.time()
     # https://docs.python.org/3/library/asyncio-eventloop.html#asyncio.loop.subprocess_exec
     # All other keyword arguments are passed to subprocess.Popen without interpretation, except for
     # bufsize, universal_newlines and shell, which should not be specified at all.
     proc = await asyncio.create_subprocess_exec(*cmdline, **args)  # type: ignore
-    stdout, stderr = await asyncio.gather(
-        read_from_stream(proc.stdout, proc.stdin, label, decode=True),
-        read_from_stream(proc.stderr, proc.stdin, label, decode=True),
-    )
 
-    await proc.wait()
+    async def _communicate():
+        output = await asyncio.gather(
+            read_from_stream(proc.stdout, proc.stdin, label, echo=echo),
+            read_from_stream(proc.stderr, proc.stdin, label, echo=echo),
+        )
+        await proc.wait()
+        return output
+
+    try:
+        stdout, stderr = await asyncio.wait_for(_communicate(), timeout)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        raise HostTimeout(label, "run", timeout) from None
+
     return CommandResult(
         command=original_command,
         actual_command=command,
@@ -116,10 +172,13 @@ async def _local(command, environ=None, env_inherit=True, **kwargs) -> CommandRe
         # if we use a pty this will be empty
         stderr=stderr,
         hostname="*local*",
+        duration=loop.time() - started,
     )
 
 
-def local(command, cd=None, environ=None, env_inherit=True) -> CommandResult:
+def local(
+    command, cd=None, environ=None, env_inherit=True, echo=True, timeout=None
+) -> CommandResult:
     """Execute `command` on the local machine.
 
     :param command: the command line string to execute.
@@ -128,31 +187,94 @@ def local(command, cd=None, environ=None, env_inherit=True) -> CommandResult:
     executing the command.
     :param env_inherit: set to `False` when you also specify `env` to execute the process in a new
     blank environment.
+    :param echo: set to `False` to hide the output of the command.
+    :param timeout: the optional number of seconds after which the command is killed.
     """
 
-    return run_in_loop(_local(command, cd=cd, environ=environ, env_inherit=env_inherit))
+    return run_in_loop(
+        _local(command, cd=cd, environ=environ, env_inherit=env_inherit, echo=echo, timeout=timeout)
+    )
+
+
+def local_concurrent(
+    commands, limit=0, cd=None, environ=None, env_inherit=True, echo=True, timeout=None
+) -> List[Union[CommandResult, Exception]]:
+    """Execute several `commands` concurrently on the local machine.
+
+    The output of each command is printed as soon as it's produced, labelled with the index of the
+    command (e.g. `[*local:2*]`).
+
+    :param commands: a list of command line strings to execute.
+    :param limit: limit the concurrent execution to `limit` commands; set to `0` to execute all the
+    commands at once.
+    :param cd: the optional name of the directory where the commands will be executed.
+    :param environ: an optional dictionary containing environment variables to set when
+    executing the commands.
+    :param env_inherit: set to `False` when you also specify `env` to execute the processes in a
+    new blank environment.
+    :param echo: set to `False` to hide the output of the commands.
+    :param timeout: the optional number of seconds after which each command is killed.
+
+    Returns the results in the same order as `commands`; a command that could not be executed or
+    timed out is represented by the exception it raised.
+    """
+
+    return run_in_loop(
+        _local_concurrent(
+            commands,
+            limit=limit,
+            cd=cd,
+            environ=environ,
+            env_inherit=env_inherit,
+            echo=echo,
+            timeout=timeout,
+        )
+    )
+
+
+async def _local_concurrent(commands, limit=0, **kwargs):
+    todo = list(enumerate(commands))
+    results: List[Union[CommandResult, Exception, None]] = [None] * len(todo)
+
+    aws: Dict[asyncio.Future, int] = {}
+    while todo or aws:
+        while todo and (not limit or len(aws) < limit):
+            i, command = todo.pop(0)
+            aws[asyncio.ensure_future(_local(command, label=f"*local:{i}*", **kwargs))] = i
+
+        done, _ = await asyncio.wait(aws, return_when=asyncio.FIRST_COMPLETED)
+        for future in done:
+            i = aws.pop(future)
+            try:
+                results[i] = future.result()
+            except Exception as ex:
+                results[i] = ex
+
+    return results
 
 
-def run_concurrent(hosts, command, limit=0):
+def run_concurrent(hosts, command, limit=0, timeout=None):
     """Execute `command` on `hosts` concurrently.
 
     :param hosts: a list of hosts where to run `command`.
     :param command: the command line string to execute.
     :param limit: limit the concurrent execution to `limit` hosts; set to `0` to execute on all the
     hosts at once.
+    :param timeout: the optional number of seconds to wait for the command to complete on each host
+    (default: `env.command_timeout`).
     """
 
-    return run_in_loop(_run_concurrent(hosts, command, limit))
+    return run_in_loop(_run_concurrent(hosts, command, limit=limit, timeout=timeout))
 
 
-async def _run_concurrent(hosts, command, pty=False, cd=None, limit=0):
+async def _run_concurrent(hosts, command, pty=False, cd=None, limit=0, timeout=None):
     conns = [_get_connection(host) for host in hosts]
     futures_done = []
 
     aws = set()
     while conns:
         conn = conns.pop(0)
-        aws.add(asyncio.ensure_future(conn._run(command, pty=pty, cd=cd)))
+        aws.add(asyncio.ensure_future(conn._run(command, pty=pty, cd=cd, timeout=timeout)))
         if limit and len(aws) >= limit:
             done, pending = await asyncio.wait(aws, return_when=asyncio.FIRST_COMPLETED)
             aws = pending
@@ -0,0 +1,432 @@
+"""A local broker that keeps SSH connections open across fox processes.
+
+The broker is a process listening on a Unix socket that runs commands and transfers files on behalf
+of other fox processes, re-using its authenticated SSH connections like OpenSSH does with
+ControlMaster and ControlPersist. Start it with::
+
+    python -m fox.broker --socket ~/.ssh/fox-broker.sock --persist 600
+
+and set `env.broker_path` to the same socket path: all the connections created by fox will then
+go through the broker whenever its socket exists.
+"""
+
+import os
+import sys
+import json
+import time
+import base64
+import socket
+import getpass
+import asyncio
+import logging
+import argparse
+import subprocess
+import dataclasses
+from typing import Any, AsyncIterator, Dict, Optional
+from .conf import env
+from .connection import (
+    Connection,
+    SudoPasswordError,
+    _get_connection,
+    _connections_cache,
+    _disconnect_all,
+)
+from .render import get_renderer
+from .utils import CommandResult, get_loop
+
+
+log = logging.getLogger(__name__)
+
+# responses can contain whole files (see `read`)
+STREAM_LIMIT = 256 * 1024 * 1024
+
+# the number of seconds a successful ping of a broker is trusted for
+ALIVE_TTL = 5.0
+
+# socket path -> time of the last successful ping
+_alive: Dict[str, float] = {}
+
+
+class BrokerError(Exception):
+    """An operation executed through the broker failed.
+
+    :param message: the error message.
+    :param error_type: the name of the exception class raised in the broker.
+    """
+
+    def __init__(self, message: str, error_type: str):
+        super().__init__(message, error_type)
+        self.message = message
+        self.error_type = error_type
+
+    def __str__(self):
+        return f"{self.error_type}: {self.message}"
+
+
+async def _request(path: str, request: Dict[str, Any]) -> Any:
+    reader, writer = await asyncio.open_unix_connection(path, limit=STREAM_LIMIT)
+    try:
+        writer.write(json.dumps(request).encode("utf-8") + b"\n")
+        await writer.drain()
+        response = json.loads(await reader.readline())
+    finally:
+        writer.close()
+
+    if "error" in response:
+        raise BrokerError(response["error"], response["type"])
+    return response["result"]
+
+
+def is_alive(path: str, timeout: float = 1.0) -> bool:
+    """Whether a broker answers on the Unix socket `path`; a socket left by a dead broker doesn't.
+
+    Successful pings are trusted for `ALIVE_TTL` seconds; the ping blocks, so that it can be used
+    outside of the event loop too.
+    """
+
+    now = time.monotonic()
+    if now - _alive.get(path, -ALIVE_TTL) < ALIVE_TTL:
+        return True
+
+    try:
+        with socket.socket(socket.AF_UNIX) as sock:
+            sock.settimeout(timeout)
+            sock.connect(path)
+            sock.sendall(json.dumps({"op": "ping"}).encode("utf-8") + b"\n")
+            with sock.makefile("rb") as fd:
+                alive = json.loads(fd.readline()).get("result") is True
+    except (OSError, ValueError):
+        alive = False
+
+    if alive:
+        _alive[path] = now
+    else:
+        _alive.pop(path, None)
+    return alive
+
+
+async def _stream_request(path: str, request: Dict[str, Any]) -> AsyncIterator[Dict[str, Any]]:
+    """Send a streaming `request` and yield its responses, up to the final result."""
+
+    reader, writer = await asyncio.open_unix_connection(path, limit=STREAM_LIMIT)
+    try:
+        writer.write(json.dumps(request).encode("utf-8") + b"\n")
+        await writer.drain()
+        while True:
+            response = json.loads(await reader.readline())
+            if "error" in response:
+                raise BrokerError(response["error"], response["type"])
+            if "result" in response:
+                return
+            yield response
+    finally:
+        writer.close()
+
+
+class BrokerConnection(Connection):
+    """A connection to a remote server that goes through the broker listening on `path`.
+
+    :param nickname: the name of the server, resolved by the broker.
+    :param path: the path of the Unix socket of the broker.
+    """
+
+    # the broker resolves the hostnames
+    _resolves_locally = False
+
+    def __init__(self, nickname: str, path: str):
+        super().__init__(nickname, "", 0, nickname=nickname)
+        self.path = path
+
+    async def _call(self, op: str, **kwargs) -> Any:
+        return await _request(self.path, {"op": op, "host": self.nickname, **kwargs})
+
+    async def _connect(self):
+        await self._call("connect")
+
+    async def _run(
+        self,
+        command: str,
+        sudo=False,
+        cd: Optional[str] = None,
+        pty=False,
+        environ: Optional[Dict[str, str]] = None,
+        echo=True,
+        timeout: Optional[float] = None,
+        compress: Optional[str] = None,
+        full_output=False,
+        **kwargs,
+    ) -> CommandResult:
+        # the broker can't prompt for the sudo password: it's asked here when the broker needs it
+        for attempt in range(3):
+            try:
+                result = await self._call(
+                    "run",
+                    command=command,
+                    sudo=sudo,
+                    cd=cd,
+                    pty=pty,
+                    environ=environ,
+                    timeout=timeout,
+                    compress=compress,
+                    full_output=full_output,
+                    sudo_password=env.sudo_password if sudo else None,
+                )
+                break
+            except BrokerError as ex:
+                if ex.error_type != SudoPasswordError.__name__ or attempt == 2:
+                    raise
+                get_renderer().flush()
+                env.sudo_password = getpass.getpass("Need password for sudo: ")
+        result = CommandResult(**result)
+        if echo:
+            get_renderer().output(self.nickname, (result.stdout + result.stderr).splitlines())
+        return result
+
+    async def _get(self, remotefile, localfile, resume=False):
+        localfile = os.path.abspath(localfile)
+        await self._call("get", remotefile=remotefile, localfile=localfile, resume=resume)
+
+    async def _put(self, localfile, remotefile, resume=False):
+        localfile = os.path.abspath(localfile)
+        await self._call("put", localfile=localfile, remotefile=remotefile, resume=resume)
+
+    async def _read(self, remotefile) -> bytes:
+        return base64.b64decode(await self._call("read", remotefile=remotefile))
+
+    async def _file_exists(self, remotefile) -> bool:
+        return await self._call("file_exists", remotefile=remotefile)
+
+    async def _read_iter(self, remotefile, chunk_size=None, offset=0, lines=False, follow=False):
+        request = {
+            "op": "read_iter",
+            "host": self.nickname,
+            "remotefile": remotefile,
+            "chunk_size": chunk_size,
+            "offset": offset,
+            "lines": lines,
+            "follow": follow,
+        }
+        async for response in _stream_request(self.path, request):
+            yield response["line"] if lines else base64.b64decode(response["data"])
+
+    def disconnect(self):
+        """Nothing to do: the SSH connection is owned by the broker."""
+
+    @property
+    def connected(self) -> bool:
+        return is_alive(self.path)
+
+
+class Broker:
+    """The broker server.
+
+    :param path: the path of the Unix socket to listen on.
+    :param persist: the number of seconds an idle SSH connection is kept open; the broker exits
+     after being idle for as long.
+    """
+
+    def __init__(self, path: str, persist: float = 600):
+        self.path = path
+        self.persist = persist
+        self._last_used: Dict[str, float] = {}
+        # the number of streaming reads on each connection, which is never idle while they last
+        self._streams: Dict[str, int] = {}
+        self._last_request = time.monotonic()
+        self._active = 0
+
+    async def serve(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+        # the broker holds authenticated connections: only our user can talk to it, from the moment
+        # the socket is created.
+        umask = os.umask(0o177)
+        try:
+            server = await asyncio.start_unix_server(self._handle, self.path, limit=STREAM_LIMIT)
+        finally:
+            os.umask(umask)
+        log.info(f"Broker listening on {self.path}")
+
+        try:
+            await self._reap()
+        finally:
+            server.close()
+            await server.wait_closed()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            await self._close(list(_connections_cache))
+
+    async def _close(self, names):
+        conns = [_connections_cache.pop(name) for name in names]
+        for conn in conns:
+            self._last_used.pop(conn.nickname, None)
+        await _disconnect_all(conns, env.disconnect_timeout)
+
+    async def _reap(self):
+        """Close the idle connections and return when the broker itself is idle."""
+
+        while True:
+            await asyncio.sleep(min(self.persist, 10))
+            now = time.monotonic()
+
+            idle = [
+                name
+                for name, last_used in self._last_used.items()
+                if now - last_used > self.persist and name in _connections_cache
+            ]
+            idle = [name for name in idle if not self._streams.get(name)]
+            if idle:
+                log.info(f"Closing idle connections to: {', '.join(idle)}")
+                await self._close(idle)
+
+            if not self._active and now - self._last_request > self.persist:
+                log.info("Broker is idle, exiting")
+                return
+
+    async def _handle(self, reader, writer):
+        self._active += 1
+        try:
+            request = json.loads(await reader.readline())
+            try:
+                if request["op"] == "read_iter":
+                    await self._read_iter(request, writer)
+                    response = {"result": True}
+                else:
+                    response = {"result": await self._dispatch(request)}
+            except ConnectionError as ex:
+                log.info(f"Request {request['op']} on {request.get('host')} dropped: {ex!r}")
+                return
+            except Exception as ex:
+                log.info(f"Request {request['op']} on {request.get('host')} failed: {ex!r}")
+                response = {"error": str(ex), "type": type(ex).__name__}
+            writer.write(json.dumps(response).encode("utf-8") + b"\n")
+            await writer.drain()
+        finally:
+            writer.close()
+            self._active -= 1
+            self._last_request = time.monotonic()
+
+    async def _read_iter(self, request: Dict[str, Any], writer):
+        """Stream the chunks or lines of a remote file, one response each."""
+
+        name = request["host"]
+        conn = _get_connection(name)
+        lines = request["lines"]
+        self._streams[name] = self._streams.get(name, 0) + 1
+        try:
+            async for item in conn._read_iter(
+                request["remotefile"],
+                request["chunk_size"],
+                request["offset"],
+                lines,
+                request["follow"],
+            ):
+                response = {"line": item} if lines else {"data": base64.b64encode(item).decode()}
+                writer.write(json.dumps(response).encode("utf-8") + b"\n")
+                # read the file only as fast as the client consumes it
+                await writer.drain()
+        finally:
+            self._streams[name] -= 1
+            self._last_used[name] = time.monotonic()
+
+    async def _dispatch(self, request: Dict[str, Any]) -> Any:
+        op = request["op"]
+        if op == "ping":
+            return True
+
+        name = request["host"]
+        conn = _get_connection(name)
+        self._last_used[name] = time.monotonic()
+
+        if op == "connect":
+            if conn._connection is None:
+                await conn._connect()
+            return True
+        if op == "run":
+            result = await conn._run(
+                request["command"],
+                sudo=request["sudo"],
+                cd=request["cd"],
+                pty=request["pty"],
+                environ=request["environ"],
+                echo=False,
+                timeout=request["timeout"],
+                compress=request.get("compress"),
+                full_output=request.get("full_output", False),
+                sudo_password=_request_password(request["sudo_password"]),
+            )
+            return dataclasses.asdict(result)
+        if op == "get":
+            await conn._get(request["remotefile"], request["localfile"], request.get("resume"))
+            return True
+        if op == "put":
+            await conn._put(request["localfile"], request["remotefile"], request.get("resume"))
+            return True
+        if op == "read":
+            data = await conn._read(request["remotefile"])
+            return base64.b64encode(data).decode("ascii")
+        if op == "file_exists":
+            return await conn._file_exists(request["remotefile"])
+
+        raise ValueError(f"unknown operation: {op}")
+
+
+def _request_password(password: Optional[str]):
+    """Returns the function giving sudo the password sent with a request, without prompting."""
+
+    def _password(wrong: bool) -> str:
+        if password is None:
+            raise SudoPasswordError("sudo needs a password")
+        if wrong:
+            raise SudoPasswordError("wrong sudo password")
+        return password
+
+    return _password
+
+
+def start(path: str, persist: float = 600, wait: float = 5):
+    """Start a broker process in the background, unless one is already listening on `path`.
+
+    :param path: the path of the Unix socket of the broker.
+    :param persist: the number of seconds idle connections (and the broker itself) are kept alive.
+    :param wait: the number of seconds to wait for the broker to be ready.
+    """
+
+    path = os.path.abspath(os.path.expanduser(path))
+    if is_alive(path):
+        return
+
+    subprocess.Popen(
+        [sys.executable, "-m", "fox.broker", "--socket", path, "--persist", str(persist)],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+
+    deadline = time.monotonic() + wait
+    while not os.path.exists(path):
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"the broker didn't start listening on {path}")
+        time.sleep(0.05)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Keep SSH connections open for fox processes")
+    parser.add_argument("--socket", required=True, help="the path of the Unix socket")
+    parser.add_argument(
+        "--persist", type=float, default=600, help="seconds to keep idle connections open"
+    )
+    parser.add_argument("--debug", action="store_true", help="enable debug logging")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+    # the broker must connect directly, never through itself
+    env.broker_path = None
+
+    path = os.path.abspath(os.path.expanduser(args.socket))
+    get_loop().run_until_complete(Broker(path, args.persist).serve())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""Caches of entries that expire, optionally persisted across runs in a JSON file."""
+
+import os
+import json
+import time
+import logging
+from typing import Any, Dict, List, Optional
+
+
+log = logging.getLogger(__name__)
+
+
+def load_json(path: str) -> Any:
+    """Load the JSON file `path`; raises `OSError` or `ValueError` when it can't be read."""
+
+    with open(path) as fd:
+        return json.load(fd)
+
+
+def file_signature(path: str) -> List[int]:
+    """Returns the modification time and the size of the file `path`, to tell when it changes.
+
+    It's a list, so that it compares equal to a signature saved in a JSON file.
+    """
+
+    st = os.stat(path)
+    return [st.st_mtime_ns, st.st_size]
+
+
+def save_json(path: str, data: Any):
+    """Save `data` to the JSON file `path` atomically, creating its directory if needed."""
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmpfile = f"{path}.{os.getpid()}"
+    with open(tmpfile, "w") as fd:
+        json.dump(data, fd)
+    os.replace(tmpfile, path)
+
+
+class PersistentCache:
+    """The base class of the caches whose entries expire after `ttl` seconds.
+
+    :param ttl: the number of seconds an entry is cached for.
+    :param path: the optional path of a JSON file used to persist the cache across runs.
+
+    Subclasses store their entries in `_entries`, set `_dirty` when they modify them and implement
+    :meth:`_restore` to load the entries that are not expired yet.
+    """
+
+    #: The name of the cache, in the log messages.
+    name = "cache"
+
+    def __init__(self, ttl: float, path: Optional[str] = None):
+        self.ttl = ttl
+        self.path = path
+        self._entries: Dict[str, Any] = {}
+        self._dirty = False
+        if path is not None:
+            self.load()
+
+    def _restore(self, entries: Dict[str, Any], now: float):
+        raise NotImplementedError
+
+    def load(self):
+        """Load the cache from `path`, discarding the expired entries."""
+
+        try:
+            entries = load_json(self.path)  # type: ignore
+        except (OSError, ValueError) as ex:
+            log.debug(f"Can't load the {self.name}: {ex}")
+            return
+
+        self._restore(entries, time.time())
+
+    def save(self):
+        """Save the cache to `path`, if it was modified."""
+
+        if self.path is None or not self._dirty:
+            return
+
+        save_json(self.path, self._entries)
+        self._dirty = False
@@ -1,76 +1,439 @@
 import asyncio
-import tqdm
-import asyncssh
-from .connection import _get_connection
-from .utils import run_in_loop, CommandResult
+from dataclasses import dataclass, replace
+from typing import Dict, List, Optional, Union
+from .conf import env
+from .connection import _get_connection, _disconnect_all, HostTimeout
+from .resolver import get_resolver
+from .results import open_writer
+from .transport import get_transport
+from . import metrics
+from .render import get_renderer
+from .utils import run_in_loop, iter_in_loop, tee_streams, CommandResult
 
 
-async def _update_bar(bar, n, queue):
-    for _ in range(n):
-        await queue.get()
-        queue.task_done()
-        bar.update(1)
+def _make_batches(items, canary=0, batch_size=None):
+    """Split `items` in an optional canary batch followed by batches of `batch_size` items.
+
+    `batch_size` can be a number of items or a percentage of the total, like `"25%"`; when it's not
+    specified all the items after the canary batch are put in a single batch.
+    """
+
+    items = list(items)
+    total = len(items)
+    batches = []
+
+    if canary:
+        batches.append(items[:canary])
+        items = items[canary:]
+
+    if isinstance(batch_size, str) and batch_size.endswith("%"):
+        size = max(1, int(total * float(batch_size[:-1]) / 100))
+    elif batch_size:
+        size = int(batch_size)
+    else:
+        size = len(items)
+
+    size = max(size, 1)
+    for start in range(0, len(items), size):
+        end = start + size
+        batches.append(items[start:end])
+
+    return batches
+
+
+class HostCancelled(Exception):
+    """A host was cancelled because the run was aborted before it completed; its command may have
+    run partially.
+
+    :param hostname: the name of the cancelled host.
+    """
+
+    def __init__(self, hostname: str):
+        super().__init__(hostname)
+        self.hostname = hostname
+
+    def __str__(self):
+        return f"{self.hostname}: cancelled because the run was aborted"
 
-    bar.close()
+
+def _failed(result) -> bool:
+    return not isinstance(result, CommandResult) or result.exit_code != 0
 
 
 class Cluster:
     """
     Cluster mode.
 
-    Run a command on several hosts in parallel.
-
-    TOOD:
-    - canary run (do a canary run on the first host before doing the remanining)
-    - exit after % of hosts failed
+    Run a command on several hosts in parallel, optionally in rolling batches: a *canary* batch is
+    run first and the run is aborted if any of its hosts fail, then the remaining hosts are run in
+    batches of a fixed size or a percentage of the cluster; the run is aborted as soon as the
+    fraction of failed hosts exceeds `max_failures`.
     """
 
     def __init__(self, *hosts):
         self.hosts = hosts
         self._connections = [_get_connection(host, use_cache=False) for host in self.hosts]
 
-    def run(self, command, limit=0):
-        return run_in_loop(self._run(command, limit))
+        #: The hosts that timed out during the last run, mapped to the phase that timed out
+        #: (`connect`, `run` or `pending`).
+        self.timed_out: Dict[str, str] = {}
 
-    async def _run(self, command, limit=0):
-        bar = tqdm.tqdm(total=len(self.hosts))
-        qbar = asyncio.Queue()
-        futures_done = []
-        aws = set()
+        #: The batches of hosts that were started during the last run.
+        self.batches: List[List[str]] = []
 
-        bar_task = asyncio.ensure_future(_update_bar(bar, len(self.hosts), qbar))
+        #: Wether the last run was aborted because too many hosts failed.
+        self.aborted = False
 
-        for connection in self._connections:
-            aws.add(asyncio.ensure_future(self._do(qbar, connection, command)))
-            if limit and len(aws) >= limit:
-                done, pending = await asyncio.wait(aws, return_when=asyncio.FIRST_COMPLETED)
-                aws = pending
-                futures_done.extend(done)
+        #: The hosts that were still running when the last run was aborted, and were cancelled.
+        self.cancelled: List[str] = []
+
+        #: The number of seconds spent resolving the hostnames of the cluster during the last run.
+        self.resolve_time: Optional[float] = None
+
+    def run(
+        self,
+        command,
+        limit=0,
+        timeout=None,
+        deadline=None,
+        canary=0,
+        batch_size=None,
+        max_failures=None,
+        compress=None,
+        output=None,
+    ):
+        """Run a command on all the hosts of the cluster.
+
+        :param command: the command line string to execute.
+        :param limit: limit the concurrent execution to `limit` hosts; set to `0` to execute on all
+         the hosts of a batch at once.
+        :param timeout: the optional number of seconds to wait for the command to complete on each
+         host (default: `env.command_timeout`).
+        :param deadline: the optional number of seconds after which the whole run is stopped; hosts
+         still connecting or running are cancelled and reported in :attr:`timed_out`.
+        :param canary: the number of hosts to run first, as a canary batch; any failure in the
+         canary batch aborts the run.
+        :param batch_size: run the hosts in batches of `batch_size` hosts; it can also be a
+         percentage of the cluster size like `"25%"`.
+        :param max_failures: abort the run when the fraction of the cluster hosts that failed (e.g.
+         `0.1` for 10%) exceeds this value; pending hosts are cancelled and reported in
+         :attr:`cancelled`, and the remaining batches are skipped.
+        :param compress: compress the output of the command on the hosts with `"zstd"` or
+         `"gzip"`, see :meth:`fox.connection.Connection.run`.
+        :param output: the optional path of a file where the results are written as soon as each
+         host completes, in JSONL or, when the path ends with `.parquet`, in Parquet format (see
+         :mod:`fox.results`); the returned results then don't hold the output of the commands,
+         only their status.
+
+        Returns a list of `(nickname, result)` tuples, where `result` is a
+        :class:`fox.utils.CommandResult` or the exception raised by the host (a
+        :class:`HostCancelled` for the hosts cancelled when the run is aborted).
+        """
+
+        return run_in_loop(
+            self._run(
+                command,
+                limit,
+                timeout,
+                deadline,
+                canary,
+                batch_size,
+                max_failures,
+                compress,
+                output=output,
+            )
+        )
+
+    async def _run(self, command, *args, output=None):
+        writer = open_writer(output) if output is not None else None
+        try:
+            with metrics.span("cluster.run", hosts=len(self.hosts)) as stats:
+                results = await self._run_batches(command, *args, writer=writer)
+                stats["failures"] = sum(1 for _, result in results if _failed(result))
+                stats["aborted"] = self.aborted
+        finally:
+            if writer is not None:
+                writer.close()
+        return results
+
+    async def _run_batches(
+        self,
+        command,
+        limit=0,
+        timeout=None,
+        deadline=None,
+        canary=0,
+        batch_size=None,
+        max_failures=None,
+        compress=None,
+        writer=None,
+    ):
+        renderer = get_renderer()
+        progress = renderer.progress("hosts", len(self.hosts))
+        results = []
+        self.timed_out = {}
+        self.batches = []
+        self.aborted = False
+        self.cancelled = []
 
-        if len(aws):
-            done, pending = await asyncio.wait(aws, return_when=asyncio.ALL_COMPLETED)
-            futures_done.extend(done)
+        expires_at = None
+        if deadline is not None:
+            expires_at = asyncio.get_event_loop().time() + deadline
 
-        _ = await asyncio.wait({bar_task})
+        def _completed(nickname, result):
+            if writer is not None:
+                writer.write(nickname, result)
+                if isinstance(result, CommandResult):
+                    # the output is in the file already: keep only the status of the host
+                    result = replace(result, stdout="", stderr="")
+            results.append((nickname, result))
 
-        results = [future.result() for future in futures_done]
-        for connection, result in results:
+        # hosts that can't be resolved fail right away, without being scheduled
+        errors = await self._resolve()
+        unresolved = [
+            (c.nickname, errors[c.hostname]) for c in self._connections if c.hostname in errors
+        ]
+        for nickname, result in unresolved:
+            _completed(nickname, result)
+            progress.update()
+        failures = len(unresolved)
+        connections = [c for c in self._connections if c.hostname not in errors]
+
+        batches = _make_batches(connections, canary, batch_size)
+        for n, batch in enumerate(batches):
+            self.batches.append([connection.nickname for connection in batch])
+            is_canary = canary and n == 0
+            batch_failures = 0
+            todo = list(batch)
+            aws = set()
+            # the nicknames of the running hosts, to report them if they are cancelled
+            running = {}
+
+            while todo or aws:
+                while todo and (not limit or len(aws) < limit):
+                    connection = todo.pop(0)
+                    future = asyncio.ensure_future(
+                        self._do(
+                            progress,
+                            connection,
+                            command,
+                            timeout,
+                            expires_at,
+                            deadline,
+                            compress,
+                        )
+                    )
+                    running[future] = connection.nickname
+                    aws.add(future)
+
+                done, aws = await asyncio.wait(aws, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    _completed(*future.result())
+                batch_failures += sum(1 for future in done if _failed(future.result()[1]))
+
+                if is_canary and batch_failures:
+                    self.aborted = True
+                elif max_failures is not None:
+                    self.aborted = (failures + batch_failures) / len(self.hosts) > max_failures
+
+                if self.aborted:
+                    for future in aws:
+                        future.cancel()
+                    if aws:
+                        await asyncio.wait(aws)
+                    for future in aws:
+                        if future.cancelled():
+                            nickname = running[future]
+                            _completed(nickname, HostCancelled(nickname))
+                            progress.update()
+                        else:
+                            _completed(*future.result())
+                    break
+
+            failures += batch_failures
+            label = " (canary)" if is_canary else ""
+            renderer.message(
+                f"batch {n + 1}/{len(batches)}{label}: {len(batch)} hosts, "
+                f"{batch_failures} failed"
+            )
+            if self.aborted:
+                renderer.message(
+                    f"aborting: {failures} of {len(self.hosts)} hosts failed, "
+                    f"{len(batches) - n - 1} batches not run"
+                )
+                break
+
+        progress.close()
+
+        for nickname, result in results:
             if isinstance(result, CommandResult):
-                print(f"output from {connection.nickname}: {result.stdout}", end="")
+                if not env.quiet and writer is None:
+                    renderer.message(f"output from {nickname}: {result.stdout.rstrip()}")
+            elif isinstance(result, HostTimeout):
+                self.timed_out[nickname] = result.phase
+                renderer.message(f"timed out on {nickname} during {result.phase}")
+            elif isinstance(result, HostCancelled):
+                self.cancelled.append(nickname)
+                renderer.message(f"cancelled on {nickname}")
             else:
-                print(f"command failed on {connection.nickname}: {result}")
+                renderer.message(f"command failed on {nickname}: {result}")
 
         return results
 
-    async def _do(self, queue, connection, command):
+    # use the event loop
+    def tail(self, remotefile, offset=-4096, follow=True):
+        """Read the lines of a remote file on all the hosts of the cluster at once, like `tail -f`.
+
+        Returns an iterator of `(nickname, line)` tuples, in the order the lines are read; the
+        hosts are read concurrently and a host that fails is dropped without stopping the others.
+
+        :param remotefile: the path of the remote file to read.
+        :param offset: where to start reading each file, see
+         :meth:`fox.connection.Connection.read_iter`; by default the last 4KiB are read.
+        :param follow: keep reading the lines appended to the files; set to `False` to stop at the
+         end of the files.
+        """
+
+        return iter_in_loop(self._tail(remotefile, offset, follow))
+
+    async def _tail(self, remotefile, offset=-4096, follow=True):
+        # bounded, so that slow consumers pause the reads instead of buffering the files
+        queue: asyncio.Queue = asyncio.Queue(maxsize=1024)
+
+        async def _read_host(connection):
+            try:
+                async for line in connection._read_iter(
+                    remotefile, offset=offset, lines=True, follow=follow
+                ):
+                    await queue.put((connection.nickname, line))
+            except Exception as exc:
+                get_renderer().message(f"tail failed on {connection.nickname}: {exc}")
+            await queue.put((connection.nickname, None))
+
+        tasks = [asyncio.ensure_future(_read_host(c)) for c in self._connections]
         try:
-            result = await connection._run(command, echo=False)
+            running = len(tasks)
+            while running:
+                nickname, line = await queue.get()
+                if line is None:
+                    running -= 1
+                    continue
+                yield nickname, line
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    # use the event loop
+    def facts(self, names=None, refresh=False):
+        """Returns facts about all the hosts of the cluster, gathered concurrently.
+
+        Returns a dictionary mapping each host to its facts, or to the exception raised while
+        gathering them; see :meth:`fox.connection.Connection.facts` for the parameters.
+        """
+
+        return run_in_loop(self._facts(names, refresh))
+
+    async def _facts(self, names=None, refresh=False):
+        results = await asyncio.gather(
+            *[connection._facts(names, refresh) for connection in self._connections],
+            return_exceptions=True,
+        )
+        return {
+            connection.nickname: result for connection, result in zip(self._connections, results)
+        }
+
+    def invalidate_facts(self, names=None):
+        """Forget the cached facts in `names` (default: all of them) about all the hosts."""
+
+        for connection in self._connections:
+            connection.invalidate_facts(names)
+
+    # use the event loop
+    def close(self):
+        """Close the connections to all the hosts of the cluster."""
+
+        run_in_loop(self._close())
+
+    async def _close(self):
+        await _disconnect_all(self._connections, env.disconnect_timeout)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._close()
+
+    async def _resolve(self):
+        """Resolve all the hostnames of the cluster at once and return the resolution errors."""
+
+        resolver = get_resolver()
+        if resolver is None or not get_transport().uses_network:
+            return {}
+
+        loop = asyncio.get_event_loop()
+        started = loop.time()
+        hostnames = [c.hostname for c in self._connections if c._resolves_locally and not c.tunnel]
+        addresses = await resolver.resolve_all(hostnames)
+        self.resolve_time = loop.time() - started
+
+        errors = {
+            hostname: address
+            for hostname, address in addresses.items()
+            if isinstance(address, Exception)
+        }
+        get_renderer().message(
+            f"resolved {len(addresses)} hostnames in {self.resolve_time:.3f}s, "
+            f"{len(errors)} failed"
+        )
+        return errors
+
+    async def _do(
+        self,
+        progress,
+        connection,
+        command,
+        timeout=None,
+        expires_at=None,
+        deadline=None,
+        compress=None,
+    ):
+        metrics.current_host.set(connection.nickname)
+        try:
+            with metrics.span("host", connection.nickname):
+                result = await self._run_host(
+                    connection, command, timeout, expires_at, deadline, compress
+                )
         except Exception as exc:
-            print(f"Task on {connection} failed: {exc}")
-            result = None
+            get_renderer().message(f"Task on {connection.nickname} failed: {exc}")
+            result = exc
+
+        progress.update()
+        # only the nickname is kept, so that the results don't hold on to the connections
+        return (connection.nickname, result)
 
-        await queue.put(1)
-        return (connection, result)
+    async def _run_host(
+        self, connection, command, timeout=None, expires_at=None, deadline=None, compress=None
+    ):
+        if expires_at is None:
+            return await connection._run(command, echo=False, timeout=timeout, compress=compress)
+
+        remaining = expires_at - asyncio.get_event_loop().time()
+        if remaining <= 0:
+            raise HostTimeout(connection.nickname, "pending", deadline)
+        try:
+            return await asyncio.wait_for(
+                connection._run(command, echo=False, timeout=timeout, compress=compress), remaining
+            )
+        except asyncio.TimeoutError:
+            phase = "run" if connection.connected else "connect"
+            raise HostTimeout(connection.nickname, phase, deadline) from None
 
 
 def connect_pipes(source, source_command, destination, destination_command):
@@ -83,6 +446,8 @@ def connect_pipes(source, source_command, destination, destination_command):
 
 
 async def _connect_pipes(source, source_command, destination, destination_command):
+    import asyncssh
+
     source_conn = _get_connection(source, use_cache=False)
     dest_conn = _get_connection(destination, use_cache=False)
 
@@ -106,3 +471,139 @@ async def _connect_pipes(source, source_command, destination, destination_comman
         stderr=stderr,
         hostname=destination,
     )
+
+
+@dataclass
+class PipeResult:
+
+    #: The name of the host the data was piped to.
+    hostname: str
+
+    #: The number of bytes written to the destination command.
+    bytes: int
+
+    #: The number of seconds from the start of the pipe to the exit of the destination command.
+    duration: float
+
+    #: The result of the destination command, or the exception that interrupted it.
+    result: Union[CommandResult, Exception]
+
+    @property
+    def throughput(self) -> float:
+        """The average number of bytes per second written to the destination command."""
+
+        return self.bytes / self.duration if self.duration else 0.0
+
+
+def tee_pipes(source, source_command, destinations, destination_command):
+    """Pipe the output of a command to several processes at once, like `tee`.
+
+    The stdout of `source_command`, executed on `source`, is written to the stdin of
+    `destination_command` executed on each of the `destinations` hosts, so that e.g. a database dump
+    can seed many replicas at once. The source is throttled by the slowest destination; a
+    destination that fails is dropped without stopping the others.
+
+    Returns the :class:`fox.utils.CommandResult` of the source command (without its stdout) and a
+    :class:`PipeResult` for each destination.
+    """
+
+    return run_in_loop(_tee_pipes(source, source_command, destinations, destination_command))
+
+
+async def _tee_pipes(source, source_command, destinations, destination_command):
+    source_conn = _get_connection(source, use_cache=False)
+    dest_conns = [_get_connection(destination, use_cache=False) for destination in destinations]
+    try:
+        return await _tee_processes(source_conn, source_command, dest_conns, destination_command)
+    finally:
+        await _disconnect_all([source_conn, *dest_conns])
+
+
+async def _tee_processes(source_conn, source_command, dest_conns, destination_command):
+    loop = asyncio.get_event_loop()
+    started = loop.time()
+
+    await source_conn._connect()
+    errors = await asyncio.gather(*[conn._connect() for conn in dest_conns], return_exceptions=True)
+    connected = [conn for conn, error in zip(dest_conns, errors) if error is None]
+
+    source_proc = await source_conn._connection.create_process(source_command, encoding=None)
+    # a destination that fails to start its process is dropped, like one that fails to connect
+    procs = await asyncio.gather(
+        *[
+            conn._connection.create_process(destination_command, encoding=None)
+            for conn in connected
+        ],
+        return_exceptions=True,
+    )
+    # everything is kept by position, as the same host can be given more than once
+    errors = list(errors)
+    positions = [i for i, error in enumerate(errors) if error is None]
+    for i, proc in zip(positions, procs):
+        if isinstance(proc, Exception):
+            errors[i] = proc
+    started_procs = [(i, proc) for i, proc in zip(positions, procs) if errors[i] is None]
+    dest_procs = [proc for _, proc in started_procs]
+
+    finished: Dict[int, float] = {}
+
+    async def _wait_destination(i, proc):
+        conn = dest_conns[i]
+        stdout, stderr = await asyncio.gather(
+            conn._read_from(proc.stdout, proc.stdin), conn._read_from(proc.stderr, proc.stdin)
+        )
+        await proc.wait()
+        finished[i] = loop.time()
+        return CommandResult(
+            command=destination_command,
+            actual_command=destination_command,
+            exit_code=proc.exit_status,
+            stdout=stdout,
+            stderr=stderr,
+            hostname=conn.nickname,
+            duration=finished[i] - started,
+        )
+
+    async def _tee():
+        written = await tee_streams(source_proc.stdout, [proc.stdin for proc in dest_procs])
+        if not source_proc.stdout.at_eof():
+            # all the destinations failed: stop the source instead of waiting for it forever
+            source_proc.close()
+        return written
+
+    written, source_stderr, *dest_results = await asyncio.gather(
+        _tee(),
+        source_conn._read_from(source_proc.stderr, source_proc.stdin),
+        *[_wait_destination(i, proc) for i, proc in started_procs],
+        return_exceptions=True,
+    )
+    for error in (written, source_stderr):
+        if isinstance(error, Exception):
+            raise error
+    await source_proc.wait_closed()
+
+    source_result = CommandResult(
+        command=source_command,
+        actual_command=source_command,
+        exit_code=source_proc.exit_status,
+        stdout="",
+        stderr=source_stderr,
+        hostname=source_conn.nickname,
+        duration=loop.time() - started,
+    )
+
+    results = []
+    written_by_position = dict(zip([i for i, _ in started_procs], written))
+    dest_results_by_position = dict(zip([i for i, _ in started_procs], dest_results))
+    for i, conn in enumerate(dest_conns):
+        result = errors[i] if errors[i] is not None else dest_results_by_position[i]
+        duration = finished.get(i, loop.time()) - started
+        pipe = PipeResult(conn.nickname, written_by_position.get(i, 0), duration, result)
+        metrics.emit(metrics.Span("pipe", conn.nickname, started, duration, {"bytes": pipe.bytes}))
+        get_renderer().message(
+            f"piped {pipe.bytes} bytes to {conn.nickname} in {duration:.3f}s "
+            f"({pipe.throughput / 1e6:.2f} MB/s)"
+        )
+        results.append(pipe)
+
+    return source_result, results
@@ -0,0 +1,140 @@
+"""Compression of the output of remote commands.
+
+The remote command is wrapped in a shell script that pipes its stdout through `zstd` or `gzip`,
+whichever is available on the remote host, and preserves its exit status; the first line of the
+output names the compressor that was used, so that the controller can decompress the rest of the
+stream incrementally with :class:`DecompressingReader`. stderr is never compressed.
+"""
+
+import shlex
+import logging
+from typing import Any, List, Optional
+
+
+log = logging.getLogger(__name__)
+
+# the fastest levels: the goal is to save bandwidth without slowing down the remote host
+COMPRESSORS = {
+    "zstd": "zstd -q -c -1",
+    "gzip": "gzip -c -1",
+}
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        return None
+    return zstandard
+
+
+def _candidates(method: str) -> List[str]:
+    if method not in COMPRESSORS:
+        raise ValueError(f"unknown compression method: {method}")
+
+    if method == "zstd":
+        if _zstandard() is not None:
+            return ["zstd", "gzip"]
+        log.warning("zstandard is not installed, falling back to gzip")
+    return ["gzip"]
+
+
+def compress_command(command: str, method: str) -> str:
+    """Wrap `command` so that its stdout is compressed with `method` (`"zstd"` or `"gzip"`).
+
+    The remote host falls back to gzip when zstd is not installed, and to no compression at all
+    when gzip is not installed either. The exit status of `command` is preserved.
+    """
+
+    checks = []
+    for n, name in enumerate(_candidates(method)):
+        keyword = "if" if n == 0 else "elif"
+        checks.append(
+            f"{keyword} command -v {name} >/dev/null 2>&1; then c='{COMPRESSORS[name]}'; n={name}"
+        )
+    checks.append("else c=cat; n=none; fi")
+
+    # the exit status of the command is written on fd 3, while the compressed output goes to the
+    # original stdout saved on fd 4.
+    run = f'"${{SHELL:-sh}}" -c {shlex.quote(command)} 3>&- 4>&-; echo $? >&3'
+    script = "\n".join(
+        [
+            *checks,
+            "printf '%s\\n' \"$n\"",
+            "exec 4>&1",
+            f"s=$( {{ {{ {run}; }} | $c >&4 3>&-; }} 3>&1 )",
+            "exit $s",
+        ]
+    )
+    return f"sh -c {shlex.quote(script)}"
+
+
+class DecompressingReader:
+    """Read the stdout of a command wrapped by :func:`compress_command` and decompress it.
+
+    :param stream: the stream to read, with an asynchronous `read(n)` method returning bytes.
+
+    Output without a known header (e.g. from a command that wasn't wrapped) is returned as is.
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._decompressor: Optional[Any] = None
+        self._pending = b""
+        self._started = False
+        self._done = False
+
+        #: The number of (compressed) bytes read from the stream.
+        self.wire_bytes = 0
+
+    async def _read_header(self):
+        header = b""
+        while b"\n" not in header:
+            data = await self._stream.read(256)
+            if not data:
+                break
+            self.wire_bytes += len(data)
+            header += data
+
+        name, sep, rest = header.partition(b"\n")
+        if sep and name == b"gzip":
+            import zlib
+
+            # accept the gzip header and trailer
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif sep and name == b"zstd":
+            self._decompressor = _zstandard().ZstdDecompressor().decompressobj()  # type: ignore
+        elif not sep or name != b"none":
+            # not a compressed stream: return everything that was read
+            rest = header
+
+        self._started = True
+        self._pending = self._decompress(rest) if rest else b""
+
+    def _decompress(self, data: bytes) -> bytes:
+        if self._decompressor is None:
+            return data
+        return self._decompressor.decompress(data)
+
+    async def read(self, n: int = -1) -> bytes:
+        if not self._started:
+            await self._read_header()
+
+        if self._pending:
+            data, self._pending = self._pending, b""
+            return data
+
+        while not self._done:
+            data = await self._stream.read(n)
+            if not data:
+                self._done = True
+                if self._decompressor is not None and hasattr(self._decompressor, "flush"):
+                    return self._decompressor.flush()
+                return b""
+
+            self.wire_bytes += len(data)
+            data = self._decompress(data)
+            if data:
+                return data
+
+        return b""
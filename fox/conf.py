@@ -1,6 +1,8 @@
 import os
-from typing import Dict, Any, Optional
-from .sshconfig import SSHConfig
+from typing import TYPE_CHECKING, Dict, Any, Optional, Union
+
+if TYPE_CHECKING:
+    from .sshconfig import SSHConfig
 
 
 class Environment:
@@ -25,6 +27,10 @@ class Environment:
     #: Set the path to the OpenSSH configuration file.
     ssh_config_path = os.path.expanduser("~/.ssh/config")
 
+    #: The optional path of a file where the parsed OpenSSH configuration is cached, to skip parsing
+    #: it again until any of its files change (e.g. `~/.cache/fox/ssh_config.json`).
+    ssh_config_cache_path: Optional[str] = None
+
     #: Set the password for the `sudo()` commands.
     sudo_password: Optional[str] = None
 
@@ -40,11 +46,140 @@ class Environment:
     #: The path to a OpenSSH private key.
     private_key: Optional[str] = None
 
+    #: The number of seconds to wait for a SSH connection to be established (`None` to wait
+    #: forever).
+    connect_timeout: Optional[float] = None
+
+    #: The default number of seconds to wait for a remote command to complete (`None` to wait
+    #: forever).
+    command_timeout: Optional[float] = None
+
+    #: The default compression of the output of remote commands: `"zstd"`, `"gzip"` or `None` to
+    #: disable it (see :meth:`fox.connection.Connection.run`).
+    compress: Optional[str] = None
+
+    #: The number of seconds the facts gathered from a host are cached for (see
+    #: :mod:`fox.facts`); set to `None` to gather them every time.
+    facts_ttl: Optional[float] = 3600
+
+    #: The optional path of a file used to cache the facts across runs.
+    facts_cache_path: Optional[str] = None
+
+    #: Set to `True` to hide the output of the commands and the progress of transfers and runs;
+    #: the output is not even formatted, which saves CPU time on large clusters.
+    quiet = False
+
+    #: The minimum number of seconds between two writes of the output of the commands or two
+    #: redraws of the progress (see :mod:`fox.render`).
+    render_interval = 0.1
+
+    #: The number of seconds the list of the keys held by a SSH agent is cached for; keys added to
+    #: the agent afterwards are seen by the next connections. Set to `None` to cache it forever.
+    agent_keys_ttl: Optional[float] = 60
+
+    #: The number of seconds to wait for the open connections to close at exit.
+    disconnect_timeout: Optional[float] = 5.0
+
+    #: The number of seconds a failed connection to a host is remembered for, e.g. `300`; until then
+    #: new connections to the host will fail fast. The dead hosts cache is disabled by default.
+    dead_host_ttl: Optional[float] = None
+
+    #: The optional path of a file used to remember the dead hosts across runs.
+    dead_host_cache_path: Optional[str] = None
+
+    #: Before failing fast, check if a dead host came back with a TCP connection that must complete
+    #: within this number of seconds; set to `None` to fail without checking.
+    dead_host_probe_timeout: Optional[float] = 1.0
+
+    #: The number of seconds resolved hostnames are cached for, e.g. `60`; by default (`None`) each
+    #: connection resolves its hostname.
+    resolver_ttl: Optional[float] = None
+
+    #: The maximum number of concurrent DNS lookups.
+    resolver_concurrency = 32
+
+    #: The transport tuning preset applied to all the connections: either the name of one of
+    #: :data:`TRANSPORT_PROFILES` (`"lan"`, `"wan"`) or a dictionary of asyncssh connection
+    #: options; it overrides the transport options from `~/.ssh/config`.
+    transport_profile: Optional[Union[str, Dict[str, Any]]] = None
+
+    #: The number of bytes read at once from the output of the commands.
+    read_size = 65536
+
+    #: Lines of output longer than this number of characters are split in several lines.
+    max_line_length = 65536
+
+    #: The number of characters of the output of a command kept in its result: only the last ones
+    #: are kept, so that the results of a large cluster fit in memory. Set to `None` to keep the
+    #: whole output.
+    max_output_length: Optional[int] = 10240
+
+    #: The transport used to reach the servers: `None` to connect with asyncssh, or an instance of a
+    #: :class:`fox.transport.Transport` like :class:`fox.transport.SimulatedTransport`.
+    transport: Optional[Any] = None
+
+    #: The size of the SFTP read and write requests used by file transfers; larger blocks are faster
+    #: on high latency links, as long as the server supports them.
+    sftp_block_size = 16384
+
+    #: The number of seconds between two checks for new data in a followed remote file (see
+    #: :meth:`fox.connection.Connection.read_iter`).
+    follow_interval = 1.0
+
+    #: The number of times a resumable transfer (`get(..., resume=True)`) is attempted when the
+    #: connection drops.
+    transfer_attempts = 3
+
+    #: Before resuming a transfer, the last bytes (at most this number) of the partial file are
+    #: compared with the source file; the transfer starts over if they differ.
+    resume_check_size = 65536
+
+    #: The path of the Unix socket of a :mod:`fox.broker` process; when the socket exists all the
+    #: connections go through the broker, which keeps them open across fox processes.
+    broker_path: Optional[str] = None
+
+    #: The event loop implementation: `"asyncio"`, `"uvloop"` or `"auto"` to use uvloop when it's
+    #: installed; fox creates one event loop per thread (see :func:`fox.utils.get_loop`).
+    event_loop = "asyncio"
+
+    #: Set to `"lag"`, `"cprofile"` or `"yappi"` to profile each run of the event loop and write a
+    #: report with the event loop lag, the slow callbacks and the slowest hosts (see
+    #: :class:`fox.profiling.Profiler`).
+    profile: Optional[str] = None
+
+    #: The path of the file where the profiling reports are appended (default: stderr).
+    profile_report_path: Optional[str] = None
+
+    #: Callbacks blocking the event loop for longer than this number of seconds are reported when
+    #: profiling.
+    profile_slow_callback = 0.05
+
 
 #: Global configuration object.
 env = Environment()
 
-_ssh_config: Optional[SSHConfig] = None
+#: Transport tuning presets, selected with `env.transport_profile`: `lan` uses a cheap cipher and no
+#: compression for bulk transfers inside a datacenter, `wan` enables compression for slow links.
+TRANSPORT_PROFILES: Dict[str, Dict[str, Any]] = {
+    "lan": {
+        "encryption_algs": ["aes128-gcm@openssh.com", "aes128-ctr"],
+        "compression_algs": ["none"],
+    },
+    "wan": {
+        "compression_algs": ["zlib@openssh.com", "zlib", "none"],
+        "keepalive_interval": 30,
+    },
+}
+
+# ssh_config options that map directly to asyncssh connection options
+SSH_TRANSPORT_OPTIONS = {
+    "ciphers": "encryption_algs",
+    "kexalgorithms": "kex_algs",
+    "macs": "mac_algs",
+    "hostkeyalgorithms": "server_host_key_algs",
+}
+
+_ssh_config: Optional["SSHConfig"] = None
 
 
 def options_to_connect(hostname: str) -> Dict[str, Any]:
@@ -65,8 +200,10 @@ def options_to_connect(hostname: str) -> Dict[str, Any]:
 
     global _ssh_config
     if _ssh_config is None:
+        from .sshconfig import SSHConfig
+
         _ssh_config = SSHConfig()
-        _ssh_config.load(os.path.abspath(env.ssh_config_path))
+        _ssh_config.load(os.path.abspath(env.ssh_config_path), env.ssh_config_cache_path)
 
     ssh_options = _ssh_config.lookup(hostname)
 
@@ -77,3 +214,35 @@ def options_to_connect(hostname: str) -> Dict[str, Any]:
     ssh_options.update(options_from_env)
 
     return ssh_options
+
+
+def transport_options(ssh_options: Dict[str, Any]) -> Dict[str, Any]:
+    """Translate the transport options from ssh_config to asyncssh connection options.
+
+    The options of `env.transport_profile`, if any, take precedence.
+    """
+
+    options: Dict[str, Any] = {}
+    for name, asyncssh_name in SSH_TRANSPORT_OPTIONS.items():
+        if name in ssh_options:
+            # asyncssh supports the same "+alg", "-alg" and "^alg" syntax of OpenSSH
+            options[asyncssh_name] = ssh_options[name]
+
+    if "compression" in ssh_options:
+        if ssh_options["compression"].lower() == "yes":
+            options["compression_algs"] = ["zlib@openssh.com", "zlib", "none"]
+        else:
+            options["compression_algs"] = ["none"]
+
+    if "serveraliveinterval" in ssh_options:
+        options["keepalive_interval"] = int(ssh_options["serveraliveinterval"])
+    if "serveralivecountmax" in ssh_options:
+        options["keepalive_count_max"] = int(ssh_options["serveralivecountmax"])
+
+    profile = env.transport_profile
+    if isinstance(profile, str):
+        profile = TRANSPORT_PROFILES[profile]
+    if profile:
+        options.update(profile)
+
+    return options
@@ -4,17 +4,45 @@ import getpass
 import warnings
 import asyncio
 import logging
-import collections
 import atexit
-from typing import Optional, Dict, Deque
-import tqdm
-import asyncssh
-from .conf import env, options_to_connect
-from .utils import run_in_loop, CommandResult, prepare_environment, split_lines
-
-
-# disable annoying warnings (we can't fix the problems in 3rd party libs)
-warnings.simplefilter("ignore")
+import weakref
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncIterator,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Union,
+)
+from .conf import env, options_to_connect, transport_options
+from .deadhosts import get_dead_hosts, probe
+from .resolver import get_resolver
+from .keys import load_private_key, load_known_hosts, get_agent_keys, close_agents, _agents
+from .transport import get_transport
+from .compression import compress_command, DecompressingReader
+from .facts import FACTS, gather_command, parse_output, get_facts_cache
+from .render import get_renderer
+from . import metrics
+from .utils import (
+    run_in_loop,
+    iter_in_loop,
+    CommandResult,
+    LineDecoder,
+    OutputBuffer,
+    prepare_environment,
+)
+
+if TYPE_CHECKING:
+    import asyncssh
+
+
+# disable annoying warnings (we can't fix the problems in 3rd party libs), e.g. the deprecation
+# warnings about old ciphers that asyncssh triggers in cryptography, without hiding the warnings
+# of other modules.
+warnings.filterwarnings("ignore", module=r"(asyncssh|cryptography)(\.|$)")
 
 
 log = logging.getLogger(__name__)
@@ -24,17 +52,104 @@ log = logging.getLogger(__name__)
 _connections_cache: Dict[str, "Connection"] = {}
 
 
+# resumable transfers read and write this many SFTP blocks at once (asyncssh splits them in
+# parallel requests)
+RESUME_CHUNK_BLOCKS = 64
+
+
+# All the open connections by event loop, including the ones not in the cache (e.g. created by
+# Cluster, or used as tunnels), so that they can be closed at exit; each thread has its own event
+# loop, and a connection can only be closed in the loop where it was opened.
+_open_connections: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, weakref.WeakSet]"
+_open_connections = weakref.WeakKeyDictionary()
+
+
+async def _disconnect_all(connections, timeout: Optional[float] = None):
+    """Close many connections at once, waiting at most `timeout` seconds for them to close."""
+
+    connections = [conn for conn in connections if conn.connected]
+    if not connections:
+        return
+
+    log.info(f"Closing {len(connections)} connections")
+    done, pending = await asyncio.wait(
+        [asyncio.ensure_future(conn._disconnect()) for conn in connections], timeout=timeout
+    )
+    for future in pending:
+        future.cancel()
+    if pending:
+        log.warning(f"{len(pending)} connections didn't close within {timeout}s")
+
+
 def _clean_connections():
-    # would be better to close them all at once with gather() or similar
-    for hostname, conn in _connections_cache.items():
-        if conn.connected:
-            log.info(f"Cleaning up connection for {hostname}")
-            conn.disconnect()
+    for loop in {*_open_connections, *_agents}:
+        # a closed loop is gone with its connections, while a loop still running in another thread
+        # can't be run from here; the loops of the threads that exited are run one last time.
+        if loop.is_closed() or loop.is_running():
+            continue
+
+        connections = [conn for conn in _open_connections.get(loop, ()) if conn.connected]
+        if connections:
+            loop.run_until_complete(_disconnect_all(connections, env.disconnect_timeout))
+        close_agents(loop)
 
 
 atexit.register(_clean_connections)
 
 
+class HostTimeout(Exception):
+    """A host didn't complete a phase of its work within the allotted time.
+
+    :param hostname: the name of the host that timed out.
+    :param phase: the phase that timed out: `connect`, `run` or `pending` (the work never
+     started because a deadline expired first).
+    :param timeout: the timeout that expired, in seconds.
+    """
+
+    def __init__(self, hostname: str, phase: str, timeout: Optional[float]):
+        super().__init__(hostname, phase, timeout)
+        self.hostname = hostname
+        self.phase = phase
+        self.timeout = timeout
+
+    def __str__(self):
+        return f"{self.hostname}: timed out during {self.phase} after {self.timeout}s"
+
+
+class HostUnreachable(Exception):
+    """A host failed to connect recently and is still considered unreachable.
+
+    :param hostname: the name of the unreachable host.
+    :param error: the error of the last failed connection.
+    """
+
+    def __init__(self, hostname: str, error: str):
+        super().__init__(hostname, error)
+        self.hostname = hostname
+        self.error = error
+
+    def __str__(self):
+        return f"{self.hostname}: host is unreachable (last error: {self.error})"
+
+
+class SudoPasswordError(Exception):
+    """sudo asked for a password that can't be given, e.g. through the broker, which can't prompt
+    for it, or because it was wrong."""
+
+
+def _ask_sudo_password(wrong: bool) -> str:
+    """Returns `env.sudo_password`, prompting for it when it's not set or it was `wrong`."""
+
+    if wrong:
+        get_renderer().message("Unsetting env.sudo_password")
+        env.sudo_password = None
+
+    if env.sudo_password is None:
+        get_renderer().flush()
+        env.sudo_password = getpass.getpass("Need password for sudo: ")
+    return env.sudo_password
+
+
 class Connection:
     """A SSH connection to a remote server.
 
@@ -47,8 +162,16 @@ class Connection:
     :param tunnel: the optional hostname of another server that will be used as tunnel.
     :param nickname: the hostname of the server as passed on the command line (could be different
      from the real hostname configured in `~/.ssh/config`).
+    :param connect_timeout: the optional number of seconds to wait for the connection to be
+     established (default: `env.connect_timeout`).
+    :param connection_attempts: the number of times to try to connect before giving up.
+    :param options: optional extra asyncssh connection options, like `encryption_algs` or
+     `compression_algs`.
     """
 
+    # wether the hostname must be resolved by us before connecting
+    _resolves_locally = True
+
     def __init__(
         self,
         hostname: str,
@@ -59,6 +182,9 @@ class Connection:
         agent_path: Optional[str] = None,
         tunnel: Optional[str] = None,
         nickname: Optional[str] = None,
+        connect_timeout: Optional[float] = None,
+        connection_attempts: int = 1,
+        options: Optional[Dict[str, Any]] = None,
     ):
         self.hostname = hostname
         self.username = username
@@ -71,50 +197,61 @@ class Connection:
             self.nickname = nickname
         else:
             self.nickname = self.hostname
-        self._connection: Optional[asyncssh.SSHClientConnection] = None
-        self._sftp_client: Optional[asyncssh.SFTPClient] = None
-
-    async def _read_from(self, stream, writer, maxlen=10, echo=True) -> str:
-        buf: Deque[str] = collections.deque(maxlen=maxlen)
-        trail = ""
+        self.connect_timeout = connect_timeout
+        self.connection_attempts = connection_attempts
+        self.options = options or {}
+        #: The number of seconds spent resolving the hostname by the last connection attempt.
+        self.resolve_time: Optional[float] = None
+        #: The number of seconds spent connecting and authenticating by the last connection attempt.
+        self.connect_time: Optional[float] = None
+        self._connection: Optional["asyncssh.SSHClientConnection"] = None
+        self._tunnel_connection: Optional[Connection] = None
+        self._sftp_client: Optional["asyncssh.SFTPClient"] = None
+
+    async def _read_from(
+        self, stream, writer, full_output=False, echo=True, stats=None, sudo_password=None
+    ) -> str:
+        buf = OutputBuffer(None if full_output else env.max_output_length)
+        decoder = LineDecoder()
+        renderer = get_renderer()
+        echo = echo and not env.quiet
+        last_line = None
 
         while True:
-            data = await stream.read(1024)
-            if data == "":
+            data = await stream.read(env.read_size)
+            if not data:
                 break
 
-            # everything gets stored in `buf` (within its limits)
-            buf.append(data)
+            if stats is not None:
+                stats["bytes"] += len(data)
 
-            # handle previously unprinted output, if any
-            if trail:
-                data = trail + data
-                trail = ""
+            # everything gets stored in `buf` (within its limits)
+            text = decoder.decode(data)
+            buf.append(text)
 
-            # split lines and keep any non-newline ended data
-            lines, rest = split_lines(data)
+            lines = decoder.split(text)
+            if lines:
+                last_line = lines[-1]
             if echo:
-                for line in lines:
-                    print(f"[{self.nickname}] {line}")
+                renderer.output(self.nickname, lines)
+
+            # if the current line ends with the sudo prompt, handle it
+            if decoder.partial_endswith(env.sudo_prompt):
+                renderer.message(f"[{self.nickname}] {decoder.take_partial()}")
 
-            # if the last part of `data` contains the sudo prompt, handle it
-            if rest.endswith(env.sudo_prompt):
-                print(f"[{self.nickname}] {rest}")
+                # the prompt must be visible before asking for the password
+                renderer.flush()
 
                 # we need to handle sudo erroring because the password was wrong
-                if lines[-1] == "Sorry, try again.":
-                    print("Unsetting env.sudo_password")
-                    env.sudo_password = None
+                wrong = last_line == "Sorry, try again."
+                password = f"{(sudo_password or _ask_sudo_password)(wrong)}\n"
+                writer.write(password.encode("utf-8") if isinstance(data, bytes) else password)
 
-                if env.sudo_password is None:
-                    env.sudo_password = getpass.getpass("Need password for sudo: ")
-                writer.write(f"{env.sudo_password}\n")
-            else:
-                if rest:
-                    trail += rest
+        lines = decoder.close()
+        if echo:
+            renderer.output(self.nickname, lines)
 
-        output = "".join(list(buf))
-        return output
+        return buf.getvalue()
 
     async def _run(
         self,
@@ -124,9 +261,25 @@ class Connection:
         pty=False,
         environ: Optional[Dict[str, str]] = None,
         echo=True,
+        timeout: Optional[float] = None,
+        compress: Optional[str] = None,
+        full_output=False,
+        sudo_password: Optional[Callable[[bool], str]] = None,
         **kwargs,
     ) -> CommandResult:
-        """Run a shell command on the remote host"""
+        """Run a shell command on the remote host
+
+        With `full_output` the whole output is kept, instead of its last `env.max_output_length`
+        characters. `sudo_password` is called to get the password when sudo asks for it, with
+        `True` if the previous one was wrong; by default it's `env.sudo_password`, prompted for
+        when needed.
+        """
+
+        if timeout is None:
+            timeout = env.command_timeout
+        if compress is None:
+            compress = env.compress
+        metrics.current_host.set(self.nickname)
 
         if self._connection is None:
             await self._connect()
@@ -145,31 +298,80 @@ class Connection:
         else:
             command = f"{env_command}{command}"
 
+        if compress:
+            if pty:
+                # a pty would merge stderr into the compressed stream and mangle it
+                log.debug(f"*{self.nickname}* compressing the output: not using a pty")
+                pty = False
+            command = compress_command(command, compress)
+
         log.debug(f"*{self.nickname}* final command: {command}")
 
-        args = {}
+        args: Dict[str, Any] = {
+            "compress": bool(compress),
+            "full_output": full_output,
+            "sudo_password": sudo_password,
+        }
         if pty:
             args.update({"term_type": env.term_type, "term_size": env.term_size})
 
-        async with self._connection.create_process(command, **args) as proc:  # type: ignore
-            stdout, stderr = await asyncio.gather(
-                self._read_from(proc.stdout, proc.stdin, echo=echo),
-                self._read_from(proc.stderr, proc.stdin, echo=echo),
+        started = asyncio.get_event_loop().time()
+        try:
+            stdout, stderr, exit_code = await asyncio.wait_for(
+                self._execute(command, echo, **args), timeout
             )
+        except asyncio.TimeoutError:
+            raise HostTimeout(self.nickname, "run", timeout) from None
 
         return CommandResult(
             command=original_command,
             actual_command=command,
-            exit_code=proc.exit_status,
+            exit_code=exit_code,
             stdout=stdout,
             # if we use a pty this will be empty
             stderr=stderr,
             hostname=self.nickname,
             sudo=sudo,
+            duration=asyncio.get_event_loop().time() - started,
         )
 
+    async def _execute(
+        self,
+        command: str,
+        echo=True,
+        compress=False,
+        full_output=False,
+        sudo_password=None,
+        **kwargs,
+    ):
+        with metrics.span("channel_open", self.nickname):
+            # read bytes, decoded by `_read_from`
+            proc = await self._connection.create_process(  # type: ignore
+                command, encoding=None, **kwargs
+            )
+
+        # when cancelled (e.g. by a timeout) the context manager closes the channel for us.
+        async with proc:
+            with metrics.span("exec", self.nickname, bytes=0) as stats:
+                stdout_stream = DecompressingReader(proc.stdout) if compress else proc.stdout
+                stdout, stderr = await asyncio.gather(
+                    self._read_from(
+                        stdout_stream, proc.stdin, full_output, echo, stats, sudo_password
+                    ),
+                    self._read_from(
+                        proc.stderr, proc.stdin, full_output, echo, stats, sudo_password
+                    ),
+                )
+                stats["exit_code"] = proc.exit_status
+                if compress:
+                    stats["wire_bytes"] = stdout_stream.wire_bytes
+
+        return stdout, stderr, proc.exit_status
+
     # use the event loop
-    def run(self, command, pty=True, cd=None, environ=None, echo=True) -> CommandResult:
+    def run(
+        self, command, pty=True, cd=None, environ=None, echo=True, timeout=None, compress=None
+    ) -> CommandResult:
         """Execute a command on the remote server.
 
         :param command: the command line string to execute.
@@ -178,14 +380,28 @@ class Connection:
         :param environ: an optional dictionary containing environment variables to set when
          executing the command.
         :param echo: set to `False` to hide the output of the command.
+        :param timeout: the optional number of seconds to wait for the command to complete
+         (default: `env.command_timeout`).
+        :param compress: compress the output on the remote host with `"zstd"` or `"gzip"` and
+         decompress it here, to save bandwidth on large outputs (default: `env.compress`); the
+         remote host falls back to gzip, or to no compression, when the tool is not installed, and
+         zstd requires the `zstandard` package. The command is executed without a pty.
         """
 
-        print(f"*{self.nickname}* Running: {command}")
-        kwargs = {"pty": pty, "cd": cd, "environ": environ}
+        get_renderer().message(f"*{self.nickname}* Running: {command}")
+        kwargs = {
+            "pty": pty,
+            "cd": cd,
+            "environ": environ,
+            "timeout": timeout,
+            "compress": compress,
+        }
         return run_in_loop(self._run(command, **kwargs))
 
     # use the event loop
-    def sudo(self, command, pty=True, cd=None, environ=None, echo=True) -> CommandResult:
+    def sudo(
+        self, command, pty=True, cd=None, environ=None, echo=True, timeout=None, compress=None
+    ) -> CommandResult:
         """Execute a command with sudo on the remote server.
 
         :param command: the command line string to execute.
@@ -194,36 +410,137 @@ class Connection:
         :param environ: an optional dictionary containing environment variables to set when
          executing the command.
         :param echo: set to `False` to hide the output of the command.
+        :param timeout: the optional number of seconds to wait for the command to complete
+         (default: `env.command_timeout`).
+        :param compress: compress the output of the command, see :meth:`run`.
         """
 
-        print(f"*{self.nickname}* - Sudo: {command}")
-        kwargs = {"pty": pty, "cd": cd, "sudo": True, "environ": environ}
+        get_renderer().message(f"*{self.nickname}* - Sudo: {command}")
+        kwargs = {
+            "pty": pty,
+            "cd": cd,
+            "sudo": True,
+            "environ": environ,
+            "timeout": timeout,
+            "compress": compress,
+        }
         return run_in_loop(self._run(command, **kwargs))
 
     async def _connect(self):
         log.info(f"Connecting to {self.hostname}:{self.port}")
 
-        args = {"username": self.username}
+        args = {"username": self.username, **self.options}
 
+        # known hosts and keys are parsed once and shared by all the connections.
         if env.use_known_hosts is False:
             args["known_hosts"] = None
+        else:
+            known_hosts = load_known_hosts()
+            if known_hosts is not None:
+                args["known_hosts"] = known_hosts
 
         if self.tunnel:
             log.info(f"Connecting to tunnel {self.tunnel}")
             tunnel_conn = _get_connection(self.tunnel, use_cache=False)
             await tunnel_conn._connect()
-            args["tunnel"] = tunnel_conn
+            self._tunnel_connection = tunnel_conn
+            args["tunnel"] = tunnel_conn._connection
 
         # we either use the private key OR the agent; loading the private key might fail while the
         # agent could still be working.
         if self.agent_path:
-            args["agent_path"] = self.agent_path
+            agent_keys = await get_agent_keys(self.agent_path)
+            if agent_keys:
+                args["client_keys"] = agent_keys
+                args["agent_path"] = None
+            else:
+                args["agent_path"] = self.agent_path
+        elif isinstance(self.private_key, str):
+            args["client_keys"] = load_private_key(self.private_key)
         elif self.private_key:
             args["client_keys"] = [self.private_key]
 
+        timeout = self.connect_timeout
+        if timeout is None:
+            timeout = env.connect_timeout
+
+        # hosts behind a tunnel are resolved by the tunnel itself
+        loop = asyncio.get_event_loop()
+        addresses = [self.hostname]
+        uses_network = get_transport().uses_network
+        resolver = None
+        if uses_network and self._resolves_locally and not self.tunnel:
+            resolver = get_resolver()
+        if resolver is not None:
+            started = loop.time()
+            with metrics.span("resolve", self.nickname):
+                addresses = await resolver.resolve(self.hostname, self.port)
+            self.resolve_time = loop.time() - started
+            if addresses != [self.hostname]:
+                # verify the host key against the hostname and not against its address
+                args["host_key_alias"] = self.hostname
+
+        # hosts behind a tunnel can't be probed directly and are not cached
+        dead_hosts = get_dead_hosts() if uses_network and not self.tunnel else None
+        if dead_hosts is not None:
+            error = dead_hosts.failure(self.hostname, self.port)
+            if error is not None:
+                probe_timeout = env.dead_host_probe_timeout
+                if probe_timeout is None or not await probe(addresses, self.port, probe_timeout):
+                    raise HostUnreachable(self.nickname, error)
+
         # this may throw several exceptions:
         # asyncssh.misc.HostKeyNotVerifiable: Host key is not trusted
-        self._connection = await asyncssh.connect(self.hostname, self.port, **args)
+        started = loop.time()
+        for attempt in range(1, max(self.connection_attempts, 1) + 1):
+            try:
+                with metrics.span("connect", self.nickname, attempt=attempt):
+                    self._connection = await asyncio.wait_for(
+                        self._open_any_connection(addresses, args), timeout
+                    )
+                break
+            except (asyncio.TimeoutError, OSError) as ex:
+                # only network errors are retried and mark a host as dead; e.g. authentication
+                # errors don't.
+                if attempt < self.connection_attempts:
+                    log.info(f"Connection to {self.nickname} failed ({attempt}): {ex!r}")
+                    continue
+                if dead_hosts is not None:
+                    error = str(ex) or "connection timed out"
+                    dead_hosts.record_failure(self.hostname, self.port, error)
+                if isinstance(ex, asyncio.TimeoutError):
+                    raise HostTimeout(self.nickname, "connect", timeout) from None
+                raise
+
+        self.connect_time = loop.time() - started
+        _open_connections.setdefault(loop, weakref.WeakSet()).add(self)
+        if dead_hosts is not None:
+            dead_hosts.record_success(self.hostname, self.port)
+
+    async def _open_any_connection(self, addresses: List[str], args: Dict[str, Any]):
+        # try the addresses in order, like asyncio does with the results of getaddrinfo()
+        for n, address in enumerate(addresses, 1):
+            try:
+                return await self._open_connection(address, args)
+            except OSError as ex:
+                if n == len(addresses):
+                    raise
+                log.info(f"Connection to {self.nickname} at {address} failed: {ex!r}")
+
+    async def _open_connection(self, address: str, args: Dict[str, Any]):
+        return await get_transport().connect(address, self.port, self.nickname, args)
+
+    async def _disconnect(self):
+        connection, self._connection = self._connection, None
+        tunnel, self._tunnel_connection = self._tunnel_connection, None
+        self._sftp_client = None
+
+        if connection is not None:
+            connection.close()
+            await connection.wait_closed()
+            log.debug(f"Disconnected from {self.nickname}")
+        if tunnel is not None:
+            await tunnel._disconnect()
 
     # use the event loop
     def disconnect(self):
@@ -231,82 +548,160 @@ class Connection:
 
         # Maybe here we should also delete ourself from the connection cache, but we don't know our
         # own "nickname"!
-        if self._connection is not None:
-            self._connection.close()
-            run_in_loop(self._connection.wait_closed())
-        self._connection = None
-        print("disconnected")
+        run_in_loop(self._disconnect())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.disconnect()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._disconnect()
 
     @property
     def connected(self) -> bool:
         return self._connection is not None
 
-    async def get_sftp_client(self) -> asyncssh.SFTPClient:
+    async def get_sftp_client(self) -> "asyncssh.SFTPClient":
         if self._connection is None:
             await self._connect()
 
         if self._sftp_client is None:
-            self._sftp_client = await self._connection.start_sftp_client()  # type: ignore
+            with metrics.span("sftp_open", self.nickname):
+                self._sftp_client = await self._connection.start_sftp_client()  # type: ignore
         return self._sftp_client
 
-    async def _get(self, remotefile, localfile):
-        sftp_client = await self.get_sftp_client()
+    async def _retry_transfer(self, transfer, *args):
+        """Run `transfer`, reconnecting and running it again when the connection drops."""
 
-        try:
-            size = await sftp_client.getsize(remotefile)
+        import asyncssh
 
-            # from https://asyncssh.readthedocs.io/en/latest/api.html#asyncssh.SFTPClient.get
-            block_size = 16384
+        retryable = (
+            ConnectionError,
+            asyncio.TimeoutError,
+            asyncssh.DisconnectError,
+            asyncssh.ChannelOpenError,
+            asyncssh.SFTPConnectionLost,
+        )
+        for attempt in range(1, max(env.transfer_attempts, 1) + 1):
+            try:
+                return await transfer(*args)
+            except retryable as ex:
+                if attempt >= env.transfer_attempts:
+                    raise
+                log.warning(f"Transfer on {self.nickname} interrupted ({attempt}): {ex!r}")
+                await self._disconnect()
+                await asyncio.sleep(attempt)
+
+    async def _get(self, remotefile, localfile, resume=False):
+        if resume:
+            return await self._retry_transfer(self._get_resumable, remotefile, localfile)
 
-            i = size // block_size + 1
-            if i < 0:
-                i = 1
-            bar = tqdm.tqdm(total=i, desc=os.path.basename(remotefile))
+        sftp_client = await self.get_sftp_client()
 
-            def _update_bar(source, dest, cur, tot):
-                bar.update(1)
+        size = await sftp_client.getsize(remotefile)
+        progress = get_renderer().progress(os.path.basename(remotefile), size, unit="B")
 
-            await sftp_client.get(
-                remotefile, localfile, progress_handler=_update_bar, block_size=block_size
-            )
-            bar.close()
+        def _update_progress(source, dest, cur, tot):
+            progress.set(cur)
 
-        except (OSError, asyncssh.SFTPError):
-            raise
+        try:
+            with metrics.span("get", self.nickname, bytes=size):
+                await sftp_client.get(
+                    remotefile,
+                    localfile,
+                    progress_handler=_update_progress,
+                    block_size=env.sftp_block_size,
+                )
+        finally:
+            progress.close()
+
+    async def _get_resumable(self, remotefile, localfile):
+        sftp_client = await self.get_sftp_client()
+        size = await sftp_client.getsize(remotefile)
+
+        # the data is downloaded to a partial file that is renamed when complete.
+        partial = f"{localfile}.part"
+        offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+        if offset > size:
+            offset = 0
+
+        fd = await sftp_client.open(remotefile, "rb")
+        try:
+            # make sure the remote file didn't change since the partial file was written
+            check_size = min(offset, env.resume_check_size)
+            if check_size:
+                remote_tail = await fd.read(check_size, offset - check_size)
+                with open(partial, "rb") as local:
+                    local.seek(offset - check_size)
+                    local_tail = local.read(check_size)
+                if remote_tail != local_tail:
+                    log.warning(f"{partial} doesn't match {remotefile}, restarting the download")
+                    offset = 0
+
+            name = os.path.basename(remotefile)
+            progress = get_renderer().progress(name, size, initial=offset, unit="B")
+            try:
+                with metrics.span("get", self.nickname, bytes=0, offset=offset) as stats:
+                    with open(partial, "r+b" if offset else "wb") as local:
+                        local.seek(offset)
+                        local.truncate()
+                        while offset < size:
+                            data = await fd.read(env.sftp_block_size * RESUME_CHUNK_BLOCKS, offset)
+                            if not data:
+                                break
+                            local.write(data)
+                            offset += len(data)
+                            stats["bytes"] += len(data)
+                            progress.update(len(data))
+            finally:
+                progress.close()
+        finally:
+            await fd.close()
+
+        os.replace(partial, localfile)
 
     # use the event loop
-    def get(self, remotefile, localfile):
+    def get(self, remotefile, localfile, resume=False):
         """Download a file from the remote server.
 
         :param remotefile: the path to the remote file to download.
         :param localfile: the local path where to write the downloaded file.
+        :param resume: set to `True` to download to `localfile.part` first, resuming from its
+         contents if it exists; when the connection drops the download is resumed up to
+         `env.transfer_attempts` times, and the partial file is renamed to `localfile` when
+         complete.
         """
 
-        run_in_loop(self._get(remotefile, localfile))
+        run_in_loop(self._get(remotefile, localfile, resume))
 
     async def _read(self, remotefile) -> bytes:
         sftp_client = await self.get_sftp_client()
 
-        try:
-            size = await sftp_client.getsize(remotefile)
-            bar = tqdm.tqdm(total=size, desc=os.path.basename(remotefile))
+        size = await sftp_client.getsize(remotefile)
+        progress = get_renderer().progress(os.path.basename(remotefile), size, unit="B")
 
-            fd = await sftp_client.open(remotefile, "rb")
-            data = []
-            while True:
-                # 16384 is the default block size
-                buf = await fd.read(16384)
-                if buf == b"":
-                    break
-                data.append(buf)
-                bar.update(len(buf))
-
-            fd.close()
-            bar.close()
-
-            return b"".join(data)
-        except (OSError, asyncssh.SFTPError):
-            raise
+        try:
+            with metrics.span("read", self.nickname, bytes=0) as stats:
+                fd = await sftp_client.open(remotefile, "rb")
+                data = []
+                while True:
+                    buf = await fd.read(env.sftp_block_size)
+                    if buf == b"":
+                        break
+                    data.append(buf)
+                    stats["bytes"] += len(buf)
+                    progress.update(len(buf))
+
+                await fd.close()
+        finally:
+            progress.close()
+
+        return b"".join(data)
 
     # use the event loop
     def read(self, remotefile) -> bytes:
@@ -319,40 +714,174 @@ class Connection:
         """
         return run_in_loop(self._read(remotefile))
 
-    async def _put(self, localfile, remotefile):
+    async def _read_iter(
+        self, remotefile, chunk_size=None, offset=0, lines=False, follow=False
+    ) -> AsyncIterator[Union[bytes, str]]:
         sftp_client = await self.get_sftp_client()
+        chunk_size = chunk_size or env.read_size
+        decoder = LineDecoder() if lines else None
 
+        size = await sftp_client.getsize(remotefile)
+        if offset < 0:
+            offset = max(0, size + offset)
+
+        fd = await sftp_client.open(remotefile, "rb")
         try:
-            size = os.path.getsize(localfile)
+            # when starting in the middle of a line, skip it
+            skip_line = lines and offset > 0 and await fd.read(1, offset - 1) != b"\n"
+
+            while True:
+                data = await fd.read(chunk_size, offset)
+                if data:
+                    offset += len(data)
+                    if decoder is None:
+                        yield data
+                        continue
+                    for line in decoder.feed(data):
+                        if skip_line:
+                            skip_line = False
+                            continue
+                        yield line
+                    continue
+
+                if not follow:
+                    break
 
-            # from https://asyncssh.readthedocs.io/en/latest/api.html#asyncssh.SFTPClient.get
-            block_size = 16384
+                # wait for the file to grow; if it shrinks it was truncated or rotated.
+                while size <= offset:
+                    await asyncio.sleep(env.follow_interval)
+                    size = await sftp_client.getsize(remotefile)
+                    if size < offset:
+                        log.info(f"{remotefile} on {self.nickname} was truncated, reading it again")
+                        await fd.close()
+                        fd = await sftp_client.open(remotefile, "rb")
+                        offset = 0
+                        # the partial line of the old file doesn't continue in the new one
+                        if decoder is not None:
+                            decoder = LineDecoder()
+                            skip_line = False
+
+            if decoder is not None:
+                last_lines = decoder.close()
+                # the skipped partial line can also be the last one, without a trailing newline
+                if skip_line:
+                    last_lines = last_lines[1:]
+                for line in last_lines:
+                    yield line
+        finally:
+            await fd.close()
 
-            i = size // block_size + 1
-            if i < 0:
-                i = 1
-            bar = tqdm.tqdm(total=i, desc=os.path.basename(localfile))
+    # use the event loop
+    def read_iter(
+        self, remotefile, chunk_size=None, offset=0, lines=False, follow=False
+    ) -> Iterator[Union[bytes, str]]:
+        """Read a remote file lazily, one chunk or line at a time.
 
-            def _update_bar(source, dest, cur, tot):
-                bar.update(1)
+        :param remotefile: the path of the remote file to read.
+        :param chunk_size: the size of the chunks to read (default: `env.read_size`).
+        :param offset: the offset where to start reading; a negative offset is relative to the end
+         of the file, e.g. `-4096` reads its last 4KiB.
+        :param lines: set to `True` to get the lines of the file (decoded as UTF-8) instead of
+         chunks of bytes; when starting from an offset, the first partial line is skipped.
+        :param follow: set to `True` to keep reading the data appended to the file, like
+         `tail -f`; the file is checked every `env.follow_interval` seconds and read again from
+         the beginning when it gets truncated.
+
+        Only a chunk of the file is held in memory at any time, so it's also suitable for very
+        large files.
+        """
 
-            await sftp_client.put(
-                localfile, remotefile, progress_handler=_update_bar, block_size=block_size
-            )
-            bar.close()
+        return iter_in_loop(self._read_iter(remotefile, chunk_size, offset, lines, follow))
+
+    async def _put(self, localfile, remotefile, resume=False):
+        if resume:
+            return await self._retry_transfer(self._put_resumable, localfile, remotefile)
+
+        sftp_client = await self.get_sftp_client()
+
+        size = os.path.getsize(localfile)
+        progress = get_renderer().progress(os.path.basename(localfile), size, unit="B")
 
-        except (OSError, asyncssh.SFTPError):
-            raise
+        def _update_progress(source, dest, cur, tot):
+            progress.set(cur)
+
+        try:
+            with metrics.span("put", self.nickname, bytes=size):
+                await sftp_client.put(
+                    localfile,
+                    remotefile,
+                    progress_handler=_update_progress,
+                    block_size=env.sftp_block_size,
+                )
+        finally:
+            progress.close()
+
+    async def _put_resumable(self, localfile, remotefile):
+        import asyncssh
+
+        sftp_client = await self.get_sftp_client()
+        size = os.path.getsize(localfile)
+
+        # the data is uploaded to a partial file that is renamed when complete.
+        partial = f"{remotefile}.part"
+        offset = 0
+        if await sftp_client.exists(partial):
+            offset = await sftp_client.getsize(partial)
+        if offset > size:
+            offset = 0
+
+        with open(localfile, "rb") as local:
+            fd = await sftp_client.open(partial, "r+b" if offset else "wb")
+            try:
+                # make sure the local file didn't change since the partial file was written
+                check_size = min(offset, env.resume_check_size)
+                if check_size:
+                    remote_tail = await fd.read(check_size, offset - check_size)
+                    local.seek(offset - check_size)
+                    if remote_tail != local.read(check_size):
+                        log.warning(f"{partial} doesn't match {localfile}, restarting the upload")
+                        await fd.close()
+                        fd = await sftp_client.open(partial, "wb")
+                        offset = 0
+
+                name = os.path.basename(localfile)
+                progress = get_renderer().progress(name, size, initial=offset, unit="B")
+                try:
+                    with metrics.span("put", self.nickname, bytes=0, offset=offset) as stats:
+                        local.seek(offset)
+                        while offset < size:
+                            data = local.read(env.sftp_block_size * RESUME_CHUNK_BLOCKS)
+                            if not data:
+                                break
+                            await fd.write(data, offset)
+                            offset += len(data)
+                            stats["bytes"] += len(data)
+                            progress.update(len(data))
+                finally:
+                    progress.close()
+            finally:
+                await fd.close()
+
+        try:
+            await sftp_client.posix_rename(partial, remotefile)
+        except asyncssh.SFTPOpUnsupported:
+            if await sftp_client.exists(remotefile):
+                await sftp_client.remove(remotefile)
+            await sftp_client.rename(partial, remotefile)
 
     # use the event loop
-    def put(self, localfile, remotefile):
+    def put(self, localfile, remotefile, resume=False):
         """Upload a local file to a remote server.
 
         :param localfile: the path of the local file to upload.
         :param remotefile: the path where to write the file on the remote server.
+        :param resume: set to `True` to upload to `remotefile.part` first, resuming from its
+         contents if it exists; when the connection drops the upload is resumed up to
+         `env.transfer_attempts` times, and the partial file is renamed to `remotefile` when
+         complete.
         """
 
-        run_in_loop(self._put(localfile, remotefile))
+        run_in_loop(self._put(localfile, remotefile, resume))
 
     async def _file_exists(self, remotefile) -> bool:
         sftp_client = await self.get_sftp_client()
@@ -367,6 +896,52 @@ class Connection:
 
         return run_in_loop(self._file_exists(remotefile))
 
+    async def _facts(self, names=None, refresh=False) -> Dict[str, Any]:
+        names = list(FACTS) if names is None else list(names)
+        cache = get_facts_cache()
+        facts = {}
+        if cache is not None and not refresh:
+            facts = cache.get(self.nickname, names)
+
+        missing = [name for name in names if name not in facts]
+        if missing:
+            command, boundary = gather_command(missing)
+            # the output of all the facts is needed, not only its end
+            result = await self._run(command, echo=False, full_output=True)
+            gathered = parse_output(result.stdout, boundary)
+            # facts missing from the output (e.g. the command was interrupted) are not cached
+            gathered = {name: value for name, value in gathered.items() if name in missing}
+            if cache is not None:
+                # failed facts (None) are gathered again next time, instead of for the whole TTL
+                cache.update(
+                    self.nickname,
+                    {name: value for name, value in gathered.items() if value is not None},
+                )
+            facts.update(gathered)
+
+        return {name: facts.get(name) for name in names}
+
+    # use the event loop
+    def facts(self, names=None, refresh=False) -> Dict[str, Any]:
+        """Returns facts about the remote server, like its kernel or number of CPUs.
+
+        :param names: the names of the facts to return (default: all the facts registered in
+         :data:`fox.facts.FACTS`).
+        :param refresh: set to `True` to gather the facts again even if they are cached.
+
+        All the facts that are not cached are gathered with a single remote command; a fact is
+        `None` when its command failed on the server.
+        """
+
+        return run_in_loop(self._facts(names, refresh))
+
+    def invalidate_facts(self, names=None):
+        """Forget the cached facts in `names` (default: all of them) about the remote server."""
+
+        cache = get_facts_cache()
+        if cache is not None:
+            cache.invalidate(self.nickname, names)
+
 
 def _get_connection(name=None, use_cache=True) -> Connection:
     """Get a connection for `name`.
@@ -389,6 +964,17 @@ def _get_connection(name=None, use_cache=True) -> Connection:
             return conn
         del _connections_cache[name]
 
+    if env.broker_path is not None and os.path.exists(env.broker_path):
+        from .broker import BrokerConnection, is_alive
+
+        # a socket left by a dead broker must not break the connections: connect directly
+        if is_alive(env.broker_path):
+            c: Connection = BrokerConnection(name, env.broker_path)
+            if use_cache:
+                _connections_cache[name] = c
+            return c
+        log.warning(f"The broker on {env.broker_path} doesn't answer, connecting directly")
+
     ssh_options = options_to_connect(name)
 
     args = {}
@@ -396,9 +982,15 @@ def _get_connection(name=None, use_cache=True) -> Connection:
         args["private_key"] = ssh_options["identityfile"]
     if "identityagent" in ssh_options:
         args["agent_path"] = ssh_options["identityagent"]
+    if "connecttimeout" in ssh_options:
+        args["connect_timeout"] = float(ssh_options["connecttimeout"])
+    if "connectionattempts" in ssh_options:
+        args["connection_attempts"] = int(ssh_options["connectionattempts"])
     # TODO:
     # identitiesonly yes
 
+    args["options"] = transport_options(ssh_options)
+
     # NOTE: we only cache connections created here, and maybe the tunnels.
     # maybe by default we should not re-use the tunnels, as the default behavior of SSH
     c = Connection(
@@ -0,0 +1,85 @@
+import time
+import atexit
+import asyncio
+from typing import Any, Dict, List, Optional, Tuple
+from .conf import env
+from .cache import PersistentCache
+
+
+class DeadHostCache(PersistentCache):
+    """A cache of the hosts that recently failed to connect.
+
+    :param ttl: the number of seconds a failure is remembered for.
+    :param path: the optional path of a JSON file used to persist the cache across runs.
+    """
+
+    name = "dead hosts cache"
+
+    # "hostname:port" -> (timestamp of the failure, error message)
+    _entries: Dict[str, Tuple[float, str]]
+
+    @staticmethod
+    def _key(hostname: str, port: int) -> str:
+        return f"{hostname}:{port}"
+
+    def failure(self, hostname: str, port: int) -> Optional[str]:
+        """Returns the error of the last failed connection to a host, if it's not expired yet."""
+
+        key = self._key(hostname, port)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        timestamp, error = entry
+        if time.time() - timestamp > self.ttl:
+            del self._entries[key]
+            self._dirty = True
+            return None
+        return error
+
+    def record_failure(self, hostname: str, port: int, error: str):
+        self._entries[self._key(hostname, port)] = (time.time(), error)
+        self._dirty = True
+
+    def record_success(self, hostname: str, port: int):
+        if self._entries.pop(self._key(hostname, port), None) is not None:
+            self._dirty = True
+
+    def _restore(self, entries: Dict[str, Any], now: float):
+        for key, (timestamp, error) in entries.items():
+            if now - timestamp <= self.ttl:
+                self._entries[key] = (timestamp, error)
+
+
+_dead_hosts: Optional[DeadHostCache] = None
+
+
+def get_dead_hosts() -> Optional[DeadHostCache]:
+    """Returns the global dead hosts cache, or `None` when it's disabled in `env`."""
+
+    global _dead_hosts
+
+    if not env.dead_host_ttl:
+        return None
+
+    if _dead_hosts is None:
+        _dead_hosts = DeadHostCache(env.dead_host_ttl, env.dead_host_cache_path)
+        atexit.register(_dead_hosts.save)
+    return _dead_hosts
+
+
+async def probe(addresses: List[str], port: int, timeout: float) -> bool:
+    """Check with plain TCP connections if something is listening on any of `addresses`:`port`.
+
+    The addresses are tried in order, each for up to `timeout` seconds.
+    """
+
+    for address in addresses:
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(address, port), timeout)
+        except (OSError, asyncio.TimeoutError):
+            continue
+
+        writer.close()
+        return True
+    return False
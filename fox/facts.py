@@ -0,0 +1,190 @@
+"""Facts about the remote hosts, like their kernel, OS release or number of CPUs.
+
+The facts are gathered with a single remote command, whatever their number, and are cached per
+host for `env.facts_ttl` seconds, optionally on disk in `env.facts_cache_path` so that the next
+runs can skip gathering them again. Register new facts with :func:`register_fact`.
+"""
+
+import os
+import time
+import shlex
+import atexit
+import logging
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+from .conf import env
+from .cache import PersistentCache
+
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class Fact:
+
+    #: The shell command printing the fact.
+    command: str
+
+    #: The function that parses the output of the command (stripped of the surrounding
+    #: whitespace); its result must be serializable to JSON.
+    parser: Optional[Callable[[str], Any]] = None
+
+    def parse(self, output: str) -> Any:
+        if self.parser is None:
+            return output
+        return self.parser(output)
+
+
+def _parse_os_release(output: str) -> Dict[str, str]:
+    result = {}
+    for line in output.splitlines():
+        key, sep, value = line.partition("=")
+        if sep and not key.startswith("#"):
+            result[key.strip()] = value.strip().strip("\"'")
+    return result
+
+
+def _parse_meminfo(output: str) -> int:
+    # "MemTotal:       16318412 kB"
+    return int(output.split()[1])
+
+
+def _parse_packages(output: str) -> Dict[str, str]:
+    result = {}
+    for line in output.splitlines():
+        name, _, version = line.partition(" ")
+        result[name] = version
+    return result
+
+
+#: The known facts, by name.
+FACTS: Dict[str, Fact] = {
+    "uname": Fact("uname -a"),
+    "kernel": Fact("uname -r"),
+    "arch": Fact("uname -m"),
+    "hostname": Fact("hostname"),
+    "os_release": Fact("cat /etc/os-release", _parse_os_release),
+    "nproc": Fact("nproc", int),
+    "memory_kb": Fact("grep MemTotal /proc/meminfo", _parse_meminfo),
+    "packages": Fact(
+        "dpkg-query -W -f '${Package} ${Version}\\n' || "
+        "rpm -qa --qf '%{NAME} %{VERSION}-%{RELEASE}\\n'",
+        _parse_packages,
+    ),
+}
+
+
+def register_fact(name: str, command: str, parser: Optional[Callable[[str], Any]] = None):
+    """Register (or replace) the fact `name`, printed by the shell `command`.
+
+    :param name: the name of the fact.
+    :param command: the shell command that prints the fact; its stderr is discarded and the fact is
+     `None`, and not cached, when it fails.
+    :param parser: an optional function that converts the output of the command, e.g. `int`; the
+     fact is `None` when it raises an exception.
+    """
+
+    FACTS[name] = Fact(command, parser)
+
+
+def gather_command(names: Iterable[str]) -> Tuple[str, str]:
+    """Returns the command that prints all the facts in `names` and the boundary between them."""
+
+    boundary = f"__fox_facts_{os.urandom(8).hex()}__"
+    script = []
+    for name in names:
+        script.append(
+            f"printf '%s\\n' '{boundary}:{name}'; {{ {FACTS[name].command}; }} 2>/dev/null; "
+            f"printf '\\n%s=%s\\n' '{boundary}' $?"
+        )
+    return "sh -c " + shlex.quote("\n".join(script)), boundary
+
+
+def parse_output(output: str, boundary: str) -> Dict[str, Any]:
+    """Parse the output of the command returned by :func:`gather_command`."""
+
+    facts = {}
+    name = None
+    lines: List[str] = []
+    for line in output.splitlines():
+        if line.startswith(f"{boundary}:"):
+            name = line[len(boundary) + 1 :]  # noqa: E203
+            lines = []
+        elif line.startswith(f"{boundary}=") and name is not None:
+            value = None
+            if line[len(boundary) + 1 :] == "0":  # noqa: E203
+                try:
+                    value = FACTS[name].parse("\n".join(lines).strip())
+                except Exception as ex:
+                    # a broken parser (e.g. a registered one) must not fail the other facts
+                    log.debug(f"Can't parse the fact {name}: {ex!r}")
+            facts[name] = value
+            name = None
+        elif name is not None:
+            lines.append(line)
+    return facts
+
+
+class FactsCache(PersistentCache):
+    """A cache of the facts gathered from each host.
+
+    :param ttl: the number of seconds a fact is cached for.
+    :param path: the optional path of a JSON file used to persist the cache across runs.
+    """
+
+    name = "facts cache"
+
+    # host -> fact name -> (timestamp, value)
+    _entries: Dict[str, Dict[str, Tuple[float, Any]]]
+
+    def get(self, host: str, names: Iterable[str]) -> Dict[str, Any]:
+        """Returns the facts in `names` that are cached for `host` and not expired yet."""
+
+        entries = self._entries.get(host, {})
+        now = time.time()
+        result = {}
+        for name in names:
+            entry = entries.get(name)
+            if entry is not None and now - entry[0] <= self.ttl:
+                result[name] = entry[1]
+        return result
+
+    def update(self, host: str, facts: Dict[str, Any]):
+        now = time.time()
+        entries = self._entries.setdefault(host, {})
+        for name, value in facts.items():
+            entries[name] = (now, value)
+        self._dirty = True
+
+    def invalidate(self, host: str, names: Optional[Iterable[str]] = None):
+        """Forget the facts in `names` (default: all of them) about `host`."""
+
+        if names is None:
+            removed = self._entries.pop(host, None) is not None
+        else:
+            entries = self._entries.get(host, {})
+            removed = any([entries.pop(name, None) is not None for name in names])
+        self._dirty = self._dirty or removed
+
+    def _restore(self, entries: Dict[str, Any], now: float):
+        for host, facts in entries.items():
+            for name, (timestamp, value) in facts.items():
+                if now - timestamp <= self.ttl:
+                    self._entries.setdefault(host, {})[name] = (timestamp, value)
+
+
+_facts_cache: Optional[FactsCache] = None
+
+
+def get_facts_cache() -> Optional[FactsCache]:
+    """Returns the global facts cache, or `None` when it's disabled in `env`."""
+
+    global _facts_cache
+
+    if not env.facts_ttl:
+        return None
+
+    if _facts_cache is None:
+        _facts_cache = FactsCache(env.facts_ttl, env.facts_cache_path)
+        atexit.register(_facts_cache.save)
+    return _facts_cache
@@ -0,0 +1,118 @@
+import os
+import asyncio
+import getpass
+import logging
+import weakref
+from typing import Any, Dict, List, Optional, Tuple
+from .conf import env
+from .cache import file_signature
+
+
+log = logging.getLogger(__name__)
+
+KNOWN_HOSTS_PATH = os.path.expanduser("~/.ssh/known_hosts")
+
+# path -> (file signature, parsed object); shared by all the Connections of the process and
+# reloaded when the file changes.
+_private_keys: Dict[str, Tuple[List[int], List[Any]]] = {}
+_known_hosts: Dict[str, Tuple[List[int], Any]] = {}
+
+# agent clients are bound to the event loop they were created in; each one is stored with its keys
+# and the time they were listed, or `None` when they must be listed again.
+_agents: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, List[Any]]]"
+_agents = weakref.WeakKeyDictionary()
+
+
+def load_private_key(path: str) -> List[Any]:
+    """Load the key pair (and its certificate, if any) from the private key file `path`.
+
+    If the key is encrypted the passphrase is asked only once per process.
+    """
+
+    signature = file_signature(path)
+    cached = _private_keys.get(path)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+
+    import asyncssh
+
+    log.debug(f"Loading private key {path}")
+    try:
+        keypairs = asyncssh.load_keypairs(path)
+    except asyncssh.KeyImportError:
+        passphrase = getpass.getpass(f"Passphrase for {path}: ")
+        keypairs = asyncssh.load_keypairs(path, passphrase)
+
+    _private_keys[path] = (signature, keypairs)
+    return keypairs
+
+
+def load_known_hosts(path: str = KNOWN_HOSTS_PATH) -> Optional[Any]:
+    """Load a OpenSSH known_hosts file, or return `None` if it doesn't exist."""
+
+    try:
+        signature = file_signature(path)
+    except FileNotFoundError:
+        return None
+
+    cached = _known_hosts.get(path)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+
+    import asyncssh
+
+    log.debug(f"Loading known hosts {path}")
+    known_hosts = asyncssh.read_known_hosts(path)
+    _known_hosts[path] = (signature, known_hosts)
+    return known_hosts
+
+
+async def get_agent_keys(path: str) -> List[Any]:
+    """Returns the keys of the OpenSSH agent listening on `path`.
+
+    A single agent connection per event loop is shared by all the SSH connections using it; the
+    list of its keys is cached for `env.agent_keys_ttl` seconds, or until
+    :func:`invalidate_agent_keys` is called.
+    """
+
+    loop = asyncio.get_event_loop()
+    agents = _agents.setdefault(loop, {})
+    entry = agents.get(path)
+    if entry is not None:
+        agent, keys, listed_at = entry
+        if listed_at is not None and (
+            not env.agent_keys_ttl or loop.time() - listed_at <= env.agent_keys_ttl
+        ):
+            return keys
+    else:
+        import asyncssh
+
+        log.debug(f"Connecting to agent {path}")
+        agent = asyncssh.SSHAgentClient(path)
+
+    try:
+        keys = await agent.get_keys()
+    except OSError as ex:
+        log.warning(f"Can't get the keys from agent {path}: {ex}")
+        keys = []
+    agents[path] = [agent, keys, loop.time()]
+    return keys
+
+
+def invalidate_agent_keys(path: Optional[str] = None):
+    """List again the keys of the agent listening on `path` (default: all the agents) on the next
+    connection, e.g. after adding a key with `ssh-add`."""
+
+    for agents in _agents.values():
+        for agent_path, entry in agents.items():
+            if path is None or agent_path == path:
+                entry[2] = None
+
+
+def close_agents(loop: Optional[asyncio.AbstractEventLoop] = None):
+    """Close all the agent connections of `loop` (default: the current event loop)."""
+
+    if loop is None:
+        loop = asyncio.get_event_loop()
+    for agent, _, _ in _agents.pop(loop, {}).values():
+        agent.close()
@@ -0,0 +1,200 @@
+import os
+import json
+import time
+import contextlib
+import contextvars
+from dataclasses import dataclass, field, asdict
+from typing import Any, Callable, Dict, List, Optional
+
+
+@dataclass
+class Span:
+
+    #: The name of the timed phase, e.g. `connect.tcp`, `channel_open`, `exec` or `get`.
+    name: str
+
+    #: The host the phase was executed for, if any.
+    host: Optional[str]
+
+    #: The (wall clock) time when the phase started.
+    start: float
+
+    #: How long the phase lasted, in seconds.
+    duration: float
+
+    #: Extra attributes of the phase, like the number of bytes transferred or the exit code.
+    attrs: Dict[str, Any] = field(default_factory=dict)
+
+    #: The class name of the exception that interrupted the phase, if any.
+    error: Optional[str] = None
+
+
+_hooks: List[Callable[[Span], None]] = []
+
+#: The host the current task is working on, used to attribute profiling data to hosts.
+current_host: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar(
+    "current_host", default=None
+)
+
+
+def add_hook(hook: Callable[[Span], None]):
+    """Register a function that will be called with each :class:`Span` when its phase ends."""
+
+    _hooks.append(hook)
+
+
+def remove_hook(hook: Callable[[Span], None]):
+    _hooks.remove(hook)
+
+
+def emit(span_: Span):
+    for hook in _hooks:
+        hook(span_)
+
+
+@contextlib.contextmanager
+def span(name: str, host: Optional[str] = None, **attrs):
+    """Time the code in the `with` block as the phase `name`.
+
+    Yields a dictionary of attributes that the block can update (e.g. with a byte counter). When no
+    hooks are registered nothing is measured.
+    """
+
+    if not _hooks:
+        yield attrs
+        return
+
+    start = time.time()
+    started = time.perf_counter()
+    error = None
+    try:
+        yield attrs
+    except BaseException as ex:
+        error = type(ex).__name__
+        raise
+    finally:
+        emit(Span(name, host, start, time.perf_counter() - started, attrs, error))
+
+
+def _percentile(values: List[float], percent: float) -> float:
+    index = min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))
+    return values[index]
+
+
+class Recorder:
+    """An in-memory recorder of spans, that can summarize and export them.
+
+    Use :func:`enable` to register one.
+    """
+
+    def __init__(self):
+        self.spans: List[Span] = []
+
+    def __call__(self, span_: Span):
+        self.spans.append(span_)
+
+    def clear(self):
+        self.spans = []
+
+    def histograms(self) -> Dict[str, Dict[str, float]]:
+        """Summarize the durations, the errors and the bytes transferred of each phase."""
+
+        durations: Dict[str, List[float]] = {}
+        for span_ in self.spans:
+            durations.setdefault(span_.name, []).append(span_.duration)
+
+        result = {}
+        for name, values in durations.items():
+            values.sort()
+            spans = [span_ for span_ in self.spans if span_.name == name]
+            result[name] = {
+                "count": len(values),
+                "errors": sum(1 for span_ in spans if span_.error is not None),
+                "bytes": sum(span_.attrs.get("bytes", 0) for span_ in spans),
+                "total": sum(values),
+                "min": values[0],
+                "p50": _percentile(values, 50),
+                "p90": _percentile(values, 90),
+                "p99": _percentile(values, 99),
+                "max": values[-1],
+            }
+        return result
+
+    def slowest(self, name: str, n: int = 10) -> List[Span]:
+        """Returns the `n` slowest spans of the phase `name`."""
+
+        spans = [span_ for span_ in self.spans if span_.name == name]
+        return sorted(spans, key=lambda span_: span_.duration, reverse=True)[:n]
+
+    def write_jsonl(self, filename: str):
+        """Write all the spans to `filename`, one JSON object per line."""
+
+        with open(filename, "w") as fd:
+            for span_ in self.spans:
+                fd.write(json.dumps(asdict(span_), default=str) + "\n")
+
+    def write_chrome_trace(self, filename: str):
+        """Write all the spans to `filename` in the Chrome trace event format.
+
+        The file can be loaded in `chrome://tracing` or https://ui.perfetto.dev; each host gets its
+        own track.
+        """
+
+        pid = os.getpid()
+        tids: Dict[Optional[str], int] = {}
+        events = []
+        for span_ in self.spans:
+            if span_.host not in tids:
+                tids[span_.host] = len(tids)
+                events.append(
+                    {
+                        "name": "thread_name",
+                        "ph": "M",
+                        "pid": pid,
+                        "tid": tids[span_.host],
+                        "args": {"name": span_.host or "fox"},
+                    }
+                )
+            args = dict(span_.attrs)
+            if span_.error is not None:
+                args["error"] = span_.error
+            events.append(
+                {
+                    "name": span_.name,
+                    "cat": "fox",
+                    "ph": "X",
+                    "ts": span_.start * 1e6,
+                    "dur": span_.duration * 1e6,
+                    "pid": pid,
+                    "tid": tids[span_.host],
+                    "args": args,
+                }
+            )
+
+        with open(filename, "w") as fd:
+            json.dump({"traceEvents": events}, fd, default=str)
+
+
+class JSONLWriter:
+    """A hook that appends each span to a JSONL file as soon as its phase ends.
+
+    :param filename: the path of the trace file.
+    """
+
+    def __init__(self, filename: str):
+        self.fd = open(filename, "a")
+
+    def __call__(self, span_: Span):
+        self.fd.write(json.dumps(asdict(span_), default=str) + "\n")
+        self.fd.flush()
+
+    def close(self):
+        self.fd.close()
+
+
+def enable() -> Recorder:
+    """Register and return a new in-memory :class:`Recorder`."""
+
+    recorder = Recorder()
+    add_hook(recorder)
+    return recorder
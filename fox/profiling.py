@@ -0,0 +1,189 @@
+import io
+import sys
+import time
+import pstats
+import asyncio
+import logging
+import cProfile
+from typing import Dict, List, Optional
+from .conf import env
+from . import metrics
+
+
+log = logging.getLogger(__name__)
+
+
+class _SlowCallbacks(logging.Handler):
+    """Collect the "Executing <Handle> took N seconds" warnings of asyncio's debug mode."""
+
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.records: List[str] = []
+
+    def emit(self, record):
+        self.records.append(record.getMessage())
+
+
+class LoopMonitor:
+    """Measure how late the event loop wakes up a task that sleeps for `interval` seconds.
+
+    A loop that is never blocked wakes it up on time; any lag is time spent running callbacks that
+    didn't yield to the loop (e.g. synchronous I/O).
+    """
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.lags: List[float] = []
+        self._task: Optional[asyncio.Future] = None
+
+    async def _monitor(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, loop.time() - started - self.interval))
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        self._task = loop.create_task(self._monitor())
+
+    def stop(self, loop: asyncio.AbstractEventLoop):
+        if self._task is not None:
+            self._task.cancel()
+            loop.run_until_complete(asyncio.gather(self._task, return_exceptions=True))
+
+    def summary(self) -> Dict[str, float]:
+        if not self.lags:
+            return {"samples": 0}
+        lags = sorted(self.lags)
+        return {
+            "samples": len(lags),
+            "mean": sum(lags) / len(lags),
+            "p99": lags[min(len(lags) - 1, int(len(lags) * 0.99))],
+            "max": lags[-1],
+        }
+
+
+class Profiler:
+    """Profile a run of the event loop, as configured by `env.profile`.
+
+    - `lag`: measure the event loop lag and log the slow callbacks.
+    - `cprofile`: also profile the run with :mod:`cProfile`.
+    - `yappi`: also profile the run with `yappi` (if installed), attributing the CPU time to the
+      hosts.
+
+    In all the modes the slowest hosts are reported, using the spans from :mod:`fox.metrics`.
+    """
+
+    def __init__(self, mode: str, report_path: Optional[str] = None):
+        if mode not in ("lag", "cprofile", "yappi"):
+            raise ValueError(f"unknown profiling mode: {mode}")
+        self.mode = mode
+        self.report_path = report_path
+        self.monitor = LoopMonitor()
+        self.recorder = metrics.Recorder()
+        self._slow_callbacks = _SlowCallbacks()
+        self._profile: Optional[cProfile.Profile] = None
+        self._yappi = None
+        self._tags: Dict[Optional[str], int] = {}
+        self._started = 0.0
+        self._elapsed = 0.0
+
+    def _tag(self) -> int:
+        host = metrics.current_host.get()
+        if host not in self._tags:
+            self._tags[host] = len(self._tags)
+        return self._tags[host]
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        self._loop_debug = loop.get_debug()
+        loop.set_debug(True)
+        loop.slow_callback_duration = env.profile_slow_callback
+        logging.getLogger("asyncio").addHandler(self._slow_callbacks)
+        metrics.add_hook(self.recorder)
+
+        if self.mode == "cprofile":
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        elif self.mode == "yappi":
+            try:
+                import yappi
+            except ImportError:
+                log.warning("yappi is not installed, falling back to cProfile")
+                self.mode = "cprofile"
+                return self.start(loop)
+            self._yappi = yappi
+            yappi.set_clock_type("cpu")
+            yappi.set_tag_callback(self._tag)
+            yappi.start()
+
+        self._started = time.perf_counter()
+        self.monitor.start(loop)
+
+    def stop(self, loop: asyncio.AbstractEventLoop):
+        self._elapsed = time.perf_counter() - self._started
+
+        if self._profile is not None:
+            self._profile.disable()
+        if self._yappi is not None:
+            self._yappi.stop()
+
+        self.monitor.stop(loop)
+        metrics.remove_hook(self.recorder)
+        logging.getLogger("asyncio").removeHandler(self._slow_callbacks)
+        loop.set_debug(self._loop_debug)
+
+    def report(self) -> str:
+        out = io.StringIO()
+        out.write(f"=== fox profile ({self.mode}): {self._elapsed:.3f}s ===\n")
+
+        lag = self.monitor.summary()
+        out.write("event loop lag: ")
+        out.write(", ".join(f"{key}={value:.4f}" for key, value in lag.items()) + "\n")
+
+        out.write(f"slow callbacks: {len(self._slow_callbacks.records)}\n")
+        for record in self._slow_callbacks.records[:20]:
+            out.write(f"  {record}\n")
+
+        slowest = self.recorder.slowest("host") or self.recorder.slowest("exec")
+        if slowest:
+            out.write("slowest hosts:\n")
+            for span in slowest:
+                out.write(f"  {span.host}: {span.duration:.3f}s\n")
+
+        if self._profile is not None:
+            stats = pstats.Stats(self._profile, stream=out)
+            stats.sort_stats("cumulative").print_stats(30)
+
+        if self._yappi is not None:
+            hosts = {tag: host for host, tag in self._tags.items()}
+            for tag, host in sorted(hosts.items()):
+                stats = self._yappi.get_func_stats(filter={"tag": tag})
+                stats.sort("ttot")
+                out.write(f"--- CPU time for {host or 'controller'} ---\n")
+                stats.print_all(
+                    out=out, columns={0: ("name", 60), 1: ("ncall", 8), 2: ("ttot", 8)}
+                )
+            self._yappi.clear_stats()
+
+        return out.getvalue()
+
+    def write_report(self):
+        report = self.report()
+        if self.report_path is None:
+            sys.stderr.write(report)
+            return
+
+        with open(self.report_path, "a") as fd:
+            fd.write(report)
+
+
+def run_profiled(loop: asyncio.AbstractEventLoop, future):
+    """Run `future` in `loop` with the profiler configured in `env`, then write its report."""
+
+    profiler = Profiler(env.profile, env.profile_report_path)  # type: ignore
+    profiler.start(loop)
+    try:
+        return loop.run_until_complete(future)
+    finally:
+        profiler.stop(loop)
+        profiler.write_report()
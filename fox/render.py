@@ -0,0 +1,241 @@
+"""The central renderer of the output of the commands and of the progress of transfers and runs.
+
+The output lines of all the hosts are buffered and written at most every `env.render_interval`
+seconds with a single write; the progress of all the running transfers is aggregated in a single
+status line on stderr, redrawn at the same rate and only when stderr is a terminal. With
+`env.quiet` the output of the commands and the progress are not even formatted.
+"""
+
+import sys
+import time
+import atexit
+import shutil
+import asyncio
+import threading
+from typing import List, Optional
+from .conf import env
+
+
+def _format_size(size: float) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(size) < 1000:
+            return f"{size:.1f}{unit}"
+        size /= 1000
+    return f"{size:.1f}TB"
+
+
+class Progress:
+    """The progress of a transfer or of a run, drawn by the :class:`Renderer`.
+
+    :param renderer: the renderer drawing the progress.
+    :param desc: the description of the progress, e.g. the name of the file transferred.
+    :param total: the total number of items (or bytes, when `unit` is `"B"`).
+    :param initial: the number of items already done.
+    :param unit: `"B"` for transfers, whose progress is aggregated in a single view.
+    """
+
+    __slots__ = ("renderer", "desc", "total", "done", "unit")
+
+    def __init__(self, renderer: "Renderer", desc: str, total: int, initial: int = 0, unit=""):
+        self.renderer = renderer
+        self.desc = desc
+        self.total = total
+        self.done = initial
+        self.unit = unit
+
+    def update(self, n: int = 1):
+        self.done += n
+        if self.unit == "B":
+            self.renderer.transferred += n
+        self.renderer.poke()
+
+    def set(self, done: int):
+        """Set the number of items done, e.g. from the cumulative count of a progress handler."""
+
+        self.update(done - self.done)
+
+    def close(self):
+        self.renderer.close_progress(self)
+
+
+class Renderer:
+    """Write the output lines and draw the progress, at most every `env.render_interval` seconds.
+
+    :param stream: the stream for the output lines (default: the current `sys.stdout`).
+    :param status_stream: the stream for the progress (default: the current `sys.stderr`).
+    """
+
+    def __init__(self, stream=None, status_stream=None):
+        self.stream = stream
+        self.status_stream = status_stream
+
+        #: The total number of bytes transferred.
+        self.transferred = 0
+
+        self._buffer: List[str] = []
+        self._progress: List[Progress] = []
+        self._lock = threading.Lock()
+        self._last_flush = 0.0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._timer_loop: Optional[asyncio.AbstractEventLoop] = None
+        self._status_drawn = False
+        self._rate: Optional[float] = None
+        self._rate_time = 0.0
+        self._rate_bytes = 0
+
+    def output(self, label: str, lines: List[str]):
+        """Write the output `lines` of the host `label`, unless `env.quiet` is set."""
+
+        if env.quiet or not lines:
+            return
+        formatted = [f"[{label}] {line}\n" for line in lines]
+        with self._lock:
+            self._buffer.extend(formatted)
+        self.poke()
+
+    def message(self, text: str):
+        """Write a message, in order with the output lines; messages are written in quiet mode."""
+
+        with self._lock:
+            self._buffer.append(f"{text}\n")
+        self.poke()
+
+    def progress(self, desc: str, total: int, initial: int = 0, unit: str = "") -> Progress:
+        """Start drawing a new :class:`Progress`; call its `close()` method when done."""
+
+        progress = Progress(self, desc, total, initial, unit)
+        with self._lock:
+            self._progress.append(progress)
+        return progress
+
+    def close_progress(self, progress: Progress):
+        with self._lock:
+            if progress in self._progress:
+                self._progress.remove(progress)
+            done = not self._progress
+        if done:
+            self.flush()
+
+    def poke(self):
+        """Flush if the last flush is older than `env.render_interval`, or schedule a flush."""
+
+        with self._lock:
+            if self._timer is not None:
+                return
+
+            delay = env.render_interval - (time.monotonic() - self._last_flush)
+            if delay > 0:
+                try:
+                    loop = asyncio.get_running_loop()
+                except RuntimeError:
+                    # not in the event loop: the next `flush()` will write the pending output
+                    return
+                self._timer = loop.call_later(delay, self._flush_later)
+                self._timer_loop = loop
+                return
+
+        self.flush()
+
+    def _flush_later(self):
+        with self._lock:
+            self._timer = None
+        self.flush()
+
+    def _cancel_timer(self):
+        timer, self._timer = self._timer, None
+        if timer is None:
+            return
+
+        # each thread has its own event loop: the timer may belong to the loop of another thread
+        loop = self._timer_loop
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if loop is running or loop is None:
+            timer.cancel()
+        elif not loop.is_closed():
+            loop.call_soon_threadsafe(timer.cancel)
+
+    def _status(self) -> str:
+        if env.quiet or not self._progress or not self._isatty():
+            return ""
+
+        now = time.monotonic()
+        elapsed = now - self._rate_time
+        if elapsed > 0:
+            rate = (self.transferred - self._rate_bytes) / elapsed
+            self._rate = rate if self._rate is None else 0.7 * self._rate + 0.3 * rate
+        self._rate_time = now
+        self._rate_bytes = self.transferred
+
+        parts = []
+        transfers = [progress for progress in self._progress if progress.unit == "B"]
+        if transfers:
+            done = sum(progress.done for progress in transfers)
+            total = sum(progress.total for progress in transfers)
+            name = transfers[0].desc if len(transfers) == 1 else f"{len(transfers)} transfers"
+            percent = done / total * 100 if total else 100.0
+            parts.append(
+                f"{name} {_format_size(done)}/{_format_size(total)} {percent:.0f}% "
+                f"{_format_size(self._rate or 0)}/s"
+            )
+        for progress in self._progress:
+            if progress.unit != "B":
+                parts.append(f"{progress.desc} {progress.done}/{progress.total}")
+
+        width = shutil.get_terminal_size().columns - 1
+        return " | ".join(parts)[:width]
+
+    def _isatty(self) -> bool:
+        stream = self.status_stream or sys.stderr
+        return hasattr(stream, "isatty") and stream.isatty()
+
+    def flush(self):
+        """Write the pending output lines and redraw the progress."""
+
+        with self._lock:
+            self._cancel_timer()
+            self._last_flush = time.monotonic()
+            buffer, self._buffer = self._buffer, []
+
+            status_stream = self.status_stream or sys.stderr
+            status = self._status()
+            if self._status_drawn and (buffer or not status):
+                # clear the status line before writing below it
+                status_stream.write("\r\x1b[K")
+                status_stream.flush()
+                self._status_drawn = False
+
+            if buffer:
+                stream = self.stream or sys.stdout
+                stream.write("".join(buffer))
+                stream.flush()
+
+            if status:
+                status_stream.write(f"\r{status}\x1b[K")
+                status_stream.flush()
+                self._status_drawn = True
+            if not self._progress:
+                self._rate = None
+
+
+_renderer: Optional[Renderer] = None
+
+
+def get_renderer() -> Renderer:
+    """Returns the global renderer."""
+
+    global _renderer
+
+    if _renderer is None:
+        _renderer = Renderer()
+    return _renderer
+
+
+def _flush_renderer():
+    if _renderer is not None:
+        _renderer.flush()
+
+
+atexit.register(_flush_renderer)
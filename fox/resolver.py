@@ -0,0 +1,117 @@
+import socket
+import asyncio
+import logging
+import weakref
+import ipaddress
+from typing import Dict, Iterable, List, Tuple, Union, Optional
+from .conf import env
+
+
+log = logging.getLogger(__name__)
+
+# the semaphore bounding the lookups of a loop, and its lookups in flight
+_LoopState = Tuple[asyncio.Semaphore, Dict[str, asyncio.Future]]
+
+
+class Resolver:
+    """A DNS resolver with a TTL cache and a bounded number of concurrent lookups.
+
+    :param ttl: the number of seconds the resolved addresses are cached for.
+    :param concurrency: the maximum number of lookups running at the same time.
+    """
+
+    def __init__(self, ttl: float = 60, concurrency: int = 32):
+        self.ttl = ttl
+        self.concurrency = concurrency
+        # hostname -> (expiration time, addresses)
+        self._cache: Dict[str, Tuple[float, List[str]]] = {}
+        # asyncio primitives are bound to a loop, and each thread has its own: the semaphore and
+        # the lookups in flight (hostname -> future) are kept per loop.
+        self._loops: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, _LoopState]"
+        self._loops = weakref.WeakKeyDictionary()
+
+    def _get_state(self, loop: asyncio.AbstractEventLoop) -> "_LoopState":
+        state = self._loops.get(loop)
+        if state is None:
+            state = self._loops[loop] = (asyncio.Semaphore(self.concurrency), {})
+        return state
+
+    async def resolve(self, hostname: str, port: int = 22) -> List[str]:
+        """Returns the addresses of `hostname`, in the order they should be tried to connect;
+        raises :class:`socket.gaierror` on failure."""
+
+        try:
+            ipaddress.ip_address(hostname)
+            return [hostname]
+        except ValueError:
+            pass
+
+        loop = asyncio.get_event_loop()
+        entry = self._cache.get(hostname)
+        if entry is not None and entry[0] > loop.time():
+            return entry[1]
+
+        semaphore, inflight = self._get_state(loop)
+        # many connections to the same host must share a single lookup
+        shared = inflight.get(hostname)
+        if shared is not None:
+            try:
+                return await asyncio.shield(shared)
+            except asyncio.CancelledError:
+                if not shared.cancelled():
+                    raise
+                # the lookup was cancelled with the task running it, and not this one: retry
+                return await self.resolve(hostname, port)
+
+        future = loop.create_future()
+        inflight[hostname] = future
+        try:
+            async with semaphore:
+                infos = await loop.getaddrinfo(hostname, port, type=socket.SOCK_STREAM)
+            # the same address is returned once per protocol
+            addresses = list(dict.fromkeys(info[4][0] for info in infos))
+        except asyncio.CancelledError:
+            # the waiters must not hang: they will do the lookup themselves
+            future.cancel()
+            raise
+        except Exception as ex:
+            future.set_exception(ex)
+            # mark the exception as retrieved, in case nobody else was waiting for it
+            future.exception()
+            raise
+        else:
+            self._cache[hostname] = (loop.time() + self.ttl, addresses)
+            future.set_result(addresses)
+        finally:
+            del inflight[hostname]
+
+        log.debug(f"Resolved {hostname} to {', '.join(addresses)}")
+        return addresses
+
+    async def resolve_all(self, hostnames: Iterable[str]) -> Dict[str, Union[List[str], Exception]]:
+        """Resolve all of `hostnames` concurrently.
+
+        Returns a dictionary mapping each hostname to its addresses or to the resolution error.
+        """
+
+        hostnames = list(set(hostnames))
+        results = await asyncio.gather(
+            *[self.resolve(hostname) for hostname in hostnames], return_exceptions=True
+        )
+        return dict(zip(hostnames, results))
+
+
+_resolver: Optional[Resolver] = None
+
+
+def get_resolver() -> Optional[Resolver]:
+    """Returns the global resolver, or `None` when it's disabled in `env`."""
+
+    global _resolver
+
+    if not env.resolver_ttl:
+        return None
+
+    if _resolver is None:
+        _resolver = Resolver(env.resolver_ttl, env.resolver_concurrency)
+    return _resolver
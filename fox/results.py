@@ -0,0 +1,115 @@
+"""Writers that stream the results of a cluster run to a file, as the hosts complete.
+
+The results can then be processed without holding them all in memory: JSONL files line by line,
+Parquet files (written with the optional `pyarrow` package) with any columnar tool.
+"""
+
+import json
+from typing import Any, Dict, List, Optional, Union
+from .utils import CommandResult
+
+
+#: The columns of each result record.
+COLUMNS = ("host", "command", "exit_code", "stdout", "stderr", "sudo", "duration", "error")
+
+
+def result_record(host: str, result: Union[CommandResult, Exception]) -> Dict[str, Any]:
+    """Convert the result of `host` (or the exception it raised) to a flat record."""
+
+    if isinstance(result, CommandResult):
+        return {
+            "host": host,
+            "command": result.command,
+            "exit_code": result.exit_code,
+            "stdout": result.stdout,
+            "stderr": result.stderr,
+            "sudo": result.sudo,
+            "duration": result.duration,
+            "error": None,
+        }
+
+    record: Dict[str, Any] = dict.fromkeys(COLUMNS)
+    record.update({"host": host, "error": f"{type(result).__name__}: {result}"})
+    return record
+
+
+class JSONLResultWriter:
+    """Write each result as a JSON object on its own line.
+
+    :param path: the path of the file to write.
+    """
+
+    def __init__(self, path: str):
+        self.fd = open(path, "w")
+
+    def write(self, host: str, result: Union[CommandResult, Exception]):
+        self.fd.write(json.dumps(result_record(host, result)) + "\n")
+
+    def close(self):
+        self.fd.close()
+
+
+class ParquetResultWriter:
+    """Write the results to a Parquet file, in row groups of `row_group_size` results.
+
+    :param path: the path of the file to write.
+    :param row_group_size: the number of results buffered in memory before being written.
+
+    Requires the `pyarrow` package.
+    """
+
+    def __init__(self, path: str, row_group_size: int = 1000):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("pyarrow is required to write the results to Parquet") from None
+
+        self._pyarrow = pyarrow
+        self.schema = pyarrow.schema(
+            [
+                ("host", pyarrow.string()),
+                ("command", pyarrow.string()),
+                ("exit_code", pyarrow.int64()),
+                ("stdout", pyarrow.string()),
+                ("stderr", pyarrow.string()),
+                ("sudo", pyarrow.bool_()),
+                ("duration", pyarrow.float64()),
+                ("error", pyarrow.string()),
+            ]
+        )
+        self.row_group_size = row_group_size
+        self._rows: List[Dict[str, Any]] = []
+        self._writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+
+    def write(self, host: str, result: Union[CommandResult, Exception]):
+        self._rows.append(result_record(host, result))
+        if len(self._rows) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if self._rows:
+            table = self._pyarrow.Table.from_pylist(self._rows, schema=self.schema)
+            self._writer.write_table(table)
+            self._rows = []
+
+    def close(self):
+        self.flush()
+        self._writer.close()
+
+
+def open_writer(path: str, output_format: Optional[str] = None):
+    """Returns a writer for `path`, in `output_format` (`"jsonl"` or `"parquet"`).
+
+    When `output_format` is not specified it's guessed from the extension of `path`, defaulting to
+    JSONL.
+    """
+
+    if output_format is None:
+        output_format = "parquet" if path.endswith(".parquet") else "jsonl"
+
+    if output_format == "parquet":
+        return ParquetResultWriter(path)
+    if output_format == "jsonl":
+        return JSONLResultWriter(path)
+    raise ValueError(f"unknown results format: {output_format}")
@@ -2,8 +2,13 @@ import re
 import os
 import socket
 import getpass
-from typing import Dict, Any
-from fnmatch import fnmatch
+import glob
+import time
+import heapq
+import functools
+from typing import Dict, Any, List, Optional, Pattern, Tuple
+from fnmatch import translate
+from .cache import file_signature, load_json, save_json
 
 
 class Error(Exception):
@@ -12,21 +17,66 @@ class Error(Exception):
 
 SSH_EXPAND_OPTIONS = ["proxycommand", "controlpath"]
 
+# same as OpenSSH
+MAX_INCLUDE_DEPTH = 16
 
-def match(hostname, patterns):
-    for pattern in patterns:
-        if pattern.startswith("!"):
-            negate = True
-            pattern = pattern[1:]
-        else:
-            negate = False
-
-        if fnmatch(hostname, pattern):
-            if negate:
-                return False
+# bump when the format of the parse cache changes
+CACHE_VERSION = 2
+
+# the number of seconds between the checks for changes of the loaded files, see SSHConfig.lookup()
+CHECK_INTERVAL = 1.0
+
+# the Match criteria that take no argument
+MATCH_FLAGS = ("all", "canonical", "final")
+
+
+def _changed(files: Dict[str, List[int]], globs: Dict[str, List[str]]) -> bool:
+    """Whether any of the parsed `files` changed, or any `Include` glob matches other files."""
+
+    try:
+        if any(file_signature(path) != signature for path, signature in files.items()):
             return True
+    except OSError:
+        return True
+
+    return any(sorted(glob.glob(pattern)) != matches for pattern, matches in globs.items())
+
+
+def _is_wildcard(pattern: str) -> bool:
+    return any(char in pattern for char in "*?[")
 
-    return False
+
+def _compile_patterns(patterns: List[str]) -> Optional[Pattern]:
+    if not patterns:
+        return None
+    return re.compile("|".join(translate(pattern) for pattern in patterns))
+
+
+def compile_patterns(patterns) -> Tuple[Optional[Pattern], Optional[Pattern]]:
+    """Compile a list of patterns into a regex for the positive and one for the negated patterns."""
+
+    positive = [pattern for pattern in patterns if not pattern.startswith("!")]
+    negative = [pattern[1:] for pattern in patterns if pattern.startswith("!")]
+    return _compile_patterns(positive), _compile_patterns(negative)
+
+
+_compile = functools.lru_cache(maxsize=1024)(compile_patterns)
+
+
+def _match_compiled(hostname, positive, negative):
+    if negative is not None and negative.match(hostname):
+        return False
+    return positive is not None and positive.match(hostname) is not None
+
+
+def match(hostname, patterns):
+    """Check if `hostname` matches a list of OpenSSH patterns.
+
+    Like OpenSSH a hostname matches when it matches any of the patterns and none of the negated
+    ones.
+    """
+
+    return _match_compiled(hostname, *_compile(tuple(patterns)))
 
 
 # not all SSH options support all the available tokens, but whatever...
@@ -56,8 +106,17 @@ def expand_tokens(s, nickname, options):
 
 
 class SSHOptions:
-    def __init__(self, patterns, **options):
+    """The options of a `Host` block.
+
+    `guard` is the block that contained the `Include` this block was read from: like OpenSSH, the
+    included blocks never match unless the including block matches too.
+    """
+
+    def __init__(self, patterns, guard: Optional["SSHOptions"] = None, **options):
         self.patterns = patterns.copy()
+        self.guard = guard
+        # compiled on first use: most blocks are never checked thanks to the index in SSHConfig
+        self._compiled: Optional[Tuple[Optional[Pattern], Optional[Pattern]]] = None
         self.options = {}
         for key, value in options.items():
             self.options[key] = value
@@ -65,48 +124,272 @@ class SSHOptions:
     def set_option(self, key, value):
         self.options[key] = value
 
+    def matches(self, hostname: str, options: Dict[str, Any]) -> bool:
+        if self.guard is not None and not self.guard.matches(hostname, options):
+            return False
+        return self._matches(hostname, options)
+
+    def _matches(self, hostname: str, options: Dict[str, Any]) -> bool:
+        if self._compiled is None:
+            self._compiled = compile_patterns(self.patterns)
+        return _match_compiled(hostname, *self._compiled)
+
+    def condition(self) -> "SSHOptions":
+        """Returns a block without options that matches the same hosts as this one."""
+
+        return SSHOptions(self.patterns, self.guard)
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = {"patterns": self.patterns, "options": self.options}
+        if self.guard is not None:
+            data["guard"] = self.guard.to_dict()
+        return data
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "SSHOptions":
+        guard = cls.from_dict(data["guard"]) if "guard" in data else None
+        if "criteria" in data:
+            return MatchOptions(data["criteria"], guard, **data["options"])
+        return cls(data["patterns"], guard, **data["options"])
+
+    def literals(self) -> Optional[List[str]]:
+        """Returns the hostnames matched by this block if none of its patterns are wildcards."""
+
+        positive = [pattern for pattern in self.patterns if not pattern.startswith("!")]
+        if any(_is_wildcard(pattern) for pattern in positive):
+            return None
+        return positive
+
+
+class MatchOptions(SSHOptions):
+    """The options of a `Match` block.
+
+    Only the `all`, `host`, `originalhost`, `user` and `localuser` criteria are supported; a block
+    using any other criteria never matches.
+    """
+
+    def __init__(self, criteria, guard: Optional[SSHOptions] = None, **options):
+        super().__init__(["*"], guard, **options)
+        # a list of (criterion, patterns) tuples; negated criteria start with "!".
+        self.criteria = [(criterion, list(patterns)) for criterion, patterns in criteria]
+
+    def _matches(self, hostname: str, options: Dict[str, Any]) -> bool:
+        for criterion, patterns in self.criteria:
+            negate = criterion.startswith("!")
+            criterion = criterion.lstrip("!")
+
+            if criterion == "all":
+                result = True
+            elif criterion == "host":
+                result = match(options.get("hostname", hostname), patterns)
+            elif criterion == "originalhost":
+                result = match(hostname, patterns)
+            elif criterion == "user":
+                result = match(options.get("user", getpass.getuser()), patterns)
+            elif criterion == "localuser":
+                result = match(getpass.getuser(), patterns)
+            else:
+                return False
+
+            if result == negate:
+                return False
+        return True
+
+    def literals(self) -> Optional[List[str]]:
+        return None
+
+    def condition(self) -> "MatchOptions":
+        return MatchOptions(self.criteria, self.guard)
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = super().to_dict()
+        del data["patterns"]
+        data["criteria"] = self.criteria
+        return data
+
+
+def _parse_match(arguments: List[str]):
+    criteria = []
+    while arguments:
+        criterion = arguments.pop(0).lower()
+        if criterion.lstrip("!") in MATCH_FLAGS:
+            criteria.append((criterion, []))
+            continue
+        if not arguments:
+            raise Error(f"Error: missing argument for Match {criterion}")
+        criteria.append((criterion, arguments.pop(0).split(",")))
+    return criteria
+
 
 class SSHConfig:
     """Parse a OpenSSH configuration file and lookup SSH options for connecting to a given host."""
 
     def __init__(self):
         self.blocks = []
+        self._filename: Optional[str] = None
+        self._cache_path: Optional[str] = None
+        self._reset()
 
-    def load(self, filename: str):
-        """Load and parse a OpenSSH configuration file."""
+    def _reset(self):
+        # an index of the blocks by literal hostname, the blocks with wildcards that must always be
+        # checked, and the results of lookup(); must be reset when `blocks` change.
+        self._literal_blocks: Optional[Dict[str, List[int]]] = None
+        self._wildcard_blocks: List[int] = []
+        self._lookup_cache: Dict[str, Dict[str, Any]] = {}
+        # the files that were read and the `Include` globs that were expanded, used to validate
+        # the parse cache.
+        self._files: Dict[str, List[int]] = {}
+        self._globs: Dict[str, List[str]] = {}
+        self._checked = time.monotonic()
 
-        with open(filename) as fd:
-            sshopt = None
+    def _build_index(self):
+        self._literal_blocks = {}
+        self._wildcard_blocks = []
+
+        for i, block in enumerate(self.blocks):
+            literals = block.literals()
+            if literals is None:
+                self._wildcard_blocks.append(i)
+                continue
+            for hostname in set(literals):
+                self._literal_blocks.setdefault(hostname, []).append(i)
+
+    def _candidate_blocks(self, nickname: str):
+        if self._literal_blocks is None:
+            self._build_index()
+
+        # keep the original order of the blocks: the first value found for an option wins.
+        indexes = heapq.merge(self._literal_blocks.get(nickname, []), self._wildcard_blocks)
+        return (self.blocks[i] for i in indexes)
+
+    def load(self, filename: str, cache_path: Optional[str] = None):
+        """Load and parse a OpenSSH configuration file.
+
+        :param filename: the path of the configuration file.
+        :param cache_path: the optional path of a file where the parsed configuration is cached; the
+         cache is used as long as none of the parsed files (including the ones included with
+         `Include`) changed.
+        """
+
+        self.blocks = []
+        self._filename = filename
+        self._cache_path = cache_path
+        self._reset()
+        if cache_path is not None and self._load_cache(filename, cache_path):
+            return
 
+        sshopt = self._parse(filename, None, None, os.path.dirname(filename), 0)
+        if sshopt is not None:
+            self.blocks.append(sshopt)
+
+        if cache_path is not None:
+            self._save_cache(filename, cache_path)
+
+    def _parse(self, filename: str, sshopt, guard, basedir: str, depth: int):
+        if depth > MAX_INCLUDE_DEPTH:
+            raise Error(f"Error: too many nested Include directives in {filename}")
+
+        self._files[filename] = file_signature(filename)
+        with open(filename) as fd:
             for line in fd:
                 line = line.strip()
                 if not line or line.startswith("#"):
                     continue
 
-                m = re.search(r"^host +(.*)$", line, re.I)
-                if m:
+                parts = re.split(r"\s*=\s*|\s+", line, maxsplit=1)
+                if len(parts) != 2:
+                    raise Error(f"Error: invalid line in {filename}: {line}")
+                key = parts[0].lower()
+                value = parts[1].strip()
+
+                if key in ("host", "match"):
                     if sshopt is not None:
                         self.blocks.append(sshopt)
-                    patterns = [p.strip() for p in m.group(1).split(",")]
-                    sshopt = SSHOptions(patterns)
+                    if key == "host":
+                        sshopt = SSHOptions([p for p in re.split(r"[\s,]+", value) if p], guard)
+                    else:
+                        sshopt = MatchOptions(_parse_match(value.split()), guard)
                     continue
 
+                if key == "include":
+                    outer = sshopt
+                    # the blocks of the included files apply only when the including block matches
+                    inner_guard = outer.condition() if outer is not None else guard
+                    for path in self._expand_include(value, basedir):
+                        sshopt = self._parse(path, sshopt, inner_guard, basedir, depth + 1)
+                    # the lines after Include still belong to the block that contained it
+                    if sshopt is not outer:
+                        self.blocks.append(sshopt)
+                        sshopt = outer.condition() if outer is not None else None
+                    continue
+
+                # options before the first Host block apply to all the hosts
                 if sshopt is None:
-                    raise Error("Error: expected to be in a 'Host' block!")
-                key, value = line.split(" ", 1)
-                key = key.strip().lower()
+                    sshopt = SSHOptions(["*"], guard)
                 sshopt.set_option(key, value)
 
-            if sshopt is not None:
-                self.blocks.append(sshopt)
+        return sshopt
+
+    def _expand_include(self, value: str, basedir: str) -> List[str]:
+        paths = []
+        for pattern in value.split():
+            pattern = os.path.join(basedir, os.path.expanduser(pattern))
+            matches = sorted(glob.glob(pattern))
+            self._globs[pattern] = matches
+            paths.extend(matches)
+        return paths
+
+    def _load_cache(self, filename: str, cache_path: str) -> bool:
+        try:
+            cache = load_json(cache_path)
+        except (OSError, ValueError):
+            return False
+
+        if cache.get("version") != CACHE_VERSION or cache.get("filename") != filename:
+            return False
+
+        if _changed(cache["files"], cache["globs"]):
+            return False
+
+        self.blocks = [SSHOptions.from_dict(block) for block in cache["blocks"]]
+        self._files = cache["files"]
+        self._globs = cache["globs"]
+        return True
+
+    def _save_cache(self, filename: str, cache_path: str):
+        cache = {
+            "version": CACHE_VERSION,
+            "filename": filename,
+            "files": self._files,
+            "globs": self._globs,
+            "blocks": [block.to_dict() for block in self.blocks],
+        }
+
+        save_json(cache_path, cache)
 
     def lookup(self, nickname: str) -> Dict[str, Any]:
-        """Lookup SSH options for connecting to the server `nickname`."""
+        """Lookup SSH options for connecting to the server `nickname`.
+
+        The configuration is loaded again when any of its files changed, which is checked at most
+        every `CHECK_INTERVAL` seconds.
+        """
+
+        now = time.monotonic()
+        if self._filename is not None and now - self._checked > CHECK_INTERVAL:
+            self._checked = now
+            if _changed(self._files, self._globs):
+                self.load(self._filename, self._cache_path)
+
+        if nickname not in self._lookup_cache:
+            self._lookup_cache[nickname] = self._lookup(nickname)
+        # callers are free to modify the returned dictionary
+        return dict(self._lookup_cache[nickname])
 
+    def _lookup(self, nickname: str) -> Dict[str, Any]:
         options = {}
 
-        for block in self.blocks:
-            if match(nickname, block.patterns):
+        for block in self._candidate_blocks(nickname):
+            if block.matches(nickname, options):
                 for opt_name, opt_value in block.options.items():
                     if opt_name not in options:
                         options[opt_name] = opt_value
@@ -0,0 +1,313 @@
+"""The transports used by connections to reach the remote servers.
+
+A transport opens a connection object exposing the subset of
+:class:`asyncssh.SSHClientConnection` used by fox: `create_process()`, `start_sftp_client()`,
+`close()` and `wait_closed()`. The default transport uses asyncssh; :class:`SimulatedTransport`
+simulates servers in memory, to test the scheduling of thousands of hosts in a single process.
+"""
+
+import os
+import time
+import random
+import asyncio
+from typing import Any, Dict, Optional, Tuple
+from .conf import env
+from . import metrics
+
+
+class Transport:
+    """The base class of the transports."""
+
+    #: Wether the transport connects through the network, so that hostnames must be resolved and
+    #: dead hosts can be probed.
+    uses_network = True
+
+    async def connect(self, address: str, port: int, nickname: str, options: Dict[str, Any]):
+        """Open a connection to `address` and `port`; `options` are asyncssh connection options."""
+
+        raise NotImplementedError
+
+
+class AsyncSSHTransport(Transport):
+    """Connect to SSH servers with asyncssh."""
+
+    async def connect(self, address: str, port: int, nickname: str, options: Dict[str, Any]):
+        import asyncssh
+
+        if not metrics._hooks:
+            return await asyncssh.connect(address, port, **options)
+
+        # split the time spent establishing the TCP connection from the time spent in the SSH
+        # handshake and authentication.
+        tcp_connected = []
+
+        class _TimingClient(asyncssh.SSHClient):
+            def connection_made(self, conn):
+                tcp_connected.append(time.time())
+
+        start = time.time()
+        connection = await asyncssh.connect(address, port, client_factory=_TimingClient, **options)
+        end = time.time()
+        if tcp_connected:
+            tcp_time = tcp_connected[0] - start
+            metrics.emit(metrics.Span("connect.tcp", nickname, start, tcp_time))
+            handshake_time = end - start - tcp_time
+            metrics.emit(
+                metrics.Span("connect.handshake", nickname, tcp_connected[0], handshake_time)
+            )
+        return connection
+
+
+_default_transport = AsyncSSHTransport()
+
+
+def get_transport() -> Transport:
+    """Returns the transport configured in `env.transport`, or the asyncssh one."""
+
+    if env.transport is None:
+        return _default_transport
+    return env.transport
+
+
+class SimulatedTransport(Transport):
+    """A transport to simulated servers that live in memory.
+
+    Every command succeeds (or exits with `exit_status`) after `duration` seconds, printing
+    `output_size` bytes of output. Only the size of the uploaded files is kept, per host, and their
+    contents read as zeros; any other remote file can be read and is `file_size` bytes long, but
+    doesn't `exists()`.
+
+    :param latency: the round trip time to the servers, in seconds; connecting takes 3 round trips,
+     opening a channel and starting a SFTP session one each.
+    :param failure_rate: the fraction of the hosts that refuse the connections; the hosts that fail
+     are picked at random but always the same for a given `seed`.
+    :param output_size: the number of bytes written to stdout by the commands.
+    :param bandwidth: the bandwidth of each connection in bytes per second (`None` for unlimited).
+    :param duration: the number of seconds each command runs for.
+    :param exit_status: the exit status of the commands.
+    :param file_size: the size of the remote files, in bytes.
+    :param seed: the seed used to pick the hosts that fail.
+    """
+
+    uses_network = False
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        failure_rate: float = 0.0,
+        output_size: int = 0,
+        bandwidth: Optional[float] = None,
+        duration: float = 0.0,
+        exit_status: int = 0,
+        file_size: int = 1024 * 1024,
+        seed: int = 0,
+    ):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.output_size = output_size
+        self.bandwidth = bandwidth
+        self.duration = duration
+        self.exit_status = exit_status
+        self.file_size = file_size
+        self.seed = seed
+        # (address, port) -> path -> size of the uploaded files
+        self._files: Dict[Tuple[str, int], Dict[str, int]] = {}
+
+    def fails(self, address: str, port: int) -> bool:
+        """Wether the simulated host at `address` and `port` refuses the connections."""
+
+        return random.Random(f"{self.seed}:{address}:{port}").random() < self.failure_rate
+
+    async def _transfer(self, size: int):
+        if self.bandwidth:
+            await asyncio.sleep(size / self.bandwidth)
+        else:
+            # let the other tasks run, like a real transfer would
+            await asyncio.sleep(0)
+
+    async def connect(self, address: str, port: int, nickname: str, options: Dict[str, Any]):
+        await asyncio.sleep(self.latency * 3)
+        if self.fails(address, port):
+            raise ConnectionRefusedError(f"simulated connection to {address}:{port} refused")
+        return _SimulatedConnection(self, self._files.setdefault((address, port), {}))
+
+
+_LINE = b"x" * 79 + b"\n"
+
+
+class _SimulatedStream:
+    """The stdout or stderr of a simulated process."""
+
+    def __init__(self, transport: SimulatedTransport, size: int, encoding: Optional[str]):
+        self._transport = transport
+        self._size = size
+        self._encoding = encoding
+        self._sent = 0
+        self._started = False
+
+    async def read(self, n: int = -1):
+        if not self._started:
+            self._started = True
+            await asyncio.sleep(self._transport.latency + self._transport.duration)
+
+        if n < 0:
+            n = self._size - self._sent
+        n = min(n, self._size - self._sent)
+        start = self._sent % len(_LINE)
+        data = (_LINE * (n // len(_LINE) + 2))[start : start + n]  # noqa: E203
+        self._sent += n
+        if data:
+            await self._transport._transfer(n)
+
+        if self._encoding is None:
+            return data
+        return data.decode(self._encoding)
+
+
+class _SimulatedStdin:
+    def write(self, data):
+        pass
+
+    def write_eof(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class _SimulatedProcess:
+    def __init__(self, transport: SimulatedTransport, command: str, encoding: Optional[str]):
+        self.command = command
+        self.stdin = _SimulatedStdin()
+        self.stdout = _SimulatedStream(transport, transport.output_size, encoding)
+        self.stderr = _SimulatedStream(transport, 0, encoding)
+        self.exit_status = transport.exit_status
+
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+
+class _SimulatedFile:
+    def __init__(self, sftp: "_SimulatedSFTPClient", path: str, mode: str):
+        self._sftp = sftp
+        self._path = path
+        if "w" in mode:
+            sftp._files[path] = 0
+        self._offset = 0
+
+    @property
+    def _size(self) -> int:
+        return self._sftp._files.get(self._path, self._sftp._transport.file_size)
+
+    async def read(self, size: int = -1, offset: Optional[int] = None) -> bytes:
+        if offset is not None:
+            self._offset = min(offset, self._size)
+        remaining = self._size - self._offset
+        if size < 0 or size > remaining:
+            size = remaining
+        self._offset += size
+        await self._sftp._transport._transfer(size)
+        return bytes(size)
+
+    async def write(self, data: bytes, offset: Optional[int] = None) -> int:
+        if offset is not None:
+            self._offset = offset
+        await self._sftp._transport._transfer(len(data))
+        self._offset += len(data)
+        self._sftp._files[self._path] = max(self._size, self._offset)
+        return len(data)
+
+    async def close(self):
+        pass
+
+
+class _SimulatedSFTPClient:
+    def __init__(self, transport: SimulatedTransport, files: Dict[str, int]):
+        self._transport = transport
+        # the sizes of the files uploaded to the host
+        self._files = files
+
+    async def getsize(self, path: str) -> int:
+        await asyncio.sleep(self._transport.latency)
+        return self._files.get(path, self._transport.file_size)
+
+    async def exists(self, path: str) -> bool:
+        await asyncio.sleep(self._transport.latency)
+        return path in self._files
+
+    async def open(self, path: str, mode: str = "r") -> _SimulatedFile:
+        await asyncio.sleep(self._transport.latency)
+        return _SimulatedFile(self, path, mode)
+
+    async def remove(self, path: str):
+        await asyncio.sleep(self._transport.latency)
+        if self._files.pop(path, None) is None:
+            raise FileNotFoundError(path)
+
+    async def rename(self, oldpath: str, newpath: str):
+        await asyncio.sleep(self._transport.latency)
+        if newpath in self._files:
+            raise FileExistsError(newpath)
+        await self.posix_rename(oldpath, newpath)
+
+    async def posix_rename(self, oldpath: str, newpath: str):
+        await asyncio.sleep(self._transport.latency)
+        if oldpath not in self._files:
+            raise FileNotFoundError(oldpath)
+        self._files[newpath] = self._files.pop(oldpath)
+
+    async def get(self, remotepath, localpath, block_size=16384, progress_handler=None, **kwargs):
+        size = self._files.get(remotepath, self._transport.file_size)
+        await asyncio.sleep(self._transport.latency)
+        with open(localpath, "wb") as fd:
+            for offset in range(0, size, block_size):
+                length = min(block_size, size - offset)
+                await self._transport._transfer(length)
+                fd.write(bytes(length))
+                if progress_handler is not None:
+                    progress_handler(remotepath, localpath, offset + length, size)
+
+    async def put(self, localpath, remotepath, block_size=16384, progress_handler=None, **kwargs):
+        size = os.path.getsize(localpath)
+        await asyncio.sleep(self._transport.latency)
+        for offset in range(0, size, block_size):
+            length = min(block_size, size - offset)
+            await self._transport._transfer(length)
+            if progress_handler is not None:
+                progress_handler(localpath, remotepath, offset + length, size)
+        self._files[remotepath] = size
+
+    def exit(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+
+class _SimulatedConnection:
+    def __init__(self, transport: SimulatedTransport, files: Dict[str, int]):
+        self._transport = transport
+        self._files = files
+
+    async def create_process(self, command: str, encoding: Optional[str] = "utf-8", **kwargs):
+        await asyncio.sleep(self._transport.latency)
+        return _SimulatedProcess(self._transport, command, encoding)
+
+    async def start_sftp_client(self) -> _SimulatedSFTPClient:
+        await asyncio.sleep(self._transport.latency)
+        return _SimulatedSFTPClient(self._transport, self._files)
+
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
@@ -1,9 +1,37 @@
+import sys
 import shlex
+import codecs
 import asyncio
+import logging
+import threading
 import collections
-from dataclasses import dataclass
+from dataclasses import dataclass, fields
+from typing import Deque, List, Optional, Union
+from .conf import env
+from .render import get_renderer
 
 
+log = logging.getLogger(__name__)
+
+# the event loop of each thread, see `get_loop()`
+_thread_state = threading.local()
+
+
+def _with_slots(cls):
+    """Recreate the dataclass `cls` with `__slots__`, like `@dataclass(slots=True)` on Python 3.10+.
+
+    The default values of the fields are already stored by the generated `__init__`.
+    """
+
+    names = tuple(field.name for field in fields(cls))
+    attrs = {key: value for key, value in cls.__dict__.items() if key not in names}
+    attrs.pop("__dict__", None)
+    attrs.pop("__weakref__", None)
+    attrs["__slots__"] = names
+    return type(cls)(cls.__name__, cls.__bases__, attrs)
+
+
+@_with_slots
 @dataclass
 class CommandResult:
 
@@ -28,6 +56,15 @@ class CommandResult:
     #: Wether the command was executed with sudo.
     sudo: bool = False
 
+    #: The number of seconds the command took to run.
+    duration: Optional[float] = None
+
+    def __post_init__(self):
+        # the same command runs on many hosts: store each string only once
+        self.command = sys.intern(self.command)
+        self.actual_command = sys.intern(self.actual_command)
+        self.hostname = sys.intern(self.hostname)
+
     # NOTE: when running in a pty there is no stderr!
     def summary(self):
         print(f'Ran command "{self.command}", exited with {self.exit_code}')
@@ -62,78 +99,279 @@ def prepare_environment(variables):
 def split_lines(data: str):
     """Separate newline terminated strings from the rest of the text
 
-    Returns two values: the first is a list of newline terminated strings found in data, and the
-    second value is any remaining text.
+    Returns two values: the first is a list of newline terminated strings found in data, with their
+    line terminators ("\n" or "\r\n") removed, and the second value is any remaining text.
+    """
+
+    lines = data.split("\n")
+    rest = lines.pop()
+    return ([line[:-1] if line.endswith("\r") else line for line in lines], rest)
+
+
+class LineDecoder:
+    """Incrementally decode a stream of bytes and split it in lines of text.
 
-    TODO:
-    - handle "\r"
-    - handle "\r\n"
+    Multi-byte characters split across two chunks are decoded correctly; lines can be terminated by
+    "\n", "\r\n" or a lone "\r" (e.g. progress bars), and lines longer than `max_line_length`
+    characters are split, so that a stream without newlines uses a bounded amount of memory.
+
+    :param encoding: the encoding of the stream.
+    :param max_line_length: the maximum length of a line (default: `env.max_line_length`).
     """
-    lines = []
-    start = 0
-    i = 0
-    length = len(data)
-    while True:
+
+    def __init__(self, encoding: str = "utf-8", max_line_length: Optional[int] = None):
+        self._decoder = codecs.getincrementaldecoder(encoding)("replace")
+        self.max_line_length = max_line_length or env.max_line_length
+        # the parts of the current, unterminated, line
+        self._partial: List[str] = []
+        self._partial_length = 0
+        # wether the last chunk ended with "\r", which may be followed by "\n" in the next one
+        self._cr = False
+
+    def decode(self, data: Union[bytes, str]) -> str:
+        """Decode a chunk of the stream; text is returned as is."""
+
+        if isinstance(data, str):
+            return data
+        return self._decoder.decode(data)
+
+    def _split_long(self, line: str) -> List[str]:
+        size = self.max_line_length
+        return [line[i : i + size] for i in range(0, len(line), size)]  # noqa: E203
+
+    def split(self, text: str) -> List[str]:
+        """Returns the lines completed by `text`, keeping any unterminated line for later."""
+
+        if "\r" in text or self._cr:
+            if self._cr and text.startswith("\n"):
+                text = text[1:]
+            self._cr = text.endswith("\r")
+            text = text.replace("\r\n", "\n").replace("\r", "\n")
+
+        parts = text.split("\n")
+        rest = parts.pop()
+        if parts:
+            if self._partial:
+                parts[0] = "".join(self._partial) + parts[0]
+                self._partial = []
+                self._partial_length = 0
+            if any(len(line) > self.max_line_length for line in parts):
+                parts = [piece for line in parts for piece in self._split_long(line) or [""]]
+
+        if rest:
+            self._partial.append(rest)
+            self._partial_length += len(rest)
+            if self._partial_length > self.max_line_length:
+                pieces = self._split_long("".join(self._partial))
+                self._partial = [pieces.pop()]
+                self._partial_length = len(self._partial[0])
+                parts.extend(pieces)
+
+        return parts
+
+    def feed(self, data: Union[bytes, str]) -> List[str]:
+        """Decode a chunk of the stream and return the lines it completed."""
+
+        return self.split(self.decode(data))
+
+    def partial_endswith(self, suffix: str) -> bool:
+        """Wether the current unterminated line ends with `suffix` (e.g. a prompt)."""
+
+        tail = ""
+        for part in reversed(self._partial):
+            tail = part + tail
+            if len(tail) >= len(suffix):
+                break
+        return tail.endswith(suffix)
+
+    def take_partial(self) -> str:
+        """Returns and forgets the current unterminated line."""
+
+        partial = "".join(self._partial)
+        self._partial = []
+        self._partial_length = 0
+        return partial
+
+    def close(self) -> List[str]:
+        """Signal the end of the stream and return its last lines, if any."""
+
+        lines = self.split(self._decoder.decode(b"", final=True))
+        partial = self.take_partial()
+        if partial:
+            lines.append(partial)
+        return lines
+
+
+class OutputBuffer:
+    """Keep the last `max_length` characters of a stream of text; `None` keeps all of it."""
+
+    def __init__(self, max_length: Optional[int]):
+        self.max_length = max_length
+        self._chunks: Deque[str] = collections.deque()
+        self._length = 0
+
+    def append(self, text: str):
+        if not text:
+            return
+        self._chunks.append(text)
+        self._length += len(text)
+        if self.max_length is None:
+            return
+
+        excess = self._length - self.max_length
+        while excess > 0:
+            first = self._chunks[0]
+            if len(first) <= excess:
+                self._chunks.popleft()
+            else:
+                self._chunks[0] = first[excess:]
+            removed = min(len(first), excess)
+            self._length -= removed
+            excess -= removed
+
+    def getvalue(self) -> str:
+        return "".join(self._chunks)
+
+
+def new_event_loop() -> asyncio.AbstractEventLoop:
+    """Create an event loop of the implementation selected with `env.event_loop`."""
+
+    if env.event_loop in ("uvloop", "auto"):
         try:
-            i = data.index("\n", start)
-        except ValueError:
-            break
-        line = data[start:i]
-        line.rstrip("\r")
-        lines.append(line)
-        start = i + 1
+            import uvloop
+        except ImportError:
+            if env.event_loop == "uvloop":
+                log.warning("uvloop is not installed, using the asyncio event loop")
+        else:
+            return uvloop.new_event_loop()
+    elif env.event_loop != "asyncio":
+        raise ValueError(f"unknown event loop: {env.event_loop}")
+
+    return asyncio.new_event_loop()
+
 
-    if start < length:
-        return (lines, data[start:])
+def get_loop(create=True) -> Optional[asyncio.AbstractEventLoop]:
+    """Returns the event loop of the current thread.
+
+    Each thread gets its own event loop, created on first use (unless `create` is `False`) and
+    re-used by all the following calls; a closed loop is replaced by a new one.
+    """
 
-    return (lines, "")
+    loop = getattr(_thread_state, "loop", None)
+    if (loop is None or loop.is_closed()) and create:
+        loop = new_event_loop()
+        asyncio.set_event_loop(loop)
+        _thread_state.loop = loop
+    return loop
 
 
 def run_in_loop(future):
-    """Run a co-routine in the default event loop"""
+    """Run a co-routine in the event loop of the current thread"""
 
+    loop = get_loop()
     try:
-        result = asyncio.get_event_loop().run_until_complete(future)
+        if env.profile:
+            from .profiling import run_profiled
+
+            result = run_profiled(loop, future)
+        else:
+            result = loop.run_until_complete(future)
     except Exception as ex:
-        print("Exception: {}".format(ex))
+        get_renderer().message("Exception: {}".format(ex))
         raise
+    finally:
+        get_renderer().flush()
 
     return result
 
 
-async def read_from_stream(stream, writer, label, maxlen=10, decode=False, echo=True):
-    buf = collections.deque(maxlen=maxlen)
-    trail = ""
+def iter_in_loop(agen):
+    """Iterate over the asynchronous generator `agen` in the event loop of the current thread."""
+
+    loop = get_loop()
+    try:
+        while True:
+            try:
+                item = loop.run_until_complete(agen.__anext__())
+            except StopAsyncIteration:
+                return
+            yield item
+    finally:
+        try:
+            loop.run_until_complete(agen.aclose())
+        except RuntimeError:
+            # the generator was interrupted while running (e.g. by a KeyboardInterrupt)
+            pass
+
+
+async def read_from_stream(stream, writer, label, full_output=False, echo=True):
+    buf = OutputBuffer(None if full_output else env.max_output_length)
+    decoder = LineDecoder()
+    renderer = get_renderer()
+    echo = echo and not env.quiet
 
     while True:
-        data = await stream.read(1024)
-        if decode:
-            data = data.decode("utf-8")
-        if data == "":
+        data = await stream.read(env.read_size)
+        if not data:
             break
 
-        buf.append(data)
+        text = decoder.decode(data)
+        buf.append(text)
 
-        if trail:
-            data = trail + data
-            trail = ""
-
-        lines, rest = split_lines(data)
+        lines = decoder.split(text)
         if echo:
-            for line in lines:
-                print(f"[{label}] {line}")
+            renderer.output(label, lines)
 
-            if rest:
-                trail += rest
+    lines = decoder.close()
+    if echo:
+        renderer.output(label, lines)
 
-    output = "".join(list(buf))
-    return output
+    return buf.getvalue()
 
 
-async def connect_streams(stream_in, stream_out):
-    while True:
-        buf = await stream_in.read(4096)
-        if buf == "":
+async def _write(writer, data):
+    writer.write(data)
+    await writer.drain()
+
+
+async def tee_streams(reader, writers, read_size: Optional[int] = None) -> List[int]:
+    """Copy everything read from `reader` to all the `writers` and close them at the end.
+
+    The next chunk of `read_size` bytes (default: `env.read_size`) is read only when all the writers
+    have drained the previous one, so the slowest writer throttles the reader and the buffers stay
+    bounded. A writer that fails is dropped and closed, while the others keep going.
+
+    Returns the number of bytes written to each writer.
+    """
+
+    written = [0] * len(writers)
+    active = list(range(len(writers)))
+
+    while active:
+        data = await reader.read(read_size or env.read_size)
+        if not data:
             break
 
-        await stream_out.write(buf)
+        results = await asyncio.gather(
+            *[_write(writers[i], data) for i in active], return_exceptions=True
+        )
+        for i, result in zip(list(active), results):
+            if isinstance(result, Exception):
+                log.warning(f"Stopped writing to stream {i}: {result!r}")
+                active.remove(i)
+                # a dropped writer gets no EOF: close it, or whoever waits on the other end hangs
+                writers[i].close()
+            else:
+                written[i] += len(data)
+
+    for i in active:
+        writers[i].write_eof()
+
+    return written
+
+
+async def connect_streams(stream_in, stream_out):
+    """Copy everything read from `stream_in` to `stream_out`, see :func:`tee_streams`."""
+
+    written = await tee_streams(stream_in, [stream_out])
+    return written[0]
@@ -10,7 +10,7 @@ setup(
     url="https://github.com/piger/fox",
     license="BSD-2-Clause",
     python_requires=">=3.7",
-    install_requires=["asyncssh[libnacl]", "tqdm", "dataclasses;python_version<'3.7'"],
+    install_requires=["asyncssh[libnacl]", "dataclasses;python_version<'3.7'"],
     tests_require=["pytest"],
     extras_require={
         "dev": ["tox", "pytest", "sphinx", "sphinx_rtd_theme"],
@@ -0,0 +1,36 @@
+import asyncssh
+import pytest
+
+
+class SSHServer(asyncssh.SSHServer):
+    """A SSH server that lets any user in without authentication."""
+
+    def begin_auth(self, username):
+        return False
+
+
+@pytest.fixture
+def ssh_server():
+    """Returns a co-routine that starts a SSH server on a free port and returns the port.
+
+    Its keyword arguments are passed to :func:`asyncssh.create_server`, e.g. `process_factory`,
+    and `server_factory` replaces the default server class; the servers are closed at the end of
+    the test, even when it fails.
+    """
+
+    servers = []
+
+    async def start(server_factory=SSHServer, **kwargs):
+        server = await asyncssh.create_server(
+            server_factory,
+            host="127.0.0.1",
+            port=0,
+            server_host_keys=[asyncssh.generate_private_key("ssh-ed25519")],
+            **kwargs,
+        )
+        servers.append(server)
+        return server.get_port()
+
+    yield start
+    for server in servers:
+        server.close()
@@ -0,0 +1,39 @@
+import time
+from fox.api import local, local_concurrent
+from fox.connection import HostTimeout
+
+
+def test_local_environ(tmp_path, monkeypatch):
+    monkeypatch.setenv("FOX_INHERITED", "yes")
+
+    result = local("sh -c 'echo $FOX_INHERITED $FOX_TEST; pwd'", cd=str(tmp_path), echo=False)
+    assert result.exit_code == 0
+    assert result.stdout == f"yes\n{tmp_path}\n"
+    assert result.duration > 0
+
+    result = local("sh -c 'echo $FOX_INHERITED $FOX_TEST'", environ={"FOX_TEST": "1"}, echo=False)
+    assert result.stdout == "yes 1\n"
+
+    result = local(
+        "/bin/sh -c 'echo $FOX_INHERITED $FOX_TEST'",
+        environ={"FOX_TEST": "1"},
+        env_inherit=False,
+        echo=False,
+    )
+    assert result.stdout == "1\n"
+
+
+def test_local_concurrent():
+    commands = [f"sh -c 'sleep 0.3; echo {i}'" for i in range(4)]
+
+    started = time.monotonic()
+    results = local_concurrent(commands + ["sleep 10", "/nonexistent"], limit=6, timeout=1)
+    assert time.monotonic() - started < 2
+
+    assert [result.stdout for result in results[:4]] == ["0\n", "1\n", "2\n", "3\n"]
+    assert isinstance(results[4], HostTimeout)
+    assert isinstance(results[5], FileNotFoundError)
+
+    started = time.monotonic()
+    results = local_concurrent(commands, limit=2, echo=False)
+    assert 0.6 <= time.monotonic() - started < 1.2
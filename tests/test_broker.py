@@ -0,0 +1,80 @@
+import os
+import stat
+import socket
+import asyncio
+import pytest
+import fox.conf
+from fox.conf import env
+from fox.broker import Broker, BrokerConnection, BrokerError, is_alive, _request_password
+from fox.connection import Connection, SudoPasswordError, _get_connection
+
+
+def process_factory(process):
+    process.stdout.write(f"ran {process.command}\n")
+    process.exit(3)
+
+
+@pytest.mark.asyncio
+async def test_broker_run(tmp_path, monkeypatch, ssh_server):
+    port = await ssh_server(process_factory=process_factory, sftp_factory=True)
+    config_path = tmp_path / "config"
+    config_path.write_text(f"Host testhost\n  HostName 127.0.0.1\n  Port {port}\n")
+    monkeypatch.setattr(env, "ssh_config_path", str(config_path))
+    monkeypatch.setattr(env, "use_known_hosts", False)
+    monkeypatch.setattr(fox.conf, "_ssh_config", None)
+
+    socket_path = str(tmp_path / "broker.sock")
+    broker = Broker(socket_path, persist=60)
+    task = asyncio.ensure_future(broker.serve())
+    await asyncio.sleep(0.1)
+    try:
+        assert stat.S_IMODE(os.stat(socket_path).st_mode) == 0o600
+
+        conn = BrokerConnection("testhost", socket_path)
+        for _ in range(2):
+            result = await conn._run("uptime", echo=False)
+            assert result.exit_code == 3
+            assert result.stdout == "ran uptime\n"
+            assert result.hostname == "testhost"
+
+        with pytest.raises(BrokerError):
+            await BrokerConnection("unknown.invalid", socket_path)._run("uptime")
+
+        # streaming reads go through the broker too
+        remotefile = tmp_path / "remote.log"
+        remotefile.write_text("".join(f"line {i}\n" for i in range(1000)))
+        lines = [line async for line in conn._read_iter(str(remotefile), 1024, -100, lines=True)]
+        assert lines == [f"line {i}" for i in range(989, 1000)]
+        data = b"".join([chunk async for chunk in conn._read_iter(str(remotefile), 1024)])
+        assert data == remotefile.read_bytes()
+        with pytest.raises(BrokerError):
+            async for chunk in conn._read_iter(str(tmp_path / "missing.log")):
+                pass
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+
+def test_broker_stale_socket(tmp_path, monkeypatch):
+    # a socket file left by a dead broker: connections don't go through it
+    socket_path = str(tmp_path / "broker.sock")
+    with socket.socket(socket.AF_UNIX) as sock:
+        sock.bind(socket_path)
+    monkeypatch.setattr(env, "broker_path", socket_path)
+    monkeypatch.setattr(env, "use_ssh_config", False)
+    monkeypatch.setattr(env, "username", "fox")
+    monkeypatch.setattr(env, "port", 22)
+    assert not is_alive(socket_path)
+
+    conn = _get_connection("stalehost", use_cache=False)
+    assert type(conn) is Connection
+
+
+def test_broker_sudo_password():
+    # the broker never prompts: a missing or wrong password is an error for the client
+    with pytest.raises(SudoPasswordError):
+        _request_password(None)(False)
+    password = _request_password("secret")
+    assert password(False) == "secret"
+    with pytest.raises(SudoPasswordError):
+        password(True)
@@ -0,0 +1,76 @@
+import json
+import pytest
+from fox.conf import env
+from fox.cluster import Cluster, HostCancelled, _make_batches
+from fox.transport import SimulatedTransport
+
+
+@pytest.fixture
+def simulated(monkeypatch):
+    # the hosts that refuse the connections fail right away, while the others are still running
+    transport = SimulatedTransport(failure_rate=0.2, duration=0.5, seed=1)
+    monkeypatch.setattr(env, "transport", transport)
+    monkeypatch.setattr(env, "use_ssh_config", False)
+    monkeypatch.setattr(env, "username", "fox")
+    monkeypatch.setattr(env, "port", 22)
+    return transport
+
+
+def test_make_batches():
+    hosts = [f"web{i}" for i in range(10)]
+    tests = [
+        ({}, [hosts]),
+        ({"canary": 1}, [hosts[:1], hosts[1:]]),
+        ({"batch_size": 4}, [hosts[:4], hosts[4:8], hosts[8:]]),
+        ({"canary": 2, "batch_size": "50%"}, [hosts[:2], hosts[2:7], hosts[7:]]),
+        ({"batch_size": "1%"}, [[host] for host in hosts]),
+    ]
+
+    for kwargs, expected in tests:
+        assert _make_batches(hosts, **kwargs) == expected
+
+
+@pytest.mark.asyncio
+async def test_canary_abort(simulated, tmp_path):
+    hosts = [f"host{i}" for i in range(100)]
+    failing = [host for host in hosts if simulated.fails(host, 22)]
+    working = [host for host in hosts if not simulated.fails(host, 22)]
+    canary = [failing[0]] + working[:4]
+    output = str(tmp_path / "results.jsonl")
+
+    async with Cluster(*canary, *working[4:10]) as cluster:
+        results = await cluster._run("uptime", 0, None, None, len(canary), output=output)
+
+    assert cluster.aborted
+    assert cluster.batches == [canary]
+    assert sorted(cluster.cancelled) == sorted(working[:4])
+    assert dict(results)[failing[0]].__class__ is ConnectionRefusedError
+    assert sorted(nickname for nickname, _ in results) == sorted(canary)
+    for host in working[:4]:
+        assert isinstance(dict(results)[host], HostCancelled)
+
+    with open(output) as fd:
+        records = [json.loads(line) for line in fd]
+    assert sorted(record["host"] for record in records) == sorted(canary)
+    assert all(record["error"] for record in records)
+
+
+@pytest.mark.asyncio
+async def test_max_failures_abort(simulated, tmp_path):
+    hosts = [f"host{i}" for i in range(40)]
+    output = str(tmp_path / "results.jsonl")
+
+    async with Cluster(*hosts) as cluster:
+        results = await cluster._run("uptime", 0, None, None, 0, 10, 0.1, output=output)
+
+    assert cluster.aborted
+    assert len(cluster.batches) < 4
+    started = [host for batch in cluster.batches for host in batch]
+    # every host that was started is reported, once
+    assert sorted(nickname for nickname, _ in results) == sorted(started)
+    assert cluster.cancelled
+    for nickname in cluster.cancelled:
+        assert isinstance(dict(results)[nickname], HostCancelled)
+
+    with open(output) as fd:
+        assert sorted(json.loads(line)["host"] for line in fd) == sorted(started)
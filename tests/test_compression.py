@@ -0,0 +1,53 @@
+import asyncio
+import pytest
+from fox.compression import compress_command, DecompressingReader
+
+
+OUTPUT = "".join(f"line {n} of a quite compressible output\n" for n in range(20000))
+
+
+async def _run_wrapped(command, method="gzip"):
+    proc = await asyncio.create_subprocess_shell(
+        compress_command(command, method), stdout=asyncio.subprocess.PIPE
+    )
+    reader = DecompressingReader(proc.stdout)
+    chunks = []
+    while True:
+        data = await reader.read(65536)
+        if not data:
+            break
+        chunks.append(data)
+    await proc.wait()
+    return b"".join(chunks).decode(), proc.returncode, reader.wire_bytes
+
+
+@pytest.mark.asyncio
+async def test_compressed_output(tmp_path):
+    path = tmp_path / "output"
+    path.write_text(OUTPUT)
+
+    output, exit_code, wire_bytes = await _run_wrapped(f"cat {path}; exit 3")
+    assert output == OUTPUT
+    assert exit_code == 3
+    assert wire_bytes < len(OUTPUT) / 5
+
+    output, exit_code, _ = await _run_wrapped("echo \"it's quoted\" && true")
+    assert output == "it's quoted\n"
+    assert exit_code == 0
+
+
+@pytest.mark.asyncio
+async def test_uncompressed_output():
+    class Stream:
+        def __init__(self, chunks):
+            self.chunks = chunks
+
+        async def read(self, n=-1):
+            return self.chunks.pop(0) if self.chunks else b""
+
+    reader = DecompressingReader(Stream([b"none\nhello", b" world\n"]))
+    assert await reader.read() + await reader.read() == b"hello world\n"
+
+    # output of a command that wasn't wrapped is returned as is
+    reader = DecompressingReader(Stream([b"hello", b" world\n", b"bye\n"]))
+    assert await reader.read() + await reader.read() == b"hello world\nbye\n"
@@ -0,0 +1,27 @@
+from fox.conf import env, transport_options
+
+
+def test_transport_options():
+    ssh_options = {
+        "ciphers": "aes128-gcm@openssh.com,aes256-ctr",
+        "macs": "+hmac-sha1",
+        "compression": "yes",
+        "serveraliveinterval": "15",
+        "connecttimeout": "5",
+    }
+
+    options = transport_options(ssh_options)
+    assert options == {
+        "encryption_algs": "aes128-gcm@openssh.com,aes256-ctr",
+        "mac_algs": "+hmac-sha1",
+        "compression_algs": ["zlib@openssh.com", "zlib", "none"],
+        "keepalive_interval": 15,
+    }
+
+    env.transport_profile = "lan"
+    try:
+        options = transport_options(ssh_options)
+    finally:
+        env.transport_profile = None
+    assert options["encryption_algs"] == ["aes128-gcm@openssh.com", "aes128-ctr"]
+    assert options["compression_algs"] == ["none"]
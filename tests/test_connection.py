@@ -3,7 +3,7 @@ import asyncssh
 import pytest
 from fox.conf import env
 from fox.api import run
-from fox.connection import Connection
+from fox.connection import Connection, HostTimeout
 from fox.utils import run_in_loop
 
 
@@ -57,3 +57,29 @@ async def test_run_command():
     assert capture["command"] == """cd "/tmp" && uname -a"""
     server.close()
     return True
+
+
+@pytest.mark.asyncio
+async def test_run_command_timeout():
+    async def process_factory(process):
+        await asyncio.sleep(10)
+        process.exit(0)
+
+    server_key = asyncssh.generate_private_key("ssh-rsa")
+    key = asyncssh.generate_private_key("ssh-rsa")
+
+    server = await asyncssh.create_server(
+        server_factory,
+        host="127.0.0.1",
+        port=SSH_SERVER_PORT + 1,
+        server_host_keys=[server_key],
+        process_factory=process_factory,
+    )
+
+    env.use_ssh_config = False
+    env.use_known_hosts = False
+    conn = Connection("localhost", "pippo", SSH_SERVER_PORT + 1, private_key=key)
+    with pytest.raises(HostTimeout) as excinfo:
+        await conn._run("sleep 10", timeout=0.2)
+    assert excinfo.value.phase == "run"
+    server.close()
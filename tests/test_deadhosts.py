@@ -0,0 +1,90 @@
+import time
+import socket
+import asyncssh
+import pytest
+import fox.deadhosts
+from fox.conf import env
+from fox.connection import Connection, HostTimeout, HostUnreachable
+from fox.deadhosts import DeadHostCache
+
+
+class RejectingSSHServer(asyncssh.SSHServer):
+    """A SSH server that rejects every user."""
+
+    def begin_auth(self, username):
+        return True
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def dead_hosts(monkeypatch):
+    cache = DeadHostCache(60)
+    monkeypatch.setattr(fox.deadhosts, "_dead_hosts", cache)
+    monkeypatch.setattr(env, "dead_host_ttl", 60)
+    monkeypatch.setattr(env, "dead_host_probe_timeout", 1.0)
+    monkeypatch.setattr(env, "use_known_hosts", False)
+    return cache
+
+
+def test_dead_host_cache(tmp_path):
+    path = str(tmp_path / "dead_hosts.json")
+
+    cache = DeadHostCache(60, path)
+    cache.record_failure("web1.example.com", 22, "Connection refused")
+    cache.record_failure("web2.example.com", 22, "Connection refused")
+    cache.record_success("web2.example.com", 22)
+    cache.save()
+
+    cache = DeadHostCache(60, path)
+    assert cache.failure("web1.example.com", 22) == "Connection refused"
+    assert cache.failure("web1.example.com", 2222) is None
+    assert cache.failure("web2.example.com", 22) is None
+
+    cache._entries["web1.example.com:22"] = (time.time() - 120, "Connection refused")
+    assert cache.failure("web1.example.com", 22) is None
+
+
+@pytest.mark.asyncio
+async def test_connect_refused(dead_hosts):
+    port = _free_port()
+
+    with pytest.raises(OSError):
+        await Connection("127.0.0.1", "fox", port)._connect()
+    assert dead_hosts.failure("127.0.0.1", port) is not None
+
+    # the probe fails too: the host is still unreachable
+    with pytest.raises(HostUnreachable):
+        await Connection("127.0.0.1", "fox", port)._connect()
+
+
+@pytest.mark.asyncio
+async def test_connect_timeout(dead_hosts):
+    # accepts the TCP connections, but never answers
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        sock.listen()
+        port = sock.getsockname()[1]
+
+        with pytest.raises(HostTimeout):
+            await Connection("127.0.0.1", "fox", port, connect_timeout=0.2)._connect()
+    assert dead_hosts.failure("127.0.0.1", port) == "connection timed out"
+
+
+@pytest.mark.asyncio
+async def test_connect_auth_error(dead_hosts, ssh_server):
+    port = await ssh_server(server_factory=RejectingSSHServer)
+
+    # authentication errors don't mark the host as dead
+    with pytest.raises(asyncssh.PermissionDenied):
+        await Connection("127.0.0.1", "fox", port)._connect()
+    assert dead_hosts.failure("127.0.0.1", port) is None
+
+    # a host that came back is probed and connected to again
+    dead_hosts.record_failure("127.0.0.1", port, "Connection refused")
+    with pytest.raises(asyncssh.PermissionDenied):
+        await Connection("127.0.0.1", "fox", port)._connect()
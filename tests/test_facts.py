@@ -0,0 +1,139 @@
+import time
+import asyncio
+import pytest
+from fox import facts
+from fox.api import _local
+from fox.conf import env
+from fox.connection import Connection
+from fox.facts import FactsCache, gather_command, parse_output
+
+
+class LocalConnection(Connection):
+    """A connection that runs the commands locally and counts them."""
+
+    commands = 0
+
+    async def _run(self, command, *args, **kwargs):
+        self.commands += 1
+        return await _local(command, echo=False)
+
+
+class ChunkedStream:
+    """Return the output of a local process in small chunks, like packets from the network."""
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    async def read(self, n=-1):
+        await asyncio.sleep(0.001)
+        return await self.stream.read(100)
+
+
+class LocalProcess:
+    def __init__(self, proc):
+        self.proc = proc
+        self.stdin = proc.stdin
+        self.stdout = ChunkedStream(proc.stdout)
+        self.stderr = ChunkedStream(proc.stderr)
+
+    @property
+    def exit_status(self):
+        return self.proc.returncode
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.proc.wait()
+
+
+class LocalSSHConnection:
+    """Run the commands of a connection locally."""
+
+    commands = 0
+
+    async def create_process(self, command, **kwargs):
+        self.commands += 1
+        pipe = asyncio.subprocess.PIPE
+        proc = await asyncio.create_subprocess_shell(command, stdin=pipe, stdout=pipe, stderr=pipe)
+        return LocalProcess(proc)
+
+
+def test_facts_cache(tmp_path):
+    path = str(tmp_path / "facts.json")
+
+    cache = FactsCache(60, path)
+    cache.update("web1", {"nproc": 4, "kernel": "6.1.0"})
+    cache.update("web2", {"nproc": 8})
+    cache.invalidate("web2")
+    cache.save()
+
+    cache = FactsCache(60, path)
+    assert cache.get("web1", ["nproc", "kernel", "arch"]) == {"nproc": 4, "kernel": "6.1.0"}
+    assert cache.get("web2", ["nproc"]) == {}
+
+    cache.invalidate("web1", ["kernel"])
+    assert cache.get("web1", ["nproc", "kernel"]) == {"nproc": 4}
+
+    cache._entries["web1"]["nproc"] = (time.time() - 120, 4)
+    assert cache.get("web1", ["nproc"]) == {}
+
+
+@pytest.mark.asyncio
+async def test_gather_facts(monkeypatch):
+    monkeypatch.setattr(facts, "_facts_cache", None)
+    monkeypatch.setattr(env, "facts_cache_path", None)
+    monkeypatch.setitem(facts.FACTS, "lines", facts.Fact("printf 'a\\nb\\n'", str.split))
+    monkeypatch.setitem(facts.FACTS, "broken", facts.Fact("echo oops; false"))
+    monkeypatch.setitem(facts.FACTS, "bad_parser", facts.Fact("echo x", lambda output: {}[output]))
+
+    command, boundary = gather_command(["nproc", "lines", "broken", "bad_parser"])
+    result = await _local(command, echo=False)
+    gathered = parse_output(result.stdout, boundary)
+    assert isinstance(gathered["nproc"], int)
+    assert gathered["lines"] == ["a", "b"]
+    assert gathered["broken"] is None
+    assert gathered["bad_parser"] is None
+
+    conn = LocalConnection("localhost", "fox", 22)
+    first = await conn._facts(["nproc", "lines"])
+    assert first == {"nproc": gathered["nproc"], "lines": ["a", "b"]}
+    assert conn.commands == 1
+
+    # cached facts are not gathered again, the missing ones all at once
+    assert (await conn._facts(["lines", "nproc", "arch", "kernel"]))["lines"] == ["a", "b"]
+    assert conn.commands == 2
+    await conn._facts(["arch", "nproc"])
+    assert conn.commands == 2
+
+    conn.invalidate_facts(["nproc"])
+    await conn._facts(["arch", "nproc"])
+    assert conn.commands == 3
+    await conn._facts(["arch"], refresh=True)
+    assert conn.commands == 4
+
+    # failed facts are not cached
+    assert (await conn._facts(["broken", "arch"]))["broken"] is None
+    assert conn.commands == 5
+    await conn._facts(["broken", "arch"])
+    assert conn.commands == 6
+
+
+@pytest.mark.asyncio
+async def test_gather_all_facts(monkeypatch):
+    monkeypatch.setattr(facts, "_facts_cache", None)
+    monkeypatch.setattr(env, "facts_cache_path", None)
+    monkeypatch.setattr(env, "max_output_length", 100)
+
+    conn = Connection("localhost", "fox", 22)
+    conn._connection = LocalSSHConnection()
+    result = await conn._facts()
+    assert set(result) == set(facts.FACTS)
+    assert isinstance(result["nproc"], int)
+    assert result["os_release"]
+    assert conn._connection.commands == 1
+
+    # all the facts were gathered, even if the output was truncated
+    assert set(facts.get_facts_cache().get(conn.nickname, facts.FACTS)) == set(facts.FACTS)
+    await conn._facts()
+    assert conn._connection.commands == 1
@@ -0,0 +1,35 @@
+import sys
+import json
+import subprocess
+
+
+# the maximum time, in microseconds, that `import fox.api` may take on top of importing asyncio.
+IMPORT_BUDGET = 150000
+
+# modules that must only be imported when they are first used.
+LAZY_MODULES = ["asyncssh", "fox.sshconfig"]
+
+
+def _import(module):
+    code = f"import asyncio, json, sys; import {module}; print(json.dumps(list(sys.modules)))"
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    cumulative = None
+    for line in proc.stderr.splitlines():
+        fields = [field.strip() for field in line.split("|")]
+        if len(fields) == 3 and fields[2] == module:
+            cumulative = int(fields[1])
+    return json.loads(proc.stdout), cumulative
+
+
+def test_import_api_is_lazy():
+    modules, cumulative = _import("fox.api")
+
+    for module in LAZY_MODULES:
+        assert module not in modules
+    assert cumulative < IMPORT_BUDGET
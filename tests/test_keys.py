@@ -0,0 +1,74 @@
+import os
+import asyncio
+import asyncssh
+import pytest
+from fox.conf import env
+from fox.keys import (
+    load_private_key,
+    load_known_hosts,
+    get_agent_keys,
+    invalidate_agent_keys,
+    close_agents,
+)
+
+
+class FakeAgent:
+    keys = ["key1"]
+    instances = []
+
+    def __init__(self, path):
+        self.listed = 0
+        self.closed = False
+        self.instances.append(self)
+
+    async def get_keys(self):
+        self.listed += 1
+        return list(self.keys)
+
+    def close(self):
+        self.closed = True
+
+
+def test_load_private_key(tmp_path):
+    path = str(tmp_path / "id_ed25519")
+    asyncssh.generate_private_key("ssh-ed25519").write_private_key(path)
+
+    keypairs = load_private_key(path)
+    assert load_private_key(path) is keypairs
+
+    asyncssh.generate_private_key("ssh-ed25519").write_private_key(path)
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000))
+    assert load_private_key(path) is not keypairs
+
+
+def test_load_known_hosts(tmp_path):
+    path = str(tmp_path / "known_hosts")
+    assert load_known_hosts(path) is None
+
+    key = asyncssh.generate_private_key("ssh-ed25519")
+    with open(path, "wb") as fd:
+        fd.write(b"web1.example.com " + key.export_public_key())
+
+    known_hosts = load_known_hosts(path)
+    assert known_hosts is not None
+    assert load_known_hosts(path) is known_hosts
+
+
+@pytest.mark.asyncio
+async def test_agent_keys(monkeypatch):
+    monkeypatch.setattr(asyncssh, "SSHAgentClient", FakeAgent)
+    monkeypatch.setattr(env, "agent_keys_ttl", 60)
+
+    assert await get_agent_keys("/tmp/agent.sock") == ["key1"]
+    monkeypatch.setattr(FakeAgent, "keys", ["key1", "key2"])
+    assert await get_agent_keys("/tmp/agent.sock") == ["key1"]
+
+    # keys added with ssh-add are seen after an invalidation, on the same agent connection
+    invalidate_agent_keys("/tmp/agent.sock")
+    assert await get_agent_keys("/tmp/agent.sock") == ["key1", "key2"]
+    assert len(FakeAgent.instances) == 1
+    assert FakeAgent.instances[0].listed == 2
+
+    close_agents(asyncio.get_event_loop())
+    assert FakeAgent.instances[0].closed
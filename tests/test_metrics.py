@@ -0,0 +1,33 @@
+import json
+import pytest
+from fox import metrics
+
+
+def test_recorder(tmp_path):
+    recorder = metrics.enable()
+    try:
+        for i in range(3):
+            with metrics.span("get", "web1", bytes=0) as stats:
+                stats["bytes"] += 100 * i
+        with pytest.raises(OSError):
+            with metrics.span("get", "web2"):
+                raise OSError("connection lost")
+    finally:
+        metrics.remove_hook(recorder)
+
+    histograms = recorder.histograms()
+    assert histograms["get"]["count"] == 4
+    assert histograms["get"]["errors"] == 1
+    assert histograms["get"]["bytes"] == 300
+    assert recorder.slowest("get", 1)[0].duration == histograms["get"]["max"]
+
+    path = tmp_path / "trace.json"
+    recorder.write_chrome_trace(str(path))
+    events = json.loads(path.read_text())["traceEvents"]
+    assert len([event for event in events if event["ph"] == "X"]) == 4
+    assert {event["args"]["name"] for event in events if event["ph"] == "M"} == {"web1", "web2"}
+
+
+def test_span_without_hooks():
+    with metrics.span("get", "web1", bytes=0) as stats:
+        stats["bytes"] += 1
@@ -0,0 +1,78 @@
+import asyncio
+import hashlib
+import asyncssh
+import pytest
+import fox.conf
+from fox.conf import env
+from fox.cluster import _tee_pipes
+
+
+DATA = bytes(range(256)) * 4096
+
+
+async def process_factory(process):
+    if process.command == "dump":
+        for start in range(0, len(DATA), 65536):
+            process.stdout.write(DATA[start : start + 65536])  # noqa: E203
+            await process.stdout.drain()
+        process.exit(0)
+    elif process.command.startswith("load"):
+        delay = float(process.command.split()[1])
+        digest = hashlib.sha256()
+        while True:
+            data = await process.stdin.read(16384)
+            if not data:
+                break
+            digest.update(data)
+            await asyncio.sleep(delay)
+        process.stdout.write(digest.hexdigest().encode() + b"\n")
+        process.exit(0)
+    else:
+        process.exit(1)
+
+
+@pytest.mark.asyncio
+async def test_tee_pipes(tmp_path, monkeypatch, ssh_server):
+    port = await ssh_server(process_factory=process_factory, encoding=None)
+    # accepts the connections but refuses to open sessions
+    refusing_port = await ssh_server()
+
+    config_path = tmp_path / "config"
+    config_path.write_text(
+        "Host down\n  HostName 127.0.0.1\n  Port 1\n"
+        f"Host refusing\n  HostName 127.0.0.1\n  Port {refusing_port}\n"
+        f"Host *\n  HostName 127.0.0.1\n  Port {port}\n  User fox\n"
+    )
+    monkeypatch.setattr(env, "ssh_config_path", str(config_path))
+    monkeypatch.setattr(env, "use_ssh_config", True)
+    monkeypatch.setattr(env, "use_known_hosts", False)
+    monkeypatch.setattr(fox.conf, "_ssh_config", None)
+
+    source, results = await _tee_pipes("primary", "dump", ["fast", "slow"], "load 0")
+    assert source.exit_code == 0
+    for pipe in results:
+        assert pipe.bytes == len(DATA)
+        assert pipe.result.stdout == hashlib.sha256(DATA).hexdigest() + "\n"
+        assert pipe.throughput > 0
+
+    # a destination that fails is dropped, the others get all the data
+    source, results = await _tee_pipes("primary", "dump", ["replica1", "down"], "load 0.001")
+    assert results[0].bytes == len(DATA)
+    assert isinstance(results[1].result, OSError)
+    source, results = await _tee_pipes("primary", "dump", ["replica1"], "fail")
+    assert results[0].result.exit_code == 1
+    assert results[0].bytes < len(DATA)
+
+    # so is a destination that fails to open its channel
+    source, results = await _tee_pipes("primary", "dump", ["refusing", "replica1"], "load 0")
+    assert isinstance(results[0].result, asyncssh.ChannelOpenError)
+    assert results[0].bytes == 0
+    assert results[1].bytes == len(DATA)
+    assert results[1].result.stdout == hashlib.sha256(DATA).hexdigest() + "\n"
+
+    # the same host can be given more than once
+    source, results = await _tee_pipes("primary", "dump", ["replica1", "replica1"], "load 0")
+    assert len(results) == 2
+    for pipe in results:
+        assert pipe.bytes == len(DATA)
+        assert pipe.result.stdout == hashlib.sha256(DATA).hexdigest() + "\n"
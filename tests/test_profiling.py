@@ -0,0 +1,42 @@
+import time
+import asyncio
+from fox import metrics
+from fox.conf import env
+from fox.utils import run_in_loop
+
+
+async def _blocking_host(nickname):
+    metrics.current_host.set(nickname)
+    with metrics.span("host", nickname):
+        await asyncio.sleep(0.1)
+        # block the event loop
+        time.sleep(0.2)
+
+
+def test_profile_lag(tmp_path):
+    report_path = tmp_path / "profile.txt"
+    env.profile = "lag"
+    env.profile_report_path = str(report_path)
+    try:
+        run_in_loop(_blocking_host("web1"))
+    finally:
+        env.profile = None
+        env.profile_report_path = None
+
+    report = report_path.read_text()
+    assert "=== fox profile (lag)" in report
+    assert "slow callbacks: 1" in report
+    assert "web1: 0.3" in report
+
+
+def test_profile_cprofile(tmp_path):
+    report_path = tmp_path / "profile.txt"
+    env.profile = "cprofile"
+    env.profile_report_path = str(report_path)
+    try:
+        run_in_loop(_blocking_host("web1"))
+    finally:
+        env.profile = None
+        env.profile_report_path = None
+
+    assert "_blocking_host" in report_path.read_text()
@@ -0,0 +1,112 @@
+import io
+import asyncio
+import threading
+import pytest
+from fox.conf import env
+from fox.render import Renderer
+from fox.utils import run_in_loop
+
+
+class Stream(io.StringIO):
+    def __init__(self, tty=False):
+        super().__init__()
+        self.tty = tty
+        self.writes = 0
+
+    def write(self, data):
+        self.writes += 1
+        return super().write(data)
+
+    def isatty(self):
+        return self.tty
+
+
+def test_batched_output(monkeypatch):
+    monkeypatch.setattr(env, "render_interval", 60)
+    stream = Stream()
+    renderer = Renderer(stream, Stream())
+    renderer.flush()
+
+    renderer.output("web1", ["a", "b"])
+    renderer.message("done")
+    renderer.output("web2", ["c"])
+    assert stream.getvalue() == ""
+
+    renderer.flush()
+    assert stream.getvalue() == "[web1] a\n[web1] b\ndone\n[web2] c\n"
+    assert stream.writes == 1
+
+
+def test_quiet(monkeypatch):
+    monkeypatch.setattr(env, "quiet", True)
+    stream = Stream()
+    status_stream = Stream(tty=True)
+    renderer = Renderer(stream, status_stream)
+
+    renderer.output("web1", ["a"])
+    progress = renderer.progress("file", 100, unit="B")
+    progress.update(50)
+    renderer.message("failed")
+    renderer.flush()
+    assert stream.getvalue() == "failed\n"
+    assert status_stream.getvalue() == ""
+    progress.close()
+
+
+def test_progress(monkeypatch):
+    monkeypatch.setattr(env, "render_interval", 60)
+    status_stream = Stream(tty=True)
+    renderer = Renderer(Stream(), status_stream)
+
+    first = renderer.progress("first", 1000, unit="B")
+    second = renderer.progress("second", 3000, initial=1000, unit="B")
+    hosts = renderer.progress("hosts", 10)
+    first.set(1000)
+    hosts.update(3)
+    renderer.flush()
+    assert "2 transfers 2.0KB/4.0KB 50%" in status_stream.getvalue()
+    assert status_stream.getvalue().split("|")[-1].startswith(" hosts 3/10")
+    assert renderer.transferred == 1000
+
+    for progress in (first, second, hosts):
+        progress.close()
+    # the status line is cleared when all the progress is done
+    assert status_stream.getvalue().endswith("\r\x1b[K")
+
+
+@pytest.mark.asyncio
+async def test_rate_limited_flush(monkeypatch):
+    monkeypatch.setattr(env, "render_interval", 0.05)
+    stream = Stream()
+    renderer = Renderer(stream, Stream())
+    renderer.flush()
+
+    for n in range(100):
+        renderer.output("web1", [str(n)])
+    assert stream.writes == 0
+    await asyncio.sleep(0.1)
+    assert stream.writes == 1
+    assert len(stream.getvalue().splitlines()) == 100
+
+
+def test_threads(monkeypatch):
+    monkeypatch.setattr(env, "render_interval", 0.001)
+    stream = Stream()
+    renderer = Renderer(stream, Stream())
+
+    # each thread writes from its own event loop
+    async def _output(label):
+        for n in range(200):
+            renderer.output(label, [str(n)])
+            await asyncio.sleep(0)
+
+    threads = [
+        threading.Thread(target=run_in_loop, args=(_output(f"web{i}"),)) for i in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    renderer.flush()
+
+    assert len(stream.getvalue().splitlines()) == 8 * 200
@@ -0,0 +1,108 @@
+import socket
+import asyncio
+import threading
+import pytest
+import fox.resolver
+from fox.conf import env
+from fox.connection import Connection
+from fox.resolver import Resolver
+from fox.transport import SimulatedTransport
+from fox.utils import run_in_loop
+
+
+class DualStackTransport(SimulatedTransport):
+    """Refuses the connections to IPv6 addresses, like a host without an IPv6 route."""
+
+    uses_network = True
+
+    def __init__(self):
+        super().__init__()
+        self.attempts = []
+
+    async def connect(self, address, port, nickname, options):
+        self.attempts.append(address)
+        if ":" in address:
+            raise OSError(f"no route to {address}")
+        return await super().connect(address, port, nickname, options)
+
+
+@pytest.mark.asyncio
+async def test_resolve_all():
+    resolver = Resolver(ttl=60, concurrency=2)
+    results = await resolver.resolve_all(["127.0.0.1", "localhost", "localhost", "invalid."])
+
+    assert results["127.0.0.1"] == ["127.0.0.1"]
+    assert "127.0.0.1" in results["localhost"] or "::1" in results["localhost"]
+    assert len(set(results["localhost"])) == len(results["localhost"])
+    assert isinstance(results["invalid."], socket.gaierror)
+    assert "localhost" in resolver._cache
+
+
+@pytest.mark.asyncio
+async def test_connect_tries_all_addresses(monkeypatch):
+    transport = DualStackTransport()
+    resolver = Resolver(ttl=60)
+    resolver._cache["dual.example.com"] = (float("inf"), ["2001:db8::1", "192.0.2.1"])
+    monkeypatch.setattr(env, "transport", transport)
+    monkeypatch.setattr(env, "use_ssh_config", False)
+    monkeypatch.setattr(env, "dead_host_ttl", 0)
+    monkeypatch.setattr(env, "resolver_ttl", 60)
+    monkeypatch.setattr(fox.resolver, "_resolver", resolver)
+
+    connection = Connection("dual.example.com", "fox", 22)
+    await connection._connect()
+    assert connection.connected
+    assert transport.attempts == ["2001:db8::1", "192.0.2.1"]
+    await connection._disconnect()
+
+    connection = Connection("2001:db8::2", "fox", 22)
+    with pytest.raises(OSError):
+        await connection._connect()
+
+
+def test_resolve_in_threads():
+    resolver = Resolver(ttl=0, concurrency=2)
+    results = []
+
+    # each thread resolves in its own event loop, with its own semaphore and lookups in flight
+    def _resolve():
+        for _ in range(20):
+            results.append(run_in_loop(resolver.resolve_all(["localhost", "127.0.0.1"])))
+
+    threads = [threading.Thread(target=_resolve) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(results) == 80
+    assert all(isinstance(result["localhost"], list) for result in results)
+    assert len(resolver._loops) <= 4
+
+
+@pytest.mark.asyncio
+async def test_cancelled_lookup():
+    resolver = Resolver(ttl=60)
+    loop = asyncio.get_event_loop()
+    lookups = []
+
+    async def getaddrinfo(host, port, **kwargs):
+        lookups.append(host)
+        if len(lookups) == 1:
+            await asyncio.sleep(60)
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, "", ("192.0.2.1", port))]
+
+    loop.getaddrinfo = getaddrinfo
+    try:
+        first = asyncio.ensure_future(resolver.resolve("web1.example.com"))
+        await asyncio.sleep(0)
+        second = asyncio.ensure_future(resolver.resolve("web1.example.com"))
+        await asyncio.sleep(0)
+
+        # the task running the shared lookup is cancelled: the others look the host up again
+        first.cancel()
+        assert await asyncio.wait_for(second, 5) == ["192.0.2.1"]
+        assert first.cancelled()
+        assert len(lookups) == 2
+    finally:
+        del loop.getaddrinfo
@@ -0,0 +1,75 @@
+import json
+import pytest
+from fox.conf import env
+from fox.cluster import Cluster
+from fox.results import open_writer
+from fox.transport import SimulatedTransport
+from fox.utils import CommandResult
+
+
+@pytest.mark.asyncio
+async def test_cluster_output(tmp_path, monkeypatch):
+    transport = SimulatedTransport(output_size=10, failure_rate=0.3, seed=2)
+    monkeypatch.setattr(env, "transport", transport)
+    monkeypatch.setattr(env, "use_ssh_config", False)
+    monkeypatch.setattr(env, "username", "fox")
+    monkeypatch.setattr(env, "port", 22)
+    path = tmp_path / "results.jsonl"
+
+    hosts = [f"host{i}" for i in range(50)]
+    async with Cluster(*hosts) as cluster:
+        results = await cluster._run("uptime", output=str(path))
+
+    records = [json.loads(line) for line in path.read_text().splitlines()]
+    assert sorted(record["host"] for record in records) == sorted(hosts)
+    assert sorted(nickname for nickname, _ in results) == sorted(hosts)
+    for record in records:
+        if transport.fails(record["host"], 22):
+            assert record["error"].startswith("ConnectionRefusedError")
+            assert record["exit_code"] is None
+        else:
+            assert record["error"] is None
+            assert record["command"] == "uptime"
+            assert len(record["stdout"]) == 10
+
+    # the outputs are in the file, only the status of the hosts is kept in memory
+    for nickname, result in results:
+        if isinstance(result, CommandResult):
+            assert result.exit_code == 0
+            assert result.stdout == result.stderr == ""
+
+
+def test_parquet_writer(tmp_path):
+    parquet = pytest.importorskip("pyarrow.parquet")
+    path = str(tmp_path / "results.parquet")
+
+    writer = open_writer(path)
+    writer.write("web1", CommandResult("uptime", "uptime", 0, "up\n", "", "web1", duration=0.1))
+    writer.write("web2", OSError("unreachable"))
+    writer.close()
+
+    table = parquet.read_table(path).to_pydict()
+    assert table["host"] == ["web1", "web2"]
+    assert table["exit_code"] == [0, None]
+    assert table["error"] == [None, "OSError: unreachable"]
+
+
+def test_open_writer_format(tmp_path):
+    # the format can be given explicitly, whatever the extension
+    path = str(tmp_path / "results.out")
+    writer = open_writer(path, output_format="jsonl")
+    writer.write("web1", OSError("unreachable"))
+    writer.close()
+    with open(path) as fd:
+        assert json.loads(fd.readline())["host"] == "web1"
+
+    with pytest.raises(ValueError):
+        open_writer(path, output_format="csv")
+
+
+def test_compact_results():
+    results = [
+        CommandResult("uptime", "".join(["env ", "uptime"]), 0, "", "", f"web{i}") for i in range(2)
+    ]
+    assert results[0].actual_command is results[1].actual_command
+    assert not hasattr(results[0], "__dict__")
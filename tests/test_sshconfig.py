@@ -1,4 +1,5 @@
-from fox.sshconfig import match
+import fox.sshconfig
+from fox.sshconfig import match, SSHConfig
 
 
 def test_match():
@@ -9,7 +10,135 @@ def test_match():
         ("web.example.com", ["*.net", "*.???"], True),
         ("web.example.com", ["*.net", "*.??g"], False),
         ("web.example.com", ["*.net", "!*.com", "*.example.com"], False),
+        ("web.example.com", ["*.example.com", "!web.example.com"], False),
+        ("db.example.com", ["*.example.com", "!web.example.com"], True),
+        ("web.example.com", ["!db.example.com"], False),
     ]
 
     for hostname, patterns, result in tests:
         assert match(hostname, patterns) == result
+
+
+def test_lookup(tmp_path):
+    path = tmp_path / "config"
+    path.write_text(
+        """
+Host web1.example.com
+    User deploy
+    Port 2222
+
+Host *.example.com, !db.example.com
+    User admin
+    IdentityFile ~/.ssh/example
+
+Host *
+    Port 22
+    User nobody
+"""
+    )
+
+    config = SSHConfig()
+    config.load(str(path))
+
+    options = config.lookup("web1.example.com")
+    assert options["user"] == "deploy"
+    assert options["port"] == 2222
+    assert options["identityfile"].endswith("/.ssh/example")
+
+    options = config.lookup("db.example.com")
+    assert options["user"] == "nobody"
+    assert "identityfile" not in options
+
+    # lookups are memoized, but each caller gets its own copy
+    options["user"] = "changed"
+    assert config.lookup("db.example.com")["user"] == "nobody"
+
+
+def test_lookup_reload(tmp_path, monkeypatch):
+    monkeypatch.setattr(fox.sshconfig, "CHECK_INTERVAL", 0)
+    path = tmp_path / "config"
+    path.write_text("Host web1\n    User deploy\n")
+    config = SSHConfig()
+    config.load(str(path))
+    assert config.lookup("web1")["user"] == "deploy"
+
+    # the memoized lookups don't outlive a change of the configuration
+    path.write_text("Host web1\n    User admin\n    Port 2222\n")
+    options = config.lookup("web1")
+    assert options["user"] == "admin"
+    assert options["port"] == 2222
+
+
+def test_include_and_match(tmp_path):
+    (tmp_path / "config.d").mkdir()
+    (tmp_path / "config.d" / "10-web").write_text("Host web*\n    User www\n")
+    (tmp_path / "config.d" / "20-db").write_text("Host db*\n    User postgres\n")
+    path = tmp_path / "config"
+    path.write_text(
+        """
+Include config.d/*
+
+Host bastion
+    Include config.d/missing-*
+    HostName bastion.example.com
+
+Match host bastion.example.com
+    User jump
+
+Match !originalhost bastion
+    Port 2222
+"""
+    )
+    cache_path = str(tmp_path / "cache" / "ssh_config.json")
+
+    for _ in range(2):
+        config = SSHConfig()
+        config.load(str(path), cache_path=cache_path)
+
+        assert config.lookup("web1")["user"] == "www"
+        assert config.lookup("db1")["user"] == "postgres"
+        assert config.lookup("db1")["port"] == 2222
+        assert config.lookup("bastion")["user"] == "jump"
+        assert config.lookup("bastion")["port"] == 22
+
+    # adding a file matched by an Include glob invalidates the cache
+    (tmp_path / "config.d" / "00-all").write_text("User root\n")
+    config = SSHConfig()
+    config.load(str(path), cache_path=cache_path)
+    assert config.lookup("web1")["user"] == "root"
+
+
+def test_include_in_host_block(tmp_path):
+    (tmp_path / "jump").write_text("Host *\n    ProxyJump bastion\nHost web*\n    User www\n")
+    path = tmp_path / "config"
+    path.write_text(
+        """
+Host *.internal
+    Include jump
+    Port 2222
+
+Match canonical all
+    User canonical
+
+Match final host db*
+    User final
+"""
+    )
+    cache_path = str(tmp_path / "cache" / "ssh_config.json")
+
+    for _ in range(2):
+        config = SSHConfig()
+        config.load(str(path), cache_path=cache_path)
+
+        # the included blocks apply only to the hosts matched by the including block
+        options = config.lookup("web1.internal")
+        assert options["proxyjump"] == "bastion"
+        assert options["user"] == "www"
+        assert options["port"] == 2222
+        options = config.lookup("web1")
+        assert "proxyjump" not in options
+        assert options["user"] != "www"
+        assert options["port"] == 22
+
+        # canonical and final take no argument, and never match
+        assert config.lookup("db1")["user"] not in ("canonical", "final")
@@ -0,0 +1,126 @@
+import os
+import pytest
+from fox import metrics
+from fox.conf import env
+from fox.connection import Connection
+
+
+DATA = os.urandom(3 * 1024 * 1024 + 123)
+
+
+class FlakyConnection(Connection):
+    """A connection that drops once, when the SFTP session is started."""
+
+    failures = 1
+
+    async def get_sftp_client(self):
+        client = await super().get_sftp_client()
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionResetError("connection dropped")
+        return client
+
+
+def _transferred(recorder, name):
+    return sum(span.attrs["bytes"] for span in recorder.spans if span.name == name)
+
+
+@pytest.mark.asyncio
+async def test_resume_get(tmp_path, monkeypatch, ssh_server):
+    monkeypatch.setattr(env, "use_known_hosts", False)
+    port = await ssh_server(sftp_factory=True)
+    source = tmp_path / "source"
+    source.write_bytes(DATA)
+    destination = tmp_path / "destination"
+    partial = tmp_path / "destination.part"
+    partial.write_bytes(DATA[:1000000])
+
+    recorder = metrics.enable()
+    try:
+        conn = FlakyConnection("127.0.0.1", "fox", port)
+        await conn._get(str(source), str(destination), resume=True)
+
+        # only the missing data is downloaded
+        assert destination.read_bytes() == DATA
+        assert not partial.exists()
+        assert _transferred(recorder, "get") == len(DATA) - 1000000
+
+        # a partial file that doesn't match is downloaded again
+        partial.write_bytes(b"x" * 1000000)
+        recorder.clear()
+        await conn._get(str(source), str(destination), resume=True)
+        assert destination.read_bytes() == DATA
+        assert _transferred(recorder, "get") == len(DATA)
+    finally:
+        metrics.remove_hook(recorder)
+        await conn._disconnect()
+
+
+@pytest.mark.asyncio
+async def test_resume_put(tmp_path, monkeypatch, ssh_server):
+    monkeypatch.setattr(env, "use_known_hosts", False)
+    port = await ssh_server(sftp_factory=True)
+    source = tmp_path / "source"
+    source.write_bytes(DATA)
+    destination = tmp_path / "destination"
+    partial = tmp_path / "destination.part"
+    partial.write_bytes(DATA[:2000000])
+
+    recorder = metrics.enable()
+    try:
+        conn = FlakyConnection("127.0.0.1", "fox", port)
+        await conn._put(str(source), str(destination), resume=True)
+
+        assert destination.read_bytes() == DATA
+        assert not partial.exists()
+        assert _transferred(recorder, "put") == len(DATA) - 2000000
+    finally:
+        metrics.remove_hook(recorder)
+        await conn._disconnect()
+
+
+@pytest.mark.asyncio
+async def test_read_iter(tmp_path, monkeypatch, ssh_server):
+    monkeypatch.setattr(env, "use_known_hosts", False)
+    monkeypatch.setattr(env, "follow_interval", 0.01)
+    port = await ssh_server(sftp_factory=True)
+    path = tmp_path / "log"
+    path.write_bytes(DATA)
+
+    conn = Connection("127.0.0.1", "fox", port)
+    try:
+        chunks = [chunk async for chunk in conn._read_iter(str(path), chunk_size=65536)]
+        assert b"".join(chunks) == DATA
+        assert max(len(chunk) for chunk in chunks) <= 65536
+
+        chunks = [chunk async for chunk in conn._read_iter(str(path), offset=-100)]
+        assert b"".join(chunks) == DATA[-100:]
+
+        # the partial line at the offset is skipped
+        path.write_bytes(b"one\ntwo\nthree\nfour")
+        lines = [line async for line in conn._read_iter(str(path), offset=-12, lines=True)]
+        assert lines == ["three", "four"]
+        # even when it's the last line, without a trailing newline
+        lines = [line async for line in conn._read_iter(str(path), offset=-2, lines=True)]
+        assert lines == []
+
+        # the appended lines are followed, even after the file is truncated
+        follow = conn._read_iter(str(path), offset=-12, lines=True, follow=True)
+        assert await follow.__anext__() == "three"
+        with open(path, "ab") as fd:
+            fd.write(b"\nfive\n")
+        assert await follow.__anext__() == "four"
+        assert await follow.__anext__() == "five"
+        path.write_bytes(b"six\n")
+        assert await follow.__anext__() == "six"
+        await follow.aclose()
+
+        # the partial line of a truncated file is dropped
+        path.write_bytes(b"one\npartial")
+        follow = conn._read_iter(str(path), lines=True, follow=True)
+        assert await follow.__anext__() == "one"
+        path.write_bytes(b"two\n")
+        assert await follow.__anext__() == "two"
+        await follow.aclose()
+    finally:
+        await conn._disconnect()
@@ -0,0 +1,126 @@
+import asyncio
+import weakref
+import threading
+import pytest
+import fox.connection
+from fox.conf import env
+from fox.cluster import Cluster
+from fox.connection import Connection, HostTimeout, _clean_connections
+from fox.transport import SimulatedTransport
+from fox.utils import CommandResult, get_loop, run_in_loop
+
+
+@pytest.fixture
+def simulated(monkeypatch):
+    transport = SimulatedTransport(output_size=100, seed=1)
+    monkeypatch.setattr(env, "transport", transport)
+    monkeypatch.setattr(env, "use_ssh_config", False)
+    monkeypatch.setattr(env, "username", "fox")
+    monkeypatch.setattr(env, "port", 22)
+    return transport
+
+
+@pytest.mark.asyncio
+async def test_simulated_cluster(simulated):
+    simulated.failure_rate = 0.2
+    hosts = [f"host{i}" for i in range(500)]
+
+    async with Cluster(*hosts) as cluster:
+        results = await cluster._run("uptime")
+
+    failed = {
+        nickname for nickname, result in results if isinstance(result, ConnectionRefusedError)
+    }
+    assert failed == {host for host in hosts if simulated.fails(host, 22)}
+    assert 50 < len(failed) < 150
+    for _, result in results:
+        if isinstance(result, CommandResult):
+            assert len(result.stdout) == 100
+
+
+@pytest.mark.asyncio
+async def test_simulated_timeout(simulated):
+    simulated.duration = 10
+
+    async with Cluster("host1", "host2") as cluster:
+        results = await cluster._run("sleep 10", 0, 0.1)
+
+    assert all(isinstance(result, HostTimeout) for _, result in results)
+    assert cluster.timed_out == {"host1": "run", "host2": "run"}
+
+
+@pytest.mark.asyncio
+async def test_simulated_deadline_limit(simulated):
+    simulated.duration = 10
+
+    # with one host at a time, the deadline expires while host1 runs and host2 is still pending
+    async with Cluster("host1", "host2", "host3") as cluster:
+        results = await cluster._run("sleep 10", 1, None, 0.1)
+
+    assert all(isinstance(result, HostTimeout) for _, result in results)
+    assert cluster.timed_out == {"host1": "run", "host2": "pending", "host3": "pending"}
+
+
+@pytest.mark.asyncio
+async def test_simulated_resumable_put(simulated, tmp_path):
+    localfile = tmp_path / "data"
+    localfile.write_bytes(bytes(100000))
+
+    connection = Connection("host1", "fox", 22)
+    sftp_client = await connection.get_sftp_client()
+    assert not await sftp_client.exists("/tmp/data")
+    await connection._put(str(localfile), "/tmp/data", resume=True)
+    assert await sftp_client.exists("/tmp/data")
+    assert not await sftp_client.exists("/tmp/data.part")
+    assert await sftp_client.getsize("/tmp/data") == 100000
+
+    # resume an interrupted upload
+    await sftp_client.remove("/tmp/data")
+    simulated._files[("host1", 22)]["/tmp/data.part"] = 40000
+    await connection._put(str(localfile), "/tmp/data", resume=True)
+    assert await sftp_client.getsize("/tmp/data") == 100000
+    assert not await sftp_client.exists("/tmp/data.part")
+    await connection._disconnect()
+
+
+def test_clean_connections_per_thread(simulated, monkeypatch):
+    monkeypatch.setattr(fox.connection, "_open_connections", weakref.WeakKeyDictionary())
+
+    # each thread connects in its own event loop
+    connections = [Connection(f"host{i}", "fox", 22) for i in range(3)]
+    threads = [
+        threading.Thread(target=run_in_loop, args=(connection._connect(),))
+        for connection in connections[1:]
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    run_in_loop(connections[0]._connect())
+    assert len(fox.connection._open_connections) == 3
+
+    # a loop still running in another thread is left alone
+    busy_connection = Connection("host3", "fox", 22)
+    running = threading.Event()
+    stop = threading.Event()
+
+    def _busy():
+        async def _wait():
+            await busy_connection._connect()
+            running.set()
+            while not stop.is_set():
+                await asyncio.sleep(0.01)
+
+        get_loop().run_until_complete(_wait())
+
+    busy = threading.Thread(target=_busy)
+    busy.start()
+    running.wait()
+    try:
+        _clean_connections()
+        assert busy_connection.connected
+    finally:
+        stop.set()
+        busy.join()
+
+    assert not any(connection.connected for connection in connections)
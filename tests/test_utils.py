@@ -1,4 +1,6 @@
-from fox.utils import split_lines
+import asyncio
+import threading
+from fox.utils import split_lines, LineDecoder, OutputBuffer, get_loop, run_in_loop, tee_streams
 
 
 def test_split_lines():
@@ -6,9 +8,97 @@ def test_split_lines():
         ("ciao\na\nte", (["ciao", "a"], "te")),
         ("ciao\na\nte\n", (["ciao", "a", "te"], "")),
         ("ciao", ([], "ciao")),
+        ("ciao\r\na\r\n", (["ciao", "a"], "")),
     ]
 
     for data, expected in tests:
         lines, rest = split_lines(data)
         assert lines == expected[0]
         assert rest == expected[1]
+
+
+def test_line_decoder():
+    decoder = LineDecoder()
+    data = "città\r\nperché\rfoo\nbar".encode("utf-8")
+
+    # feed one byte at a time: multi-byte characters and "\r\n" are split across chunks
+    lines = []
+    for i in range(len(data)):
+        lines.extend(decoder.feed(data[i : i + 1]))  # noqa: E203
+    assert lines == ["città", "perché", "foo"]
+    assert decoder.partial_endswith("ar")
+    assert decoder.close() == ["bar"]
+
+
+def test_line_decoder_max_line_length():
+    decoder = LineDecoder(max_line_length=4)
+    assert decoder.feed(b"abcdefghij") == ["abcd", "efgh"]
+    assert decoder.feed(b"k\nabcdefghi\n") == ["ijk", "abcd", "efgh", "i"]
+    assert decoder.close() == []
+
+
+def test_loop_per_thread():
+    async def current_loop():
+        return asyncio.get_event_loop()
+
+    loop = run_in_loop(current_loop())
+    assert run_in_loop(current_loop()) is loop
+    assert get_loop() is loop
+
+    loops = []
+    thread = threading.Thread(target=lambda: loops.append(run_in_loop(current_loop())))
+    thread.start()
+    thread.join()
+    assert loops[0] is not loop
+
+    loop.close()
+    assert run_in_loop(current_loop()) is not loop
+
+
+def test_output_buffer():
+    buf = OutputBuffer(10)
+    for chunk in ("abc", "defghij", "klmnopq", "", "r"):
+        buf.append(chunk)
+    assert buf.getvalue() == "ijklmnopqr"
+
+    # a single chunk longer than the limit
+    buf.append("x" * 100)
+    assert buf.getvalue() == "x" * 10
+
+    buf = OutputBuffer(None)
+    buf.append("a" * 100)
+    buf.append("b")
+    assert buf.getvalue() == "a" * 100 + "b"
+
+
+class FakeWriter:
+    def __init__(self, fail_after=None):
+        self.data = b""
+        self.fail_after = fail_after
+        self.eof = self.closed = False
+
+    def write(self, data):
+        if self.fail_after is not None and len(self.data) >= self.fail_after:
+            raise BrokenPipeError()
+        self.data += data
+
+    async def drain(self):
+        pass
+
+    def write_eof(self):
+        self.eof = True
+
+    def close(self):
+        self.closed = True
+
+
+def test_tee_streams():
+    reader = asyncio.StreamReader()
+    reader.feed_data(b"x" * 100)
+    reader.feed_eof()
+    writers = [FakeWriter(), FakeWriter(fail_after=10)]
+
+    assert run_in_loop(tee_streams(reader, writers, read_size=10)) == [100, 10]
+    assert writers[0].data == b"x" * 100 and writers[0].eof and not writers[0].closed
+    # the dropped writer gets no EOF, it's closed instead
+    assert not writers[1].eof and writers[1].closed